@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Measure how long --max-tokens takes to plan and write a dump, against a
+plain --count-tokens run.
+
+Usage:
+    python benchmarks/bench_budget.py [REPO_PATH] [--files N] [--budget N]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from synthetic import make_synthetic_repo  # also puts the repo root on sys.path
+from src.git_dump.core import RepoProcessor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time token-budget planning.")
+    parser.add_argument("repo_path", nargs="?")
+    parser.add_argument("--files", type=int, default=100000, help="Synthetic repo size")
+    parser.add_argument("--file-size", type=int, default=2048, help="Approximate synthetic file size")
+    parser.add_argument("--budget", type=int, default=200000, help="Token budget")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Reader threads")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    repo_path = args.repo_path
+    if repo_path is None:
+        repo_path = os.path.join(tmp_dir, "repo")
+        print(f"Generating {args.files} files...")
+        make_synthetic_repo(repo_path, args.files, args.file_size)
+    output = os.path.join(tmp_dir, "out.txt")
+
+    try:
+        start = time.perf_counter()
+        processor = RepoProcessor(
+            repo_path, output, verbose=False, jobs=args.jobs, max_tokens=args.budget
+        )
+        count = processor.process()
+        elapsed = time.perf_counter() - start
+        print(f"--max-tokens {args.budget}: {count} files, {processor.total_tokens} tokens in {elapsed:.3f}s")
+        assert processor.total_tokens <= args.budget
+
+        start = time.perf_counter()
+        processor = RepoProcessor(repo_path, output, verbose=False, jobs=args.jobs, count_tokens=True)
+        count = processor.process()
+        elapsed = time.perf_counter() - start
+        print(f"--count-tokens:      {count} files, {processor.total_tokens} tokens in {elapsed:.3f}s")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Measure writing a dump compressed (.gz, .xz, .bz2) against plain output, and
+how gzip output scales with --compress-threads. Every compressed dump is
+checked to decompress to the plain one.
+
+Usage:
+    python benchmarks/bench_compress.py [REPO_PATH] [--files N] [--threads 1 2 4 8 ...]
+"""
+
+import argparse
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import tempfile
+import time
+
+from synthetic import make_synthetic_repo  # also puts the repo root on sys.path
+from src.git_dump.core import RepoProcessor
+
+DECOMPRESS = {".gz": gzip.decompress, ".xz": lzma.decompress, ".bz2": bz2.decompress}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time compressed dump output.")
+    parser.add_argument("repo_path", nargs="?")
+    parser.add_argument("--files", type=int, default=30000, help="Synthetic repo size")
+    parser.add_argument("--file-size", type=int, default=2048, help="Approximate synthetic file size")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Reader threads")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8], help="--compress-threads for .gz")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    repo_path = args.repo_path
+    if repo_path is None:
+        repo_path = os.path.join(tmp_dir, "repo")
+        print(f"Generating {args.files} files...")
+        make_synthetic_repo(repo_path, args.files, args.file_size)
+
+    def dump(name, threads=1):
+        output = os.path.join(tmp_dir, name)
+        start = time.perf_counter()
+        RepoProcessor(repo_path, output, verbose=False, jobs=args.jobs, compress_threads=threads).process()
+        return output, time.perf_counter() - start
+
+    try:
+        plain, elapsed = dump("out.txt")
+        with open(plain, "rb") as f:
+            expected = f.read()
+        print(f"plain:               {elapsed:.3f}s, {len(expected) / 1e6:.1f} MB")
+
+        runs = [(".gz", threads) for threads in args.threads] + [(".xz", 1), (".bz2", 1)]
+        for suffix, threads in runs:
+            output, elapsed = dump("out.txt" + suffix, threads)
+            with open(output, "rb") as f:
+                compressed = f.read()
+            assert DECOMPRESS[suffix](compressed) == expected
+            label = f"{suffix} x{threads}" if suffix == ".gz" else suffix
+            print(
+                f"{label + ':':<20} {elapsed:.3f}s, {len(compressed) / 1e6:.1f} MB "
+                f"({len(expected) / len(compressed):.1f}:1)"
+            )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
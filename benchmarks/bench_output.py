@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Measure dump throughput of RepoProcessor.process() against the legacy
+text-mode engine (decode with errors='replace', build a str, re-encode).
+
+Usage:
+    python benchmarks/bench_output.py [REPO_PATH] [--files N] [--file-size BYTES] [--repeat R]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from synthetic import make_synthetic_repo  # also puts the repo root on sys.path
+from src.git_dump.core import RepoProcessor, generate_tree_structure
+
+
+def legacy_process(processor: RepoProcessor) -> int:
+    """The text-mode write loop that process() used before the bytes engine."""
+    manifest = processor._build_manifest()
+    count = 0
+    with open(processor.output_file, "w", encoding="utf-8") as outfile:
+        outfile.write(generate_tree_structure(processor.repo_path, paths=[e.rel_path for e in manifest]))
+        for entry in manifest:
+            with open(entry.abs_path, "rb") as f:
+                if b"\0" in f.read(8192):
+                    continue
+            content = ""
+            with open(entry.abs_path, "r", encoding="utf-8", errors="replace") as f:
+                while True:
+                    chunk = f.read(8192)
+                    if not chunk:
+                        break
+                    content += chunk
+            outfile.write(processor.start_delimiter.format(path=entry.rel_path) + "\n")
+            outfile.write(content)
+            if content and not content.endswith("\n"):
+                outfile.write("\n")
+            outfile.write(processor.end_delimiter.format(path=entry.rel_path) + "\n")
+            count += 1
+    return count
+
+
+def best_of(repeat: int, func) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare dump throughput of the bytes and text engines.")
+    parser.add_argument("repo_path", nargs="?")
+    parser.add_argument("--files", type=int, default=5000, help="Synthetic repo size")
+    parser.add_argument("--file-size", type=int, default=16384, help="Approximate synthetic file size")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    repo_path = args.repo_path
+    if repo_path is None:
+        repo_path = os.path.join(tmp_dir, "repo")
+        make_synthetic_repo(repo_path, args.files, args.file_size)
+    output = os.path.join(tmp_dir, "out.txt")
+
+    try:
+        processor = RepoProcessor(repo_path, output, verbose=False)
+        legacy = best_of(args.repeat, lambda: legacy_process(processor))
+        current = best_of(args.repeat, processor.process)
+        size_mb = os.path.getsize(output) / (1024 * 1024)
+        print(f"output size: {size_mb:.1f} MB")
+        print(f"legacy text engine: {legacy:.3f}s ({size_mb / legacy:.1f} MB/s)")
+        print(f"process():          {current:.3f}s ({size_mb / current:.1f} MB/s)")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Compare parsing a length-prefixed dump by seeking from header to header with
+scanning a delimited dump line by line, as file size grows.
+
+Usage:
+    python benchmarks/bench_parse.py [--files N] [--sizes 1024,16384,262144]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from synthetic import make_synthetic_repo  # also puts the repo root on sys.path
+from src.git_dump.core import LENGTH_PREFIXED_START_DELIMITER, RepoProcessor, parse_length_prefixed
+
+
+def scan_delimited(path: str) -> int:
+    """Count files in a regular dump the way a delimiter-scanning reader finds them."""
+    count = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(b"--- FILE: "):
+                count += 1
+    return count
+
+
+def seek_length_prefixed(path: str) -> int:
+    with open(path, "rb") as f:
+        return sum(1 for _ in parse_length_prefixed(f))
+
+
+def best_of(func, path: str, repeat: int = 3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = func(path)
+        times.append(time.perf_counter() - start)
+    return count, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time dump parsing against file size.")
+    parser.add_argument("--files", type=int, default=2000, help="Files per synthetic repo")
+    parser.add_argument("--sizes", default="1024,16384,262144", help="Comma-separated approximate file sizes")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            repo_path = os.path.join(tmp_dir, f"repo{size}")
+            make_synthetic_repo(repo_path, args.files, size)
+            delimited = os.path.join(tmp_dir, f"delimited{size}.txt")
+            prefixed = os.path.join(tmp_dir, f"prefixed{size}.txt")
+            RepoProcessor(repo_path, delimited, verbose=False, max_file_size=size * 2).process()
+            RepoProcessor(
+                repo_path, prefixed, verbose=False, max_file_size=size * 2,
+                start_delimiter=LENGTH_PREFIXED_START_DELIMITER,
+            ).process()
+
+            scanned, scan_time = best_of(scan_delimited, delimited)
+            parsed, seek_time = best_of(seek_length_prefixed, prefixed)
+            assert scanned == parsed == args.files
+            dump_mb = os.path.getsize(prefixed) / 1e6
+            print(
+                f"{args.files} files of ~{size} bytes ({dump_mb:.0f} MB): "
+                f"scan {scan_time * 1000:.1f} ms, seek {seek_time * 1000:.1f} ms"
+            )
+            shutil.rmtree(repo_path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
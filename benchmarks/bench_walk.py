@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Compare metadata syscalls of the scandir manifest walk against the legacy
+os.walk + Path.iterdir traversal.
+
+Usage:
+    python benchmarks/bench_walk.py [REPO_PATH] [--files N]
+
+Without REPO_PATH a synthetic repository with N files is generated. When
+strace is on PATH each variant runs in a child process under ``strace -c -f``
+and the stat/open/getdents counts are reported; otherwise only wall-clock
+times are printed.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic import make_synthetic_repo  # also puts the repo root on sys.path
+from src.git_dump.core import RepoProcessor, generate_tree_structure  # noqa: E402
+
+TRACED_SYSCALLS = "stat,lstat,fstat,newfstatat,statx,open,openat,getdents64"
+
+
+def legacy_walk(repo_path: str) -> int:
+    """The pre-scandir traversal: Path-based tree plus os.walk with getsize."""
+
+    def _tree(path: Path):
+        for child in sorted(path.iterdir(), key=lambda x: (x.is_file(), x.name.lower())):
+            if child.name == ".git":
+                continue
+            if child.is_dir():
+                _tree(child)
+
+    _tree(Path(repo_path))
+    count = 0
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if d != ".git"]
+        for filename in sorted(files):
+            if os.path.getsize(os.path.join(root, filename)) <= 512000:
+                count += 1
+    return count
+
+
+def scandir_walk(repo_path: str) -> int:
+    processor = RepoProcessor(repo_path, os.devnull, use_gitignore=False, verbose=False)
+    manifest = processor._build_manifest()
+    generate_tree_structure(repo_path, paths=[entry.rel_path for entry in manifest])
+    return len(manifest)
+
+
+VARIANTS = {"legacy": legacy_walk, "scandir": scandir_walk}
+
+
+def run_variant(name: str, repo_path: str) -> None:
+    start = time.perf_counter()
+    count = VARIANTS[name](repo_path)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {count} files in {elapsed:.3f}s")
+
+
+def count_syscalls(name: str, repo_path: str) -> dict:
+    with tempfile.NamedTemporaryFile(suffix=".strace") as trace:
+        subprocess.run(
+            ["strace", "-f", "-c", "-e", f"trace={TRACED_SYSCALLS}", "-o", trace.name,
+             sys.executable, __file__, repo_path, "--variant", name],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        summary = Path(trace.name).read_text()
+    counts = {}
+    for line in summary.splitlines():
+        # % time, seconds, usecs/call, calls, [errors,] syscall
+        match = re.match(r"\s*[\d.]+\s+[\d.]+\s+\d+\s+(\d+)\s+(?:\d+\s+)?(\w+)$", line)
+        if match:
+            counts[match.group(2)] = int(match.group(1))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("repo_path", nargs="?")
+    parser.add_argument("--files", type=int, default=20000, help="Synthetic repo size")
+    parser.add_argument("--variant", choices=sorted(VARIANTS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.repo_path)
+        return
+
+    tmp_dir = None
+    repo_path = args.repo_path
+    if repo_path is None:
+        tmp_dir = tempfile.mkdtemp()
+        repo_path = tmp_dir
+        make_synthetic_repo(repo_path, args.files)
+
+    try:
+        for name in VARIANTS:
+            run_variant(name, repo_path)
+        if shutil.which("strace"):
+            for name in VARIANTS:
+                counts = count_syscalls(name, repo_path)
+                total = sum(counts.values())
+                detail = ", ".join(f"{k}={v}" for k, v in sorted(counts.items()))
+                print(f"{name}: {total} metadata syscalls ({detail})")
+        else:
+            print("strace not found; syscall counts skipped")
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Measure how long an incremental dump and a watch-mode refresh take after a
+single file is edited, against a full dump.
+
+Usage:
+    python benchmarks/bench_watch.py [REPO_PATH] [--files N] [--edits N]
+"""
+
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+
+from synthetic import make_synthetic_repo  # also puts the repo root on sys.path
+from src.git_dump.core import RepoProcessor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time incremental refreshes after single-file edits.")
+    parser.add_argument("repo_path", nargs="?")
+    parser.add_argument("--files", type=int, default=100000, help="Synthetic repo size")
+    parser.add_argument("--file-size", type=int, default=2048, help="Approximate synthetic file size")
+    parser.add_argument("--edits", type=int, default=10, help="Single-file edits to time")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    repo_path = args.repo_path
+    if repo_path is None:
+        repo_path = os.path.join(tmp_dir, "repo")
+        print(f"Generating {args.files} files...")
+        make_synthetic_repo(repo_path, args.files, args.file_size)
+    output = os.path.join(tmp_dir, "out.txt")
+
+    try:
+        start = time.perf_counter()
+        watcher = RepoProcessor(repo_path, output, verbose=False, incremental=True)
+        count = watcher.update()
+        watcher.save_manifest()
+        print(f"full dump:          {count} files in {time.perf_counter() - start:.3f}s")
+
+        paths = [entry.rel_path for entry in watcher._manifest]
+        step = max(1, len(paths) // args.edits)
+        refresh_times = []
+        for rel_path in paths[::step][:args.edits]:
+            with open(os.path.join(repo_path, rel_path), "a", encoding="utf-8") as f:
+                f.write("# edited\n")
+            start = time.perf_counter()
+            watcher.update([rel_path])
+            refresh_times.append(time.perf_counter() - start)
+        refresh_times.sort()
+        print(
+            f"watch refresh:      median {refresh_times[len(refresh_times) // 2] * 1000:.1f} ms,"
+            f" max {refresh_times[-1] * 1000:.1f} ms over {len(refresh_times)} edits"
+        )
+        watcher.save_manifest()
+
+        start = time.perf_counter()
+        RepoProcessor(repo_path, output, verbose=False, incremental=True).process()
+        print(f"--incremental run:  {time.perf_counter() - start:.3f}s (walk and stat, no reads)")
+
+        full_output = os.path.join(tmp_dir, "full.txt")
+        RepoProcessor(repo_path, full_output, verbose=False).process()
+        print(f"identical to a full dump: {filecmp.cmp(output, full_output, shallow=False)}")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""Synthetic repository generator shared by the benchmark scripts."""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+LINE = "def function_{n}(value):\n    return value * {n}  # café\n\n"
+
+
+def make_synthetic_repo(path: str, num_files: int, file_size: int = 64, files_per_dir: int = 50) -> None:
+    """
+    Create ``num_files`` UTF-8 source files of roughly ``file_size`` bytes.
+
+    Files are spread over ``files_per_dir``-sized directories grouped twenty to
+    a package, which approximates the fan-out of a typical monorepo.
+    """
+    for i in range(num_files):
+        directory = os.path.join(path, f"pkg{i // (files_per_dir * 20)}", f"mod{i // files_per_dir}")
+        os.makedirs(directory, exist_ok=True)
+        body = []
+        length = 0
+        n = i
+        while length < file_size:
+            line = LINE.format(n=n)
+            body.append(line)
+            length += len(line)
+            n += 1
+        with open(os.path.join(directory, f"file{i}.py"), "w", encoding="utf-8") as f:
+            f.write("".join(body))
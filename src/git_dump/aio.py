@@ -0,0 +1,214 @@
+"""asyncio access to dumps, for services that stream them from an event loop."""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Optional
+
+from .core import RepoProcessor
+
+# Dumps run at once by the executor shared by AsyncRepoProcessors
+DEFAULT_MAX_DUMPS = 4
+# Chunks a dump may run ahead of its consumer
+DEFAULT_MAX_PENDING = 8
+# Size of the chunks yielded
+ASYNC_BLOCK_SIZE = 256 * 1024
+
+_END = object()
+_shared_executor: Optional[ThreadPoolExecutor] = None
+_shared_executor_lock = threading.Lock()
+
+
+def _default_executor() -> ThreadPoolExecutor:
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(max_workers=DEFAULT_MAX_DUMPS, thread_name_prefix="git-dump-async")
+        return _shared_executor
+
+
+class DumpCancelled(BaseException):
+    """
+    Raised in a dump's worker thread once its stream is closed or past its deadline.
+
+    A BaseException, so the per-file error handling of the writers lets it
+    through and the worker stops instead of reading the rest of the files.
+    """
+
+
+class _ChunkSink:
+    """Binary stream given to process_to(), handing each block to a DumpStream."""
+
+    def __init__(self, stream: "DumpStream"):
+        self._stream = stream
+
+    def write(self, data) -> int:
+        self._stream._put(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+class DumpStream:
+    """
+    Async iterator over the chunks of one dump, as bytes, in output order.
+
+    The dump is written by RepoProcessor.process_to() on a worker thread,
+    which waits whenever ``max_pending`` chunks are ready but not yet
+    consumed, so a slow client holds back reading instead of memory
+    piling up. Closing the stream (aclose(), leaving ``async with``, or
+    cancelling the task awaiting a chunk) stops the worker before its next
+    directory, file or chunk, whether it is still walking the repository or
+    writing. Past the deadline, a loop.time() value, the next chunk raises
+    asyncio.TimeoutError and the worker stops too.
+
+    After the last chunk, ``processed_count`` and ``total_tokens`` hold the
+    totals of the dump; errors of the worker are raised instead.
+    """
+
+    def __init__(
+        self,
+        processor: RepoProcessor,
+        executor: Executor,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        block_size: int = ASYNC_BLOCK_SIZE,
+        deadline: Optional[float] = None,
+    ):
+        self._processor = processor
+        self._loop = asyncio.get_running_loop()
+        self._deadline = deadline
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # Free places for chunks; taken by the worker, given back as they are consumed
+        self._slots = threading.Semaphore(max(1, max_pending))
+        self._closed = False
+        self._finished = False
+        self.processed_count: Optional[int] = None
+        self.total_tokens: Optional[int] = None
+        self._task = self._loop.run_in_executor(executor, self._produce, block_size)
+        # A closed stream's worker ends with DumpCancelled, which nobody awaits
+        self._task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    def _produce(self, block_size: int) -> int:
+        try:
+            return self._processor.process_to(_ChunkSink(self), block_size, self._check_cancelled)
+        finally:
+            try:
+                self._loop.call_soon_threadsafe(self._queue.put_nowait, _END)
+            except RuntimeError:
+                # The event loop is closed
+                pass
+
+    def _check_cancelled(self) -> None:
+        """Raise DumpCancelled if the stream is closed or past its deadline; worker thread only."""
+        if self._closed:
+            raise DumpCancelled("the dump stream was closed")
+        if self._deadline is not None and self._loop.time() > self._deadline:
+            raise DumpCancelled("the dump deadline passed")
+
+    def _put(self, chunk: bytes) -> None:
+        """Pass a chunk to the consumer, waiting for a free place; worker thread only."""
+        if not self._closed:
+            self._slots.acquire()
+        self._check_cancelled()
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, chunk)
+        except RuntimeError:
+            raise DumpCancelled("the event loop is closed")
+
+    def __aiter__(self) -> "DumpStream":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._finished:
+            raise StopAsyncIteration
+        try:
+            if self._deadline is None:
+                chunk = await self._queue.get()
+            else:
+                chunk = await asyncio.wait_for(self._queue.get(), max(0.0, self._deadline - self._loop.time()))
+        except BaseException:
+            # Timed out or cancelled
+            self._close()
+            raise
+        if chunk is _END:
+            self._finished = True
+            self.processed_count = await self._task
+            self.total_tokens = self._processor.total_tokens
+            raise StopAsyncIteration
+        self._slots.release()
+        return chunk
+
+    def _close(self) -> None:
+        if self._closed or self._finished:
+            return
+        self._closed = True
+        # Wake the worker if it waits for a free place
+        self._slots.release()
+
+    async def aclose(self) -> None:
+        """Stop the dump; its worker ends before its next directory, file or chunk."""
+        self._close()
+        self._task.cancel()  # Not started yet: never runs
+
+    async def __aenter__(self) -> "DumpStream":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    def __del__(self) -> None:
+        self._close()
+
+
+class AsyncRepoProcessor:
+    """
+    Dump a repository from asyncio code without blocking the event loop.
+
+    Takes the options of RepoProcessor, but no output file: every stream()
+    runs its own RepoProcessor.process_to() on ``executor``. By default
+    that is one shared by all AsyncRepoProcessors, running at most
+    DEFAULT_MAX_DUMPS dumps at once; further dumps wait for a thread. File
+    reads within a dump use ``jobs`` threads as usual. Incremental,
+    indexed, split and SQLite dumps need a file and are not supported.
+    """
+
+    def __init__(
+        self,
+        repo_path: str,
+        executor: Optional[Executor] = None,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        block_size: int = ASYNC_BLOCK_SIZE,
+        **options,
+    ):
+        self.repo_path = repo_path
+        self.executor = executor
+        self.max_pending = max_pending
+        self.block_size = block_size
+        options.setdefault("verbose", False)
+        self.options = options
+
+    def stream(self, timeout: Optional[float] = None, deadline: Optional[float] = None) -> DumpStream:
+        """
+        Start a dump and return its chunks as a DumpStream; call from a coroutine.
+
+        Args:
+            timeout: Seconds from now the whole dump may take
+            deadline: loop.time() by which the dump must be done
+        """
+        loop = asyncio.get_running_loop()
+        if timeout is not None:
+            deadline = loop.time() + timeout if deadline is None else min(deadline, loop.time() + timeout)
+        processor = RepoProcessor(self.repo_path, os.devnull, **self.options)
+        return DumpStream(
+            processor, self.executor or _default_executor(), self.max_pending, self.block_size, deadline
+        )
+
+    def __aiter__(self) -> DumpStream:
+        return self.stream()
+
+    async def dump(self, timeout: Optional[float] = None) -> bytes:
+        """Return the whole dump."""
+        async with self.stream(timeout) as stream:
+            return b"".join([chunk async for chunk in stream])
@@ -0,0 +1,90 @@
+"""Choosing which files of a repository fit a token budget."""
+
+import fnmatch
+import os
+from typing import List, Optional, Sequence
+
+# Score bonuses for files that explain or start a project
+README_BONUS = 4.0
+ENTRY_POINT_BONUS = 2.0
+# Added in proportion to how recently a file was modified, newest first
+RECENCY_WEIGHT = 1.0
+# Added for matching an earlier --include pattern; later patterns weigh less
+INCLUDE_WEIGHT = 1.0
+# Subtracted per directory level
+DEPTH_PENALTY = 0.1
+MIN_SCORE = 0.1
+
+ENTRY_POINT_NAMES = frozenset({
+    "__main__.py", "main.py", "app.py", "cli.py", "manage.py", "setup.py", "pyproject.toml",
+    "setup.cfg", "package.json", "index.js", "index.ts", "main.js", "main.ts", "main.go",
+    "go.mod", "Cargo.toml", "main.rs", "lib.rs", "Makefile", "Dockerfile", "CMakeLists.txt",
+    "pom.xml", "build.gradle", "Gemfile",
+})
+
+
+def priority_scores(entries, include_patterns: Optional[List[str]] = None) -> List[float]:
+    """
+    Score how much each manifest entry is worth including, higher first.
+
+    READMEs and entry points score highest, then recently modified files and
+    files matching earlier include patterns; deeply nested files score a
+    little less. Size is not part of the score: the packer weighs it.
+    """
+    include_patterns = include_patterns or []
+    # Recency as the rank of the modification time, from 0 (oldest) to 1
+    mtimes = sorted({entry.stat.st_mtime_ns for entry in entries if entry.stat is not None})
+    recency_rank = {mtime: i / max(len(mtimes) - 1, 1) for i, mtime in enumerate(mtimes)}
+
+    scores = []
+    for entry in entries:
+        name = os.path.basename(entry.rel_path)
+        depth = entry.rel_path.count(os.sep)
+        score = 1.0 - DEPTH_PENALTY * depth
+        if name.lower().startswith("readme"):
+            score += README_BONUS / (1 + depth)
+        elif name in ENTRY_POINT_NAMES:
+            score += ENTRY_POINT_BONUS / (1 + depth)
+        if entry.stat is not None:
+            score += RECENCY_WEIGHT * recency_rank[entry.stat.st_mtime_ns]
+        for i, pattern in enumerate(include_patterns):
+            if fnmatch.fnmatch(entry.rel_path, pattern):
+                score += INCLUDE_WEIGHT * (len(include_patterns) - i) / len(include_patterns)
+                break
+        scores.append(max(score, MIN_SCORE))
+    return scores
+
+
+def density_order(weights: Sequence[int], values: Sequence[float]) -> List[int]:
+    """Indices by value per unit of weight, best first; ties go to the lighter item."""
+    return sorted(range(len(weights)), key=lambda i: (-values[i] / max(weights[i], 1), weights[i], i))
+
+
+def pack(
+    weights: Sequence[int], values: Sequence[float], capacity: int, order: Optional[List[int]] = None
+) -> List[int]:
+    """
+    Choose items of total weight at most ``capacity`` with a high total value.
+
+    The greedy 0/1 knapsack: take items by value density, skipping those that
+    no longer fit. If a single item is worth more than the whole greedy pick,
+    it is taken alone instead, which keeps the result within half of the
+    optimum.
+
+    Returns:
+        Chosen indices in density order
+    """
+    if order is None:
+        order = density_order(weights, values)
+    chosen = []
+    remaining = capacity
+    value = 0.0
+    for i in order:
+        if weights[i] <= remaining:
+            chosen.append(i)
+            remaining -= weights[i]
+            value += values[i]
+    best = max((i for i in order if weights[i] <= capacity), key=lambda i: values[i], default=None)
+    if best is not None and values[best] > value:
+        return [best]
+    return chosen
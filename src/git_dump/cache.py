@@ -0,0 +1,119 @@
+"""Persistent caches shared between git_dump runs."""
+
+import logging
+import os
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Default number of token counts kept before least-recently-used eviction
+DEFAULT_MAX_ENTRIES = 1_000_000
+
+
+def default_cache_dir() -> str:
+    """Return the git-dump cache directory under $XDG_CACHE_HOME (~/.cache)."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "git-dump")
+
+
+def default_token_cache_path() -> str:
+    return os.path.join(default_cache_dir(), "tokens.sqlite3")
+
+
+class TokenCache:
+    """
+    Content-addressed token counts stored in SQLite.
+
+    Counts are keyed by the file's git blob OID and the encoding name, so
+    unchanged files are never re-tokenized, whichever path or checkout they
+    come from. Lookups are read straight from the database; new counts and
+    recency updates are buffered and written in one transaction by close(),
+    which also evicts the least recently used rows beyond ``max_entries``.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path or default_token_cache_path()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._new: List[Tuple[str, str, int, int]] = []
+        self._touched: List[Tuple[int, str, str]] = []
+        self._now = int(time.time())
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_counts ("
+            " oid TEXT NOT NULL,"
+            " encoding TEXT NOT NULL,"
+            " tokens INTEGER NOT NULL,"
+            " last_used INTEGER NOT NULL,"
+            " PRIMARY KEY (oid, encoding)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS token_counts_last_used ON token_counts (last_used)"
+        )
+        self._conn.commit()
+
+    def get(self, oid: str, encoding: str) -> Optional[int]:
+        """Return the cached token count for a blob, or None on a miss."""
+        row = self._conn.execute(
+            "SELECT tokens FROM token_counts WHERE oid = ? AND encoding = ?", (oid, encoding)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched.append((self._now, oid, encoding))
+        return row[0]
+
+    def put(self, oid: str, encoding: str, tokens: int) -> None:
+        """Record a token count; written on close()."""
+        self._new.append((oid, encoding, tokens, self._now))
+
+    def close(self) -> None:
+        """Flush buffered writes, evict old entries and close the database."""
+        if self._conn is None:
+            return
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO token_counts (oid, encoding, tokens, last_used) VALUES (?, ?, ?, ?)",
+                    self._new,
+                )
+                self._conn.executemany(
+                    "UPDATE token_counts SET last_used = ? WHERE oid = ? AND encoding = ?",
+                    self._touched,
+                )
+                # The newest row beyond ``max_entries``, then it and all older
+                # ones; compared column by column, as row values need SQLite 3.15
+                cutoff = self._conn.execute(
+                    "SELECT last_used, oid, encoding FROM token_counts"
+                    " ORDER BY last_used DESC, oid DESC, encoding DESC LIMIT 1 OFFSET ?",
+                    (self.max_entries,),
+                ).fetchone()
+                if cutoff is not None:
+                    last_used, oid, encoding = cutoff
+                    self._conn.execute(
+                        "DELETE FROM token_counts WHERE last_used < ? OR (last_used = ? AND"
+                        " (oid < ? OR (oid = ? AND encoding <= ?)))",
+                        (last_used, last_used, oid, oid, encoding),
+                    )
+        except sqlite3.Error as e:
+            logger.warning(f"Could not update token cache {self.path}: {e}")
+        finally:
+            self._conn.close()
+            self._conn = None
+            self._new = []
+            self._touched = []
+
+    def __enter__(self) -> "TokenCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
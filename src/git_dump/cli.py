@@ -4,7 +4,16 @@ import argparse
 import logging
 import os
 import sys
-from .core import RepoProcessor, get_tiktoken_token_count, generate_tree_structure
+from .cache import default_token_cache_path
+from .core import (
+    DEFAULT_START_DELIMITER,
+    LENGTH_PREFIXED_START_DELIMITER,
+    RepoProcessor,
+    get_tiktoken_token_count,
+    generate_tree_structure,
+)
+from .output import compression_for
+from .watch import watch
 
 
 def setup_logging(verbose: bool):
@@ -17,11 +26,17 @@ def setup_logging(verbose: bool):
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Concatenate all files in a Git repository into one file."
+        description="Concatenate all files in a Git repository into one file.",
+        epilog="'git-dump-serve' runs a server keeping repositories warm for 'git-dump-client'.",
     )
     parser.add_argument("repo_path", help="Path to the root of the Git repository")
     parser.add_argument(
-        "-o", "--output", default="repository_contents.txt", help="Output filename"
+        "-o", "--output", default="repository_contents.txt", help="Output filename, or - for standard output"
+    )
+    parser.add_argument(
+        "--format", choices=["text", "jsonl", "sqlite"], default="text", dest="output_format",
+        help="text: delimited file contents (default); jsonl: one JSON object per file with path, size, "
+        "language, tokens, sha and content; sqlite: the same as rows of an SQLite database with an FTS5 index"
     )
     parser.add_argument(
         "--no-gitignore", 
@@ -36,11 +51,16 @@ def main():
         "--include", action="append", help="Patterns to include (e.g., '*.py')"
     )
     parser.add_argument(
-        "--start-delimiter", default="--- FILE: {path} ---", help="Custom start delimiter"
+        "--start-delimiter", default=DEFAULT_START_DELIMITER,
+        help="Custom start delimiter; {path} is the file's path and {bytes} its content length"
     )
     parser.add_argument(
         "--end-delimiter", default="--- END FILE ---", help="Custom end delimiter"
     )
+    parser.add_argument(
+        "--length-prefixed", action="store_true",
+        help="Write headers as '--- FILE: path (bytes=N) ---' so readers can seek past content"
+    )
     parser.add_argument(
         "-q", "--quiet", action="store_false", dest="verbose", help="Quiet mode"
     )
@@ -56,6 +76,67 @@ def main():
     parser.add_argument(
         "--count-tokens", action="store_true", help="Count total tokens in output (requires tiktoken if available)"
     )
+    parser.add_argument(
+        "--max-tokens", type=int, default=None, metavar="N",
+        help="Fit the output, tree and delimiters included, into N tokens, preferring READMEs, entry points and recent files"
+    )
+    parser.add_argument(
+        "--split-tokens", type=int, default=None, metavar="N",
+        help="Write numbered shards OUTPUT.001 ... of at most N tokens each instead of one output file"
+    )
+    parser.add_argument(
+        "--split-bytes", type=int, default=None, metavar="N",
+        help="Write numbered shards OUTPUT.001 ... of at most N bytes each instead of one output file"
+    )
+    parser.add_argument(
+        "--token-cache", default=None, metavar="PATH",
+        help="SQLite file caching token counts by content hash (default: $XDG_CACHE_HOME/git-dump/tokens.sqlite3)"
+    )
+    parser.add_argument(
+        "--no-token-cache", action="store_false", dest="use_token_cache", help="Do not use the persistent token cache"
+    )
+    parser.add_argument(
+        "--source", choices=["walk", "index"], default="walk",
+        help="Enumerate files by walking the directory or from the git index (default: walk)"
+    )
+    parser.add_argument(
+        "--untracked", action="store_true", dest="include_untracked",
+        help="With --source=index, also include untracked files that are not ignored"
+    )
+    parser.add_argument(
+        "--rev", default=None, metavar="REF",
+        help="Dump the tree of a commit, tag or branch from the object database instead of the working tree"
+    )
+    parser.add_argument(
+        "--diff", default=None, metavar="RANGE",
+        help="Only dump files added or modified in BASE..HEAD (BASE alone compares with the working tree)"
+    )
+    parser.add_argument(
+        "--merge-base", action="store_true",
+        help="With --diff, compare from the merge base of BASE and HEAD, like BASE...HEAD"
+    )
+    parser.add_argument(
+        "--diff-hunks", action="store_true", help="With --diff, also include each file's unified diff"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Rebuild the output from the previous run, re-reading only changed files (keeps OUTPUT.manifest.json)"
+    )
+    parser.add_argument(
+        "--index", action="store_true",
+        help="Also write OUTPUT.index.json with each file's content offset, length, tokens and hash"
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Keep the output up to date as files change (implies --incremental; Ctrl-C to stop)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of threads reading files concurrently (default: 1)"
+    )
+    parser.add_argument(
+        "--compress-threads", type=int, default=None, metavar="N",
+        help="Threads compressing a .gz output in independent blocks, like pigz (default: --jobs)"
+    )
 
     args = parser.parse_args()
 
@@ -63,6 +144,51 @@ def main():
         print(f"Error: Path '{args.repo_path}' is not a directory.")
         sys.exit(1)
 
+    if args.watch and (args.rev or args.diff or args.dry_run):
+        print("Error: --watch cannot be combined with --rev, --diff or --dry-run.")
+        sys.exit(1)
+
+    if args.max_tokens is not None and (args.max_tokens <= 0 or args.watch):
+        print("Error: --max-tokens must be positive and cannot be combined with --watch.")
+        sys.exit(1)
+
+    split = args.split_tokens is not None or args.split_bytes is not None
+    if split and (
+        (args.split_tokens is not None and args.split_bytes is not None)
+        or (args.split_tokens or args.split_bytes) <= 0
+        or args.incremental or args.watch or args.index or args.max_tokens is not None
+    ):
+        print("Error: use one positive --split-tokens or --split-bytes, without --incremental, --watch, --index or --max-tokens.")
+        sys.exit(1)
+
+    if args.output_format != "text" and (
+        split or args.watch or args.index or args.max_tokens is not None
+        or (args.incremental and args.output_format != "sqlite")
+    ):
+        print(f"Error: --format {args.output_format} cannot be combined with --split-*, --watch, --index "
+              "or --max-tokens, and only sqlite with --incremental.")
+        sys.exit(1)
+
+    to_stdout = args.output == "-"
+    if to_stdout and (
+        split or args.incremental or args.watch or args.index or args.output_format == "sqlite"
+    ):
+        print("Error: -o - cannot be combined with --split-*, --incremental, --watch, --index or --format sqlite.")
+        sys.exit(1)
+
+    if compression_for(args.output) is not None and (
+        args.incremental or args.watch or args.index or args.output_format == "sqlite"
+    ):
+        print("Error: compressed output cannot be combined with --incremental, --watch, --index or --format sqlite.")
+        sys.exit(1)
+
+    if args.length_prefixed:
+        if args.start_delimiter == DEFAULT_START_DELIMITER:
+            args.start_delimiter = LENGTH_PREFIXED_START_DELIMITER
+        elif "{bytes}" not in args.start_delimiter:
+            print("Error: --length-prefixed needs a --start-delimiter with a {bytes} field.")
+            sys.exit(1)
+
     setup_logging(args.verbose)
 
     processor = RepoProcessor(
@@ -78,23 +204,81 @@ def main():
         max_file_size=args.max_size,
         include_tree=args.include_tree,
         count_tokens=args.count_tokens,
+        jobs=args.jobs,
+        source=args.source,
+        include_untracked=args.include_untracked,
+        rev=args.rev,
+        diff=args.diff,
+        merge_base=args.merge_base,
+        diff_hunks=args.diff_hunks,
+        incremental=args.incremental or args.watch,
+        index=args.index,
+        max_tokens=args.max_tokens,
+        split_tokens=args.split_tokens,
+        split_bytes=args.split_bytes,
+        output_format=args.output_format,
+        compress_threads=args.compress_threads,
     )
+    # --max-tokens and --split-tokens count tokens too
+    if processor.count_tokens and args.use_token_cache:
+        processor.token_cache_path = args.token_cache or default_token_cache_path()
 
+    # With -o -, standard output carries the dump
+    report = sys.stderr if to_stdout else sys.stdout
     if args.verbose:
-        print(f"Processing repository at: {processor.repo_path}")
+        print(f"Processing repository at: {processor.repo_path}", file=report)
+
+    if args.watch:
+        if args.verbose:
+            print(f"Watching for changes; output: {processor.output_file} (Ctrl-C to stop)")
+        try:
+            watch(processor)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            logging.error(f"Fatal error: {e}")
+            sys.exit(1)
+        return
 
-    files_processed = processor.process()
+    if to_stdout:
+        try:
+            files_processed = processor.process_to(sys.stdout)
+        except BrokenPipeError:
+            # The reader went away; keep the interpreter from failing to flush at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+        except Exception as e:
+            logging.error(f"Fatal error: {e}")
+            sys.exit(1)
+    else:
+        files_processed = processor.process()
 
     if args.verbose:
         if args.dry_run:
-            print(f"\nDry run summary: Would have processed {files_processed} files.")
+            print(f"\nDry run summary: Would have processed {files_processed} files.", file=report)
+        elif to_stdout:
+            print("\nSummary:", file=report)
+            print(f"Total files processed: {files_processed}", file=report)
+            if args.count_tokens or args.max_tokens is not None:
+                print(f"Total estimated tokens: {processor.total_tokens}", file=report)
+        elif processor.shard_files:
+            print("\nSummary:")
+            print(f"Total files processed: {files_processed}")
+            print(f"Shards written: {len(processor.shard_files)}")
+            if args.count_tokens or args.split_tokens is not None:
+                print(f"Total estimated tokens: {processor.total_tokens}")
+            print(f"Result saved to: {processor.shard_files[0]} ... {processor.shard_files[-1]}")
         elif os.path.exists(processor.output_file):
             output_size = os.path.getsize(processor.output_file)
             print("\nSummary:")
             print(f"Total files processed: {files_processed}")
             print(f"Output file size: {output_size} bytes")
-            if args.count_tokens:
+            if args.incremental:
+                print(f"Reused from previous output: {processor.reused_count} files")
+            if args.count_tokens or args.max_tokens is not None:
                 print(f"Total estimated tokens: {processor.total_tokens}")
+                if processor.token_cache_path:
+                    print(f"Token cache: {processor.token_cache_hits} hits, {processor.token_cache_misses} misses")
             print(f"Result saved to: {processor.output_file}")
         else:
             print("\nNo files were processed.")
@@ -0,0 +1,118 @@
+"""
+Thin client of the dump server (git-dump-serve).
+
+Only the standard library is imported, so a request costs little more than
+interpreter startup; the server keeps everything else warm.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+from typing import BinaryIO, Optional
+
+# Bytes copied from the socket per read
+RECEIVE_SIZE = 1024 * 1024
+
+
+class ServerError(Exception):
+    """The server could not be reached or could not produce the dump."""
+
+
+def default_socket_path() -> str:
+    """Return the server socket path: under $XDG_RUNTIME_DIR if set, else the git-dump cache directory."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "git-dump.sock")
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "git-dump", "serve.sock")
+
+
+def request_dump(repo_path: str, out: BinaryIO, socket_path: Optional[str] = None, **options) -> dict:
+    """
+    Ask the server for a dump of a repository and write it to a binary stream.
+
+    Args:
+        repo_path: Repository to dump
+        out: Binary stream the dump is written to
+        socket_path: Server socket (default: default_socket_path())
+        **options: RepoProcessor options, from the server's CLIENT_OPTIONS
+
+    Returns:
+        The server's summary: files, tokens (None unless counted), reused and size
+
+    Raises:
+        ServerError: If the server is not running or reports an error
+    """
+    socket_path = socket_path or default_socket_path()
+    request = {"repo": os.path.abspath(repo_path), "options": options}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            raise ServerError(f"No git-dump server at {socket_path} ({e}); start one with 'git-dump-serve'") from e
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as reply:
+            header = json.loads(reply.readline() or b"{}")
+            if "error" in header or "size" not in header:
+                raise ServerError(header.get("error", "The server closed the connection"))
+            remaining = header["size"]
+            while remaining:
+                data = reply.read(min(remaining, RECEIVE_SIZE))
+                if not data:
+                    raise ServerError(f"The dump ended {remaining} bytes early")
+                out.write(data)
+                remaining -= len(data)
+    finally:
+        sock.close()
+    return header
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Get a repository dump from a running 'git-dump-serve'.")
+    parser.add_argument("repo_path", help="Path to the root of the Git repository")
+    parser.add_argument("-o", "--output", default="repository_contents.txt", help="Output filename, or - for standard output")
+    parser.add_argument("--socket", default=None, help=f"Server socket (default: {default_socket_path()})")
+    parser.add_argument("--no-gitignore", action="store_false", dest="use_gitignore", help="Do not respect .gitignore files")
+    parser.add_argument("-i", "--ignore", action="append", help="Additional patterns to ignore")
+    parser.add_argument("--include", action="append", help="Patterns to include (e.g., '*.py')")
+    parser.add_argument("--max-size", type=int, default=512000, help="Maximum file size to include in bytes")
+    parser.add_argument("--no-tree", action="store_false", dest="include_tree", help="Do not include directory tree structure")
+    parser.add_argument("--count-tokens", action="store_true", help="Count total tokens in output")
+    parser.add_argument("-q", "--quiet", action="store_false", dest="verbose", help="Quiet mode")
+    args = parser.parse_args(argv)
+
+    options = {
+        "use_gitignore": args.use_gitignore,
+        "ignore_patterns": args.ignore,
+        "include_patterns": args.include,
+        "max_file_size": args.max_size,
+        "include_tree": args.include_tree,
+        "count_tokens": args.count_tokens,
+    }
+    to_stdout = args.output == "-"
+    try:
+        if to_stdout:
+            summary = request_dump(args.repo_path, sys.stdout.buffer, args.socket, **options)
+            sys.stdout.buffer.flush()
+        else:
+            with open(args.output, "wb") as out:
+                summary = request_dump(args.repo_path, out, args.socket, **options)
+    except ServerError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.verbose:
+        report = sys.stderr if to_stdout else sys.stdout
+        print(f"Total files processed: {summary['files']}", file=report)
+        print(f"Reused from previous output: {summary['reused']} files", file=report)
+        if summary.get("tokens") is not None:
+            print(f"Total estimated tokens: {summary['tokens']}", file=report)
+        if not to_stdout:
+            print(f"Result saved to: {args.output}", file=report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,30 @@
 """Core functionality for git_dump."""
 
+import codecs
+import hashlib
+import io
+import itertools
+import json
 import os
+import re
+import sqlite3
+import stat
 import sys
+import threading
+import time
 import logging
-from pathlib import Path
-from typing import List, Optional, Generator, Tuple
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Generator, Set, Tuple
 import fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import budget, git
+from .cache import TokenCache
+from .database import SQLITE_SUFFIXES, DumpDatabase
+from .incremental import MANIFEST_SUFFIX, RACY_WINDOW_NS, TEMP_SUFFIX, DumpManifest
+from .index import INDEX_SUFFIX, write_index
+from .language import detect_language
+from .output import DumpWriter, StreamOutput, compression_for, open_output
 
 try:
     import pathspec
@@ -14,6 +33,41 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Bytes inspected for binary detection; also the first block of content read
+SNIFF_SIZE = 8192
+# Read size for file content after the sniffed block
+READ_CHUNK_SIZE = 65536
+# Buffer size of the output handle
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+# Files read ahead per worker thread when jobs > 1
+PARALLEL_WINDOW_PER_JOB = 4
+# Minimum threads used by tiktoken's batch encoder
+TOKENIZER_THREADS = 8
+# Ways of enumerating the files to dump
+SOURCES = ("walk", "index")
+# Output formats: delimited text, one JSON object per file, or an SQLite database
+FORMATS = ("text", "jsonl", "sqlite")
+# ls-tree mode of symbolic links
+GIT_SYMLINK_MODE = "120000"
+# Fill candidates read and found too large before the token budget planner stops
+BUDGET_FILL_ATTEMPTS = 256
+# What RepoProcessor._read_content() returns for a binary file
+BINARY_CONTENT = ()
+# First line of every shard of a split dump
+SHARD_HEADER = "--- SHARD {number}: {name} ---"
+# Files read and measured at a time when splitting or writing JSONL, and the
+# most bytes they may total
+READ_BATCH_FILES = 256
+READ_BATCH_BYTES = 16 * 1024 * 1024
+# Delimiters around a changed file's unified diff (diff_hunks)
+DIFF_START_DELIMITER = "--- DIFF: {path} ---"
+DIFF_END_DELIMITER = "--- END DIFF ---"
+DEFAULT_START_DELIMITER = "--- FILE: {path} ---"
+# Start delimiters giving the byte length of the content that follows, so a
+# reader can seek from one header to the next (parse_length_prefixed)
+LENGTH_PREFIXED_START_DELIMITER = "--- FILE: {path} (bytes={bytes}) ---"
+LENGTH_PREFIXED_DIFF_DELIMITER = "--- DIFF: {path} (bytes={bytes}) ---"
+
 
 def estimate_tokens(text: str) -> int:
     """
@@ -28,6 +82,31 @@ def estimate_tokens(text: str) -> int:
     return len(text) // 4
 
 
+# tiktoken encoders by encoding name; None when tiktoken is not installed
+_ENCODERS: Dict[str, object] = {}
+
+
+def _get_encoder(encoding_name: str = "cl100k_base"):
+    """
+    Return the tiktoken encoder for an encoding, loading it on first use.
+
+    Returns:
+        The cached encoder, or None if tiktoken is unavailable
+    """
+    try:
+        return _ENCODERS[encoding_name]
+    except KeyError:
+        pass
+    try:
+        import tiktoken
+    except ImportError:
+        encoder = None
+    else:
+        encoder = tiktoken.get_encoding(encoding_name)
+    _ENCODERS[encoding_name] = encoder
+    return encoder
+
+
 def get_tiktoken_token_count(text: str, encoding_name: str = "cl100k_base") -> int:
     """
     Get exact token count using tiktoken if available.
@@ -39,77 +118,468 @@ def get_tiktoken_token_count(text: str, encoding_name: str = "cl100k_base") -> i
     Returns:
         Exact number of tokens or estimated count if tiktoken unavailable
     """
-    try:
-        import tiktoken
-        encoder = tiktoken.get_encoding(encoding_name)
-        return len(encoder.encode(text))
-    except ImportError:
+    encoder = _get_encoder(encoding_name)
+    if encoder is None:
         # Fallback to character-based estimation
         return estimate_tokens(text)
+    return len(encoder.encode_ordinary(text))
+
+
+class TokenCounter:
+    """
+    Count tokens of text streamed from many files, with bounded memory.
+
+    Each file's text is cut into pieces at newlines, so tokens are not split at
+    arbitrary chunk boundaries. Pieces from consecutive files are queued and
+    encoded together through tiktoken's multi-threaded batch API once
+    ``batch_chars`` characters are pending.
 
+    A file's pieces are held back until end_file(), so a count known from a
+    cache can replace them without encoding; files larger than ``batch_chars``
+    are always encoded. Counts of files ended with a key are reported in
+    ``file_counts`` after finish().
 
-def generate_tree_structure(repo_path: str, max_depth: Optional[int] = None) -> str:
+    Without tiktoken, each piece is estimated on its own. ``round_up`` rounds
+    those estimates up, so the counts of the parts of a text add up to at
+    least estimate_tokens() of the whole text, as limits need.
+    """
+
+    def __init__(
+        self,
+        encoding_name: str = "cl100k_base",
+        max_pending: int = 65536,
+        batch_chars: int = 1024 * 1024,
+        num_threads: int = 8,
+        round_up: bool = False,
+    ):
+        self.encoding_name = encoding_name
+        self.max_pending = max_pending
+        self.batch_chars = batch_chars
+        self.num_threads = num_threads
+        self.round_up = round_up
+        self.total = 0
+        self.file_counts: Dict[str, int] = {}
+        # Text of the current file not yet cut into a piece
+        self._pending: List[str] = []
+        self._pending_len = 0
+        # Pieces of the current file held until end_file()
+        self._file_pieces: List[str] = []
+        self._file_pieces_len = 0
+        self._spilled = False
+        self._file_id = 0
+        # (file id, piece) pairs waiting to be encoded
+        self._batch: List[Tuple[int, str]] = []
+        self._batch_len = 0
+        # Per-file counts for keyed files and the file in progress
+        self._file_keys: Dict[int, str] = {}
+        self._file_tokens: Dict[int, int] = {}
+
+    @property
+    def count_method(self) -> str:
+        """The encoding name, or 'estimate' when tiktoken is unavailable."""
+        return self.encoding_name if _get_encoder(self.encoding_name) is not None else "estimate"
+
+    def feed(self, text: str) -> None:
+        """Add the next chunk of text of the current file."""
+        self._pending.append(text)
+        self._pending_len += len(text)
+        if self._pending_len >= self.max_pending:
+            self._cut_pending(final=False)
+
+    def end_file(self, key: Optional[str] = None, known_tokens: Optional[int] = None) -> None:
+        """
+        Mark the end of the current file's text.
+
+        Args:
+            key: Identifier under which the file's count is reported in
+                file_counts once counted
+            known_tokens: Count already known for this text (e.g. cached);
+                used instead of encoding unless the file was too large to hold
+        """
+        self._cut_pending(final=True)
+        if known_tokens is not None and not self._spilled:
+            self.total += known_tokens
+        else:
+            if key is not None:
+                self._file_keys[self._file_id] = key
+            self._spill()
+            if key is None:
+                self._file_tokens.pop(self._file_id, None)
+        self._file_pieces = []
+        self._file_pieces_len = 0
+        self._spilled = False
+        self._file_id += 1
+
+    def finish(self) -> int:
+        """Count all queued text and return the total."""
+        self.end_file()
+        self._encode_batch()
+        for file_id, key in self._file_keys.items():
+            self.file_counts[key] = self._file_tokens.get(file_id, 0)
+        self._file_keys = {}
+        self._file_tokens = {}
+        return self.total
+
+    def _cut_pending(self, final: bool) -> None:
+        text = "".join(self._pending)
+        rest = ""
+        if not final:
+            cut = text.rfind("\n") + 1
+            # A single very long line is cut anyway to keep memory bounded
+            if cut == 0 and len(text) < 4 * self.max_pending:
+                self._pending = [text]
+                return
+            if cut:
+                text, rest = text[:cut], text[cut:]
+        if text:
+            self._file_pieces.append(text)
+            self._file_pieces_len += len(text)
+            if self._file_pieces_len >= self.batch_chars:
+                self._spilled = True
+                self._spill()
+        self._pending = [rest] if rest else []
+        self._pending_len = len(rest)
+
+    def _spill(self) -> None:
+        """Move the current file's held pieces into the encode batch."""
+        for text in self._file_pieces:
+            self._batch.append((self._file_id, text))
+            self._batch_len += len(text)
+        self._file_pieces = []
+        self._file_pieces_len = 0
+        if self._batch_len >= self.batch_chars:
+            self._encode_batch()
+
+    def _encode_batch(self) -> None:
+        if not self._batch:
+            return
+        texts = [text for _, text in self._batch]
+        encoder = _get_encoder(self.encoding_name)
+        if encoder is None:
+            if self.round_up:
+                counts = [-(-len(text) // 4) for text in texts]
+            else:
+                counts = [estimate_tokens(text) for text in texts]
+        else:
+            counts = [len(tokens) for tokens in encoder.encode_ordinary_batch(texts, num_threads=self.num_threads)]
+        for (file_id, _), count in zip(self._batch, counts):
+            self.total += count
+            if file_id == self._file_id or file_id in self._file_keys:
+                self._file_tokens[file_id] = self._file_tokens.get(file_id, 0) + count
+        self._batch = []
+        self._batch_len = 0
+
+
+def _walk_order_key(rel_path: str) -> Tuple[Tuple[int, str], ...]:
+    """Sort key placing a directory's files before its subdirectories, as the walk does."""
+    parts = rel_path.split(os.sep)
+    return tuple((1, part) for part in parts[:-1]) + ((0, parts[-1]),)
+
+
+def shard_path(output_file: str, number: int) -> str:
+    """Return the path of a numbered shard of a split dump, e.g. out.002.txt for out.txt."""
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.{number:03d}{ext}"
+
+
+def _entered_dirs(previous: str, rel_path: str) -> List[str]:
+    """Directories of ``rel_path`` that ``previous`` is not in, outermost first."""
+    parts = rel_path.split(os.sep)[:-1]
+    previous_parts = previous.split(os.sep)[:-1] if previous else []
+    common = 0
+    while common < min(len(parts), len(previous_parts)) and parts[common] == previous_parts[common]:
+        common += 1
+    return [os.sep.join(parts[:depth]) for depth in range(common + 1, len(parts) + 1)]
+
+
+# Directories skipped when generating a tree without a file manifest
+TREE_IGNORE_NAMES = ['.git', '__pycache__', '.pytest_cache', '.ruff_cache', '.venv', 'venv', 'node_modules', '.DS_Store']
+
+
+def generate_tree_structure(
+    repo_path: str,
+    max_depth: Optional[int] = None,
+    paths: Optional[Iterable[str]] = None,
+) -> str:
     """
     Generate a text-based directory tree structure.
 
     Args:
         repo_path: Path to the repository
         max_depth: Maximum depth to traverse (None for unlimited)
+        paths: Relative file paths to render, typically the manifest built by
+            RepoProcessor. If omitted, the repository is walked and common
+            cache/VCS directories are skipped.
 
     Returns:
         String representation of the directory tree
     """
-    repo_path = Path(repo_path)
+    repo_path = os.path.abspath(repo_path)
+    if paths is None:
+        paths = []
+        for root, dirs, files in os.walk(repo_path):
+            dirs[:] = [d for d in dirs if d not in TREE_IGNORE_NAMES]
+            rel_dir = os.path.relpath(root, repo_path)
+            for filename in files:
+                if filename not in TREE_IGNORE_NAMES:
+                    paths.append(filename if rel_dir == "." else os.path.join(rel_dir, filename))
+
+    # Nested dict of directory name -> children; files map to None
+    root_node: Dict[str, Optional[dict]] = {}
+    for path in paths:
+        parts = path.replace(os.sep, "/").split("/")
+        node = root_node
+        for part in parts[:-1]:
+            child = node.get(part)
+            if child is None:
+                child = node[part] = {}
+            node = child
+        node.setdefault(parts[-1], None)
+
     tree_lines = ["--- REPOSITORY STRUCTURE ---"]
 
-    def _should_ignore(path: Path) -> bool:
-        """Check if a path should be ignored based on common patterns."""
-        rel_path = path.relative_to(repo_path).as_posix()
-        # Common directories to skip for cleaner output
-        ignore_patterns = ['.git', '__pycache__', '.pytest_cache', '.ruff_cache', '.venv', 'venv', 'node_modules', '.DS_Store']
-        return any(ignore_part in rel_path.split('/') for ignore_part in ignore_patterns)
+    def _sorted_children(node: dict) -> List[Tuple[str, Optional[dict]]]:
+        return sorted(node.items(), key=lambda item: (item[1] is None, item[0].lower()))
 
-    def _add_tree_item(item_path: Path, prefix: str = "", depth: int = 0):
+    def _add_tree_item(rel_path: str, children: Optional[dict], prefix: str = "", depth: int = 0):
         if max_depth is not None and depth > max_depth:
             return
 
-        if _should_ignore(item_path):
-            return
-
-        # Get relative path from repo root
-        rel_path = item_path.relative_to(repo_path)
-        if rel_path.name == "":
-            # This is the root
-            display_name = str(repo_path.name)
-        else:
-            display_name = rel_path.as_posix()
-
-        if item_path.is_dir():
+        if children is not None:
             # Add directory
-            tree_lines.append(f"{prefix}├── {display_name}/")
-            children = sorted([child for child in item_path.iterdir() if not _should_ignore(child)],
-                             key=lambda x: (x.is_file(), x.name.lower()))
-            for i, child in enumerate(children):
-                is_last = i == len(children) - 1
+            tree_lines.append(f"{prefix}├── {rel_path}/")
+            items = _sorted_children(children)
+            for i, (name, grandchildren) in enumerate(items):
+                is_last = i == len(items) - 1
                 new_prefix = prefix + ("    " if is_last else "│   ")
-                _add_tree_item(child, new_prefix, depth + 1)
+                _add_tree_item(f"{rel_path}/{name}", grandchildren, new_prefix, depth + 1)
         else:
             # Add file
-            tree_lines.append(f"{prefix}├── {display_name}")
+            tree_lines.append(f"{prefix}├── {rel_path}")
 
     # Start with the root directory
-    tree_lines.append(f"{repo_path.name}/")
-    children = sorted([child for child in repo_path.iterdir() if not _should_ignore(child)],
-                     key=lambda x: (x.is_file(), x.name.lower()))
-    for i, child in enumerate(children):
-        is_last = i == len(children) - 1
+    tree_lines.append(f"{os.path.basename(repo_path)}/")
+    items = _sorted_children(root_node)
+    for i, (name, children) in enumerate(items):
+        is_last = i == len(items) - 1
         prefix = "" if is_last else "│   "
-        _add_tree_item(child, prefix)
+        _add_tree_item(name, children, prefix)
 
     tree_lines.append("--- END REPOSITORY STRUCTURE ---\n")
     return "\n".join(tree_lines)
 
 
+class ManifestEntry:
+    """A file selected for the dump by a single traversal of the repository."""
+
+    __slots__ = ("rel_path", "abs_path", "size", "stat", "oid")
+
+    def __init__(
+        self,
+        rel_path: str,
+        abs_path: Optional[str],
+        size: int,
+        stat_result: Optional[os.stat_result] = None,
+        oid: Optional[str] = None,
+    ):
+        self.rel_path = rel_path
+        # None for blobs read from the object database
+        self.abs_path = abs_path
+        self.size = size
+        # The single stat taken during the walk, reused downstream
+        self.stat = stat_result
+        # Git blob OID, when the entry comes from a revision
+        self.oid = oid
+
+    def __repr__(self) -> str:
+        return f"ManifestEntry({self.rel_path!r}, size={self.size})"
+
+
+# FileRecord content not read yet
+_UNREAD = object()
+
+
+class FileRecord:
+    """
+    A file of the repository, as yielded by RepoProcessor.iter_files().
+
+    Only the stat of the walk is taken up front. ``binary`` reads the first
+    block of the file, ``content`` the whole of it, normalised as in the
+    dump, and keeps it; ``tokens`` counts it when the processor counts
+    tokens. Files from a revision must be read before the iteration ends.
+    Errors reading a file are raised, not guessed at.
+    """
+
+    __slots__ = ("path", "size", "stat", "oid", "_processor", "_entry", "_binary", "_content", "_tokens")
+
+    def __init__(self, processor: "RepoProcessor", entry: ManifestEntry):
+        # Relative to the repository, '/'-separated
+        self.path = entry.rel_path.replace(os.sep, "/")
+        self.size = entry.size
+        # None for files from a revision
+        self.stat = entry.stat
+        # Git blob OID, known once the content is read or when from a revision
+        self.oid = entry.oid
+        self._processor = processor
+        self._entry = entry
+        self._binary: Optional[bool] = None
+        self._content = _UNREAD
+        self._tokens: Optional[int] = None
+
+    def _check_readable(self) -> None:
+        if self._entry.oid is not None and self._processor._cat_file is None:
+            raise ValueError(f"'{self.path}' is from a revision and can only be read during iter_files()")
+
+    @property
+    def binary(self) -> bool:
+        """
+        Whether the file looks binary, from its first block.
+
+        Raises:
+            OSError: If the file cannot be read
+            ValueError: For a file from a revision, once the iteration ended
+        """
+        if self._binary is None:
+            self._check_readable()
+            with self._processor._open_entry(self._entry) as infile:
+                self._binary = self._processor._sniff(infile) is None
+        return self._binary
+
+    @property
+    def content(self) -> Optional[str]:
+        """
+        The file's text as written to the dump; None if it is binary or could not be read.
+
+        Raises:
+            ValueError: For a file from a revision, once the iteration ended
+        """
+        if self._content is _UNREAD:
+            self._check_readable()
+            content = self._processor._read_content(self._entry)
+            self._content = None
+            if content is not None:
+                self._binary = not content
+            if content:
+                chunks, hasher = content
+                self._content = b"".join(chunks).decode("utf-8")
+                if hasher is not None:
+                    self.oid = hasher.hexdigest()
+        return self._content
+
+    @property
+    def tokens(self) -> Optional[int]:
+        """Token count of the content; None unless the processor counts tokens, or for binary files."""
+        if self._tokens is None and self._processor.count_tokens:
+            self._tokens = self._processor._record_tokens(self)
+        return self._tokens
+
+    def release(self) -> None:
+        """Drop the content read, keeping the token count."""
+        self._content = _UNREAD
+
+    def __repr__(self) -> str:
+        return f"FileRecord({self.path!r}, size={self.size})"
+
+
+def _read_batches(manifest: List[ManifestEntry]) -> Generator[List[ManifestEntry], None, None]:
+    """Split a manifest into batches of at most READ_BATCH_FILES files or about READ_BATCH_BYTES bytes."""
+    batch: List[ManifestEntry] = []
+    batch_bytes = 0
+    for entry in manifest:
+        batch.append(entry)
+        batch_bytes += entry.size
+        if len(batch) >= READ_BATCH_FILES or batch_bytes >= READ_BATCH_BYTES:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
+class DumpSection(NamedTuple):
+    """Where a file's content, or its diff, sits in a length-prefixed dump."""
+
+    path: str
+    # Byte offset and length of the content between the delimiters
+    offset: int
+    length: int
+    # "file", or "diff" for the diff written ahead of a changed file
+    kind: str
+
+
+def _delimiter_pattern(template: str):
+    """Compile a start delimiter template into a regex over its encoded line, with path and bytes groups."""
+    pattern = re.escape(template).replace(re.escape("{path}"), "(?P<path>.*)")
+    pattern = pattern.replace(re.escape("{bytes}"), r"(?P<bytes>\d+)")
+    return re.compile(pattern.encode("utf-8") + rb"\n\Z")
+
+
+def parse_length_prefixed(
+    dump,
+    start_delimiter: str = LENGTH_PREFIXED_START_DELIMITER,
+    end_delimiter: str = "--- END FILE ---",
+) -> Generator[DumpSection, None, None]:
+    """
+    Locate the sections of a length-prefixed dump by seeking from header to header.
+
+    Only delimiter lines, and the tree before the first header, are read;
+    content is skipped with a seek. Parsing time depends on the number of
+    files, not on their size, and content containing delimiter-like lines
+    cannot confuse it.
+
+    Args:
+        dump: The dump or a shard of it, opened for binary reading; must be seekable
+        start_delimiter: Start delimiter the dump was written with, with a
+            {bytes} field
+        end_delimiter: End delimiter the dump was written with
+
+    Yields:
+        DumpSection of every file and diff, in output order. Read a section's
+        content with dump.seek(section.offset) and dump.read(section.length).
+
+    Raises:
+        ValueError: If a header or end delimiter is not where the lengths say
+    """
+    if "{bytes}" not in start_delimiter:
+        raise ValueError("start_delimiter has no {bytes} field")
+    headers = (
+        (_delimiter_pattern(start_delimiter), end_delimiter, "file"),
+        (_delimiter_pattern(LENGTH_PREFIXED_DIFF_DELIMITER), DIFF_END_DELIMITER, "diff"),
+    )
+    size = dump.seek(0, os.SEEK_END)
+    position = dump.seek(0)
+    started = False
+    while position < size:
+        dump.seek(position)
+        line = dump.readline()
+        for pattern, end_template, kind in headers:
+            match = pattern.match(line)
+            if match is not None:
+                break
+        else:
+            if started:
+                raise ValueError(f"Expected a section header at offset {position}")
+            # The tree section, before the first header
+            position += len(line)
+            continue
+        started = True
+        path = match.group("path").decode("utf-8")
+        offset = position + len(line)
+        length = int(match.group("bytes"))
+        end_line = (end_template.format(path=path) + "\n").encode("utf-8")
+        if length:
+            dump.seek(offset + length - 1)
+            if dump.read(1) != b"\n":
+                # Newline added after content that does not end with one
+                end_line = b"\n" + end_line
+        else:
+            dump.seek(offset)
+        if dump.read(len(end_line)) != end_line:
+            raise ValueError(f"Section of {path} at offset {offset} does not end where its length says")
+        position = offset + length + len(end_line)
+        yield DumpSection(path, offset, length, kind)
+
+
 class RepoProcessor:
     def __init__(
         self,
@@ -118,13 +588,28 @@ class RepoProcessor:
         ignore_patterns: Optional[List[str]] = None,
         include_patterns: Optional[List[str]] = None,
         use_gitignore: bool = True,
-        start_delimiter: str = "--- FILE: {path} ---",
+        start_delimiter: str = DEFAULT_START_DELIMITER,
         end_delimiter: str = "--- END FILE ---",
         verbose: bool = True,
         dry_run: bool = False,
         max_file_size: int = 512000,  # 500KB default
         include_tree: bool = True,
         count_tokens: bool = False,
+        jobs: int = 1,
+        token_cache_path: Optional[str] = None,
+        source: str = "walk",
+        include_untracked: bool = False,
+        rev: Optional[str] = None,
+        diff: Optional[str] = None,
+        merge_base: bool = False,
+        diff_hunks: bool = False,
+        incremental: bool = False,
+        index: bool = False,
+        max_tokens: Optional[int] = None,
+        split_tokens: Optional[int] = None,
+        split_bytes: Optional[int] = None,
+        output_format: str = "text",
+        compress_threads: Optional[int] = None,
     ):
         self.repo_path = os.path.abspath(repo_path)
         self.output_file = os.path.abspath(output_file)
@@ -132,67 +617,181 @@ class RepoProcessor:
         self.include_patterns = include_patterns or []
         self.use_gitignore = use_gitignore
         self.start_delimiter = start_delimiter
+        # Headers give each block's content length: "{bytes}" in the start delimiter
+        self._length_prefixed = "{bytes}" in start_delimiter
         self.end_delimiter = end_delimiter
         self.verbose = verbose
         self.dry_run = dry_run
         self.max_file_size = max_file_size  # Max file size in bytes
         self.include_tree = include_tree
-        self.count_tokens = count_tokens
+        # Token budget for the whole output; implies counting tokens
+        self.max_tokens = max_tokens
+        # Size limit of each shard when splitting the dump into numbered files
+        self.split_tokens = split_tokens
+        self.split_bytes = split_bytes
+        if split_tokens is not None and split_bytes is not None:
+            raise ValueError("split_tokens and split_bytes cannot both be set")
+        if (split_tokens is not None or split_bytes is not None) and (incremental or index or max_tokens is not None):
+            raise ValueError("A split dump cannot be incremental, indexed or fitted to max_tokens")
+        self.shard_files: List[str] = []
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown format {output_format!r}; expected one of {', '.join(FORMATS)}")
+        if output_format != "text" and (
+            index or max_tokens is not None or split_tokens is not None or split_bytes is not None
+        ):
+            raise ValueError(f"The {output_format} format cannot be indexed, split or fitted to max_tokens")
+        if output_format == "jsonl" and incremental:
+            raise ValueError("The jsonl format cannot be incremental")
+        self.output_format = output_format
+        # Output named .gz/.xz/.bz2 is written compressed; the offsets of
+        # incremental dumps and indexes refer to uncompressed bytes
+        self.compression = compression_for(self.output_file)
+        if self.compression is not None and (incremental or index or output_format == "sqlite"):
+            raise ValueError(f"{self.compression} output cannot be incremental, indexed or an SQLite database")
+        self.count_tokens = count_tokens or max_tokens is not None or split_tokens is not None
+        # Content read while planning the budget, written as is: path -> (chunks, hasher, tokens)
+        self._planned: Optional[Dict[str, Tuple[List[bytes], object, int]]] = None
+        self.jobs = max(1, jobs)  # Reader threads; 1 reads serially
+        # Threads compressing .gz output in blocks, pigz-style; by default one per reader
+        self.compress_threads = max(1, compress_threads if compress_threads is not None else self.jobs)
+        if source not in SOURCES:
+            raise ValueError(f"Unknown source {source!r}; expected one of {', '.join(SOURCES)}")
+        # Where the file list comes from: "walk" or "index" (git ls-files)
+        self.source = source
+        self.include_untracked = include_untracked  # index source only
+        # Commit or ref to dump from the object database instead of the work tree
+        self.rev = rev
+        self._cat_file: Optional[git.CatFileBatch] = None
+        # Revision range whose added/modified files are dumped, e.g. "main..HEAD"
+        self.diff = diff
+        self.merge_base = merge_base
+        # Also write each changed file's unified diff before its content
+        self.diff_hunks = diff_hunks
+        self._patches: Dict[str, bytes] = {}
+        # Rebuild from the previous output and its sidecar manifest, re-reading
+        # only files whose stat signature changed
+        self.incremental = incremental
+        # Also write OUTPUT.index.json, mapping paths to content offsets
+        self.index = index
+        self.index_file = self.output_file + INDEX_SUFFIX
+        self.manifest_file = self.output_file + MANIFEST_SUFFIX
+        self.reused_count = 0
+        self._previous: Optional[DumpManifest] = None
+        self._previous_fd: Optional[int] = None
+        self._dump_manifest: Optional[DumpManifest] = None
+        # Manifest of the last incremental dump written, for update()
+        self._last_dump: Optional[DumpManifest] = None
+        self._last_dump_saved = True
+        # Files written by the dump itself, never part of it
+        self._generated_files = {
+            self.output_file,
+            self.output_file + TEMP_SUFFIX,
+            self.manifest_file,
+            self.manifest_file + TEMP_SUFFIX,
+            self.index_file,
+            self.index_file + TEMP_SUFFIX,
+        }
+        for suffix in SQLITE_SUFFIXES:
+            self._generated_files.update((self.output_file + suffix, self.output_file + TEMP_SUFFIX + suffix))
+        root, ext = os.path.splitext(self.output_file)
+        self._shard_pattern = re.compile(re.escape(root) + r"\.\d{3,}" + re.escape(ext) + r"\Z")
+        # File list and encoded tree of the last dump
+        self._manifest: Optional[List[ManifestEntry]] = None
+        self._tree_text: Optional[bytes] = None
+        self._positions: Dict[str, int] = {}
+        self._positions_of: Optional[List[ManifestEntry]] = None
+        # Caller's stream written instead of the output file, by process_to()
+        self._stream = None
+        self._stream_block_size = OUTPUT_BUFFER_SIZE
+        # Called between files of a process_to() dump; raises to stop it
+        self._cancel_check: Optional[Callable[[], None]] = None
         self.total_tokens = 0
+        # SQLite file caching token counts by blob OID; None disables it
+        self.token_cache_path = token_cache_path
+        self.token_cache_hits = 0
+        self.token_cache_misses = 0
+        self._token_cache: Optional[TokenCache] = None
+        # Number of .gitignore files read and compiled; each one should be
+        # parsed at most once per processor.
+        self.gitignore_parse_count = 0
+        # Compiled nested .gitignore stacks keyed by directory relative to the
+        # repo root ("" for the root itself).
+        self._gitignore_stacks: Dict[str, Tuple[Tuple[object, str], ...]] = {}
         self.spec = self._load_spec()
+        # User ignore patterns alone, for file lists that git already filtered
+        self.user_spec = None
+        if pathspec and self.ignore_patterns:
+            self.user_spec = pathspec.PathSpec.from_lines("gitwildmatch", self.ignore_patterns)
 
     def _load_spec(self):
-        """Load pathspec with support for nested .gitignore files."""
+        """Load pathspec from the root .gitignore and user ignore patterns."""
         patterns = []
-        
+
         # Load root .gitignore if it exists and gitignore is enabled
         if self.use_gitignore:
             gitignore_path = os.path.join(self.repo_path, ".gitignore")
             if os.path.exists(gitignore_path):
                 try:
-                    with open(gitignore_path, "r", encoding="utf-8") as f:
-                        patterns.extend(f.readlines())
+                    patterns.extend(self._read_gitignore(gitignore_path))
                 except Exception as e:
                     if self.verbose:
                         logger.warning(f"Could not read root .gitignore: {e}")
 
         # Add user-specified ignore patterns
         patterns.extend(self.ignore_patterns)
-        
+
         if pathspec and patterns:
             return pathspec.PathSpec.from_lines("gitwildmatch", patterns)
         return None
 
-    def _get_nested_gitignore_specs(self, directory: str) -> List:
-        """Get all pathspecs from nested .gitignore files along the path."""
-        if not self.use_gitignore:
-            return []
+    def _read_gitignore(self, gitignore_path: str) -> List[str]:
+        """Read the lines of a single .gitignore file, counting each parse."""
+        self.gitignore_parse_count += 1
+        with open(gitignore_path, "r", encoding="utf-8") as f:
+            return f.readlines()
+
+    def _get_nested_gitignore_specs(self, rel_dir: str, has_gitignore: Optional[bool] = None) -> Tuple:
+        """
+        Get the compiled nested .gitignore specs that apply inside a directory.
+
+        Stacks are cached per directory: each directory inherits its parent's
+        stack and adds its own .gitignore, which is read at most once. The root
+        .gitignore is not part of the stack since it is compiled into self.spec.
 
-        specs = []
-        # Walk up the directory tree from the given directory to repo root
-        current_path = Path(directory)
-        repo_path = Path(self.repo_path)
+        Args:
+            rel_dir: Directory relative to the repository root ("" for the root)
+            has_gitignore: Whether the directory contains a .gitignore, if the
+                caller already knows (e.g. from a directory listing)
 
-        while current_path != repo_path.parent:
-            gitignore_path = current_path / ".gitignore"
-            if gitignore_path.exists():
+        Returns:
+            Tuple of (spec, base_path) pairs, outermost first
+        """
+        if not self.use_gitignore or pathspec is None:
+            return ()
+
+        stack = self._gitignore_stacks.get(rel_dir)
+        if stack is not None:
+            return stack
+
+        if not rel_dir:
+            stack = ()
+        else:
+            stack = self._get_nested_gitignore_specs(os.path.dirname(rel_dir))
+            if has_gitignore is None:
+                has_gitignore = os.path.isfile(os.path.join(self.repo_path, rel_dir, ".gitignore"))
+            if has_gitignore:
+                gitignore_path = os.path.join(self.repo_path, rel_dir, ".gitignore")
                 try:
-                    with open(gitignore_path, "r", encoding="utf-8") as f:
-                        patterns = f.readlines()
+                    patterns = self._read_gitignore(gitignore_path)
                     if patterns:
                         spec = pathspec.PathSpec.from_lines("gitwildmatch", patterns)
-                        # Calculate relative path from repo root for proper matching
-                        rel_path_from_root = current_path.relative_to(repo_path)
-                        specs.append((spec, str(rel_path_from_root) if rel_path_from_root != Path(".") else ""))
+                        stack = stack + ((spec, rel_dir),)
                 except Exception as e:
                     if self.verbose:
-                        logger.warning(f"Could not read .gitignore in {current_path}: {e}")
+                        logger.warning(f"Could not read .gitignore in {rel_dir}: {e}")
 
-            if current_path == repo_path:
-                break
-            current_path = current_path.parent
-
-        return specs
+        self._gitignore_stacks[rel_dir] = stack
+        return stack
 
     def _matches_include(self, relative_path: str) -> bool:
         if not self.include_patterns:
@@ -202,31 +801,32 @@ class RepoProcessor:
                 return True
         return False
 
+    def _is_generated(self, abs_path: str) -> bool:
+        """Whether a path is written by the dump itself; shard names only count when splitting."""
+        if abs_path in self._generated_files:
+            return True
+        sharded = self.split_tokens is not None or self.split_bytes is not None
+        return sharded and self._shard_pattern.match(abs_path) is not None
+
     def is_ignored(self, relative_path: str, directory: str = None) -> bool:
         # Always ignore .git directory
         if relative_path == ".git" or relative_path.startswith(".git" + os.sep):
             return True
 
-        # Ignore the output file if it's within the repo path
-        if os.path.abspath(os.path.join(self.repo_path, relative_path)) == self.output_file:
+        # Ignore the output file (its sidecars and shards) if it's within the repo path
+        if self._is_generated(os.path.abspath(os.path.join(self.repo_path, relative_path))):
             return True
 
         # Check nested gitignores if in a subdirectory
         if directory and self.use_gitignore:
-            nested_specs = self._get_nested_gitignore_specs(directory)
+            nested_specs = self._get_nested_gitignore_specs(os.path.dirname(relative_path.rstrip(os.sep)))
             for spec, base_path in nested_specs:
-                # Adjust relative_path for matching against nested gitignore
-                if base_path:
-                    # For nested gitignore, we need to match relative to the gitignore's directory
-                    # If relative_path is 'subdir/secret.txt' and gitignore is in 'subdir',
-                    # then we match 'secret.txt' against the gitignore in 'subdir'
-                    if relative_path.startswith(base_path + os.sep):
-                        adjusted_path = relative_path[len(base_path) + 1:]  # Remove 'subdir/' from 'subdir/secret.txt'
-                        if spec.match_file(adjusted_path):
-                            return True
-                else:
-                    # Root gitignore - match the full relative path
-                    if spec.match_file(relative_path):
+                # For nested gitignore, we need to match relative to the gitignore's directory
+                # If relative_path is 'subdir/secret.txt' and gitignore is in 'subdir',
+                # then we match 'secret.txt' against the gitignore in 'subdir'
+                if relative_path.startswith(base_path + os.sep):
+                    adjusted_path = relative_path[len(base_path) + 1:]
+                    if spec.match_file(adjusted_path):
                         return True
 
         # Check root-level gitignore and user patterns
@@ -235,132 +835,1673 @@ class RepoProcessor:
 
         return False
 
-    def _is_binary(self, file_path: str) -> bool:
-        """Check if a file is binary by looking at the first 8KB."""
+    @staticmethod
+    def _is_binary_chunk(chunk: bytes, final: bool = True) -> bool:
+        """
+        Check whether the first block of a file looks binary.
+
+        Args:
+            chunk: Leading bytes of the file
+            final: False if the file continues past the chunk, in which case a
+                multi-byte character cut off at the end is not treated as binary
+        """
+        # Check for null bytes or high proportion of non-text characters
+        if b"\0" in chunk:
+            return True
+        # Try to decode as text - if it fails, it's likely binary
         try:
-            with open(file_path, "rb") as f:
-                # Read first 8KB to check for binary content
-                chunk = f.read(8192)
-                # Check for null bytes or high proportion of non-text characters
-                if b"\0" in chunk:
-                    return True
-                # Try to decode as text - if it fails, it's likely binary
-                try:
-                    chunk.decode('utf-8')
-                except UnicodeDecodeError:
-                    return True
-        except Exception:
+            codecs.getincrementaldecoder("utf-8")().decode(chunk, final=final)
+        except UnicodeDecodeError:
             return True
         return False
 
-    def _read_file_chunks(self, file_path: str, chunk_size: int = 8192) -> Generator[str, None, None]:
-        """Generator to read file in chunks to avoid memory issues."""
+    def _iter_content_chunks(
+        self, infile, head: bytes, chunk_size: int = READ_CHUNK_SIZE, hasher=None
+    ) -> Generator[bytes, None, None]:
+        """
+        Stream an already-open text file as UTF-8 bytes, starting with the sniffed block.
+
+        Valid UTF-8 is passed through without a decode/encode round trip; only
+        newlines are normalised to '\\n' on the raw bytes, matching a text-mode
+        read. From the first invalid sequence on, the rest of the file goes
+        through a replacement decode and is re-encoded, so the output is always
+        valid UTF-8 and identical to reading with errors='replace'. Every
+        chunk yielded ends on a character boundary.
+
+        If given, ``hasher`` is updated with the raw bytes as they are read.
+        """
+        pending = b""  # incomplete UTF-8 sequence or trailing CR held for the next chunk
+        decoder = None  # replacement decoder, once validation has failed
+        chunk = head
+        while chunk:
+            if hasher is not None:
+                hasher.update(chunk)
+            next_chunk = infile.read(chunk_size)
+            final = not next_chunk
+
+            if decoder is not None:
+                text = decoder.decode(chunk, final)
+                if text:
+                    yield text.encode("utf-8")
+                chunk = next_chunk
+                continue
+
+            data = pending + chunk if pending else chunk
+            pending = b""
+            # Hold back a trailing CR so a CRLF pair split across chunks is
+            # still collapsed into one newline
+            held = b""
+            if not final and data.endswith(b"\r"):
+                data, held = data[:-1], b"\r"
+
+            if not data.isascii():
+                try:
+                    consumed = codecs.utf_8_decode(data, "strict", final)[1]
+                except UnicodeDecodeError:
+                    decoder = io.IncrementalNewlineDecoder(
+                        codecs.getincrementaldecoder("utf-8")(errors="replace"), translate=True
+                    )
+                    text = decoder.decode(data + held, final)
+                    if text:
+                        yield text.encode("utf-8")
+                    chunk = next_chunk
+                    continue
+                data, pending = data[:consumed], data[consumed:]
+            pending += held
+
+            if b"\r" in data:
+                data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+            if data:
+                yield data
+            chunk = next_chunk
+
+    def _build_manifest(self) -> List[ManifestEntry]:
+        """
+        Collect the files to dump in a single pass over the repository.
+
+        Applies ignore, include and size rules; the tree section and the file
+        bodies are both rendered from the result. Binary detection happens when
+        the content is read, so binary files still appear in the tree.
+
+        With source="index" the file list comes from git; directories that are
+        not git working trees fall back to walking the filesystem. With a
+        revision set, files are listed from that commit's tree instead, and
+        with a diff range only the files it adds or modifies are listed.
+
+        Returns:
+            Manifest entries in output order
+        """
+        return list(self._iter_manifest())
+
+    def _iter_manifest(self) -> Iterable[ManifestEntry]:
+        """The entries of _build_manifest(); a working-tree walk yields them as it goes."""
+        if self.diff is not None:
+            return self._diff_manifest()
+
+        if self.rev is not None:
+            return self._tree_manifest(git.ls_tree(self.repo_path, self.rev))
+
+        if self.source == "index":
+            try:
+                rel_paths = git.ls_files(self.repo_path, self.include_untracked)
+            except git.GitError as e:
+                if self.verbose:
+                    logger.info(f"Not using the git index ({e}); walking the directory instead")
+            else:
+                return self._index_manifest(rel_paths)
+        return self._walk_entries()
+
+    def _walk_manifest(self, rel_root: str = "") -> List[ManifestEntry]:
+        return list(self._walk_entries(rel_root))
+
+    def _walk_entries(self, rel_root: str = "") -> Generator[ManifestEntry, None, None]:
+        """
+        Walk the working tree, or the subdirectory ``rel_root`` of it, and
+        apply .gitignore rules.
+
+        The walk uses os.scandir so directory/symlink checks come from the
+        cached entry type, and each candidate file is stat'ed exactly once.
+        Symlinks to directories are listed but not followed, as with os.walk.
+        Entries are yielded in output order as each directory is listed.
+        """
+        # Depth-first stack of (absolute path, path relative to repo root)
+        pending = [(os.path.join(self.repo_path, rel_root) if rel_root else self.repo_path, rel_root)]
+        while pending:
+            self._check_cancelled()
+            dir_path, rel_dir = pending.pop()
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                if self.verbose:
+                    logger.warning(f"Could not list {rel_dir or '.'}: {e}")
+                continue
+
+            # Compile this directory's .gitignore once; every path below
+            # it is then matched against the cached stack.
+            self._get_nested_gitignore_specs(rel_dir, any(e.name == ".gitignore" for e in entries))
+
+            subdirs = []
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+
+                if entry.is_dir(follow_symlinks=False):
+                    # The trailing separator lets directory-only patterns
+                    # such as 'build/' prune the walk.
+                    if not self.is_ignored(rel_path + os.sep, dir_path):
+                        subdirs.append((entry.path, rel_path))
+                    continue
+
+                if self.is_ignored(rel_path, dir_path):
+                    continue
+
+                if not self._matches_include(rel_path):
+                    continue
+
+                # Follows symlinks; the result is cached on the entry
+                try:
+                    st = entry.stat()
+                except OSError:
+                    if self.verbose:
+                        logger.warning(f"Could not get size for {rel_path}, skipping")
+                    continue
+
+                if not stat.S_ISREG(st.st_mode):
+                    # Symlinked directories, FIFOs, sockets, devices
+                    continue
+
+                if st.st_size > self.max_file_size:
+                    if self.verbose:
+                        logger.warning(f"Skipping {rel_path} - exceeds max size ({st.st_size} > {self.max_file_size})")
+                    continue
+
+                yield ManifestEntry(rel_path, entry.path, st.st_size, st)
+
+            # Push in reverse so directories are visited in sorted order
+            pending.extend(reversed(subdirs))
+
+    def _stat_entry(self, rel_path: str) -> Optional[ManifestEntry]:
+        """Return the manifest entry of a single working-tree file, or None if it is not dumped."""
+        file_path = os.path.join(self.repo_path, rel_path)
+        if self.is_ignored(rel_path, os.path.dirname(file_path)) or not self._matches_include(rel_path):
+            return None
         try:
-            with open(file_path, "r", encoding="utf-8", errors='replace') as f:
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    yield chunk
-        except Exception as e:
-            if self.verbose:
-                logger.error(f"Error reading file {file_path}: {e}")
-            raise
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.max_file_size:
+            return None
+        return ManifestEntry(rel_path, file_path, st.st_size, st)
 
-    def process(self) -> int:
-        processed_count = 0
-        if self.dry_run:
-            if self.verbose:
-                logger.info("Dry run mode: No files will be written.")
+    def _update_manifest(self, changed_paths: Iterable[str]) -> Optional[Set[str]]:
+        """
+        Apply changes to individual paths to the manifest of the last dump.
+
+        Modified files are updated in place. Added and removed files, and
+        directories, which are walked again, re-sort the manifest and reset the
+        tree. A changed .gitignore, or any change to the file set of the index
+        source, rebuilds the manifest from scratch.
+
+        Returns:
+            Paths of the manifest entries whose content may have changed, or
+            None if the manifest was rebuilt
+        """
+        changed = set(changed_paths)
+        if any(os.path.basename(rel_path) == ".gitignore" for rel_path in changed):
+            self._gitignore_stacks = {}
+            self.spec = self._load_spec()
+            self._manifest = self._build_manifest()
+            self._tree_text = None
+            return None
+
+        # Index of each path in the manifest, kept while the list is only modified in place
+        if self._positions_of is not self._manifest:
+            self._positions = {entry.rel_path: i for i, entry in enumerate(self._manifest)}
+            self._positions_of = self._manifest
+        positions = self._positions
+        modified = set()
+        removed = set()
+        # New entries by path; a new directory and the files in it may both be reported
+        added: Dict[str, ManifestEntry] = {}
+        for rel_path in changed:
+            full_path = os.path.join(self.repo_path, rel_path)
+            if rel_path in positions:
+                entry = self._stat_entry(rel_path)
+                if entry is None:
+                    removed.add(rel_path)
+                else:
+                    self._manifest[positions[rel_path]] = entry
+                    modified.add(rel_path)
+                continue
+            if self.source == "index":
+                # New files may or may not be tracked; ask git again
+                self._manifest = self._build_manifest()
+                self._tree_text = None
+                return None
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                # A new or moved directory; anything listed under it is stale
+                prefix = rel_path + os.sep
+                removed.update(p for p in positions if p.startswith(prefix))
+                if not self.is_ignored(prefix, os.path.dirname(full_path)):
+                    added.update((entry.rel_path, entry) for entry in self._walk_manifest(rel_path))
+            elif os.path.lexists(full_path):
+                entry = self._stat_entry(rel_path)
+                if entry is not None:
+                    added[rel_path] = entry
+            else:
+                # A deleted directory
+                prefix = rel_path + os.sep
+                removed.update(p for p in positions if p.startswith(prefix))
+
+        if removed or added:
+            kept = [entry for entry in self._manifest if entry.rel_path not in removed]
+            kept = [entry for entry in kept if entry.rel_path not in added]
+            self._manifest = sorted(kept + list(added.values()), key=lambda entry: _walk_order_key(entry.rel_path))
+            self._tree_text = None
+        return modified | removed | set(added)
+
+    def _index_manifest(self, rel_paths: List[str]) -> List[ManifestEntry]:
+        """
+        Build the manifest from paths listed by git.
+
+        Git has already applied its ignore rules, so only the user's ignore and
+        include patterns and the size limit are checked here. Entries are put in
+        the same order as the directory walk produces.
+        """
+        manifest = []
+        for rel_path in sorted(rel_paths, key=_walk_order_key):
+            if self._is_generated(os.path.join(self.repo_path, rel_path)):
+                continue
+            if self.user_spec and self.user_spec.match_file(rel_path):
+                continue
+            if not self._matches_include(rel_path):
+                continue
+
+            file_path = os.path.join(self.repo_path, rel_path)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                # Tracked but deleted from the working tree
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                # Submodules and symlinks to directories
+                continue
+            if st.st_size > self.max_file_size:
+                if self.verbose:
+                    logger.warning(f"Skipping {rel_path} - exceeds max size ({st.st_size} > {self.max_file_size})")
+                continue
+
+            manifest.append(ManifestEntry(rel_path, file_path, st.st_size, st))
+        return manifest
+
+    def _tree_manifest(self, blobs: List[Tuple[str, str, str, int]]) -> List[ManifestEntry]:
+        """
+        Build the manifest from a revision's blobs, as listed by git ls-tree.
+
+        Sizes come from git, so nothing is read from the working tree. Symlinks
+        are skipped since their target cannot be followed inside a commit.
+        """
+        manifest = []
+        for rel_path, mode, oid, size in sorted(blobs, key=lambda blob: _walk_order_key(blob[0])):
+            if mode == GIT_SYMLINK_MODE:
+                continue
+            if self.user_spec and self.user_spec.match_file(rel_path):
+                continue
+            if not self._matches_include(rel_path):
+                continue
+            if size > self.max_file_size:
+                if self.verbose:
+                    logger.warning(f"Skipping {rel_path} - exceeds max size ({size} > {self.max_file_size})")
+                continue
+            manifest.append(ManifestEntry(rel_path, None, size, oid=oid))
+        return manifest
+
+    def _diff_range(self) -> Tuple[str, Optional[str]]:
+        """
+        Resolve the diff option to a (base, head) pair of revisions.
+
+        "A..B" compares A with B (HEAD if omitted), "A...B" compares the merge
+        base of A and B with B, and a bare "A" compares A with the working tree,
+        in which case head is None. merge_base applies "A...B" semantics to the
+        other forms too.
+        """
+        spec = self.diff
+        use_merge_base = self.merge_base
+        if "..." in spec:
+            base, head = spec.split("...", 1)
+            use_merge_base = True
+        elif ".." in spec:
+            base, head = spec.split("..", 1)
+        else:
+            base, head = spec, None
+        base = base or "HEAD"
+        if head == "":
+            head = "HEAD"
+
+        git.resolve_rev(self.repo_path, base)
+        if head is not None:
+            git.resolve_rev(self.repo_path, head)
+        if use_merge_base:
+            base = git.merge_base(self.repo_path, base, head or "HEAD")
+        return base, head
+
+    def _diff_manifest(self) -> List[ManifestEntry]:
+        """
+        Build the manifest from the files added or modified in the diff range.
+
+        The new versions come from the head revision, or from the working tree
+        when the range has no head. Patches are kept for diff_hunks.
+        """
+        base, head = self._diff_range()
+        changes = git.diff_changes(self.repo_path, base, head)
+
+        self._patches = {}
+        if self.diff_hunks:
+            patches = git.diff_patches(self.repo_path, base, head)
+            for rel_path, _, _ in changes:
+                patch = patches.get(rel_path)
+                if patch is not None:
+                    # Diffs of files in other encodings must not break the output
+                    self._patches[rel_path] = patch.decode("utf-8", errors="replace").encode("utf-8")
+                elif self.verbose:
+                    logger.warning(f"No diff hunks found for '{rel_path}'; dumping the full file only")
+
+        if head is None:
+            return self._index_manifest([rel_path for rel_path, _, _ in changes])
+
+        sizes = git.blob_sizes(self.repo_path, [oid for _, _, oid in changes])
+        return self._tree_manifest([
+            (rel_path, mode, oid, sizes[oid]) for rel_path, mode, oid in changes if oid in sizes
+        ])
 
+    def _patch_parts(self, rel_path: str) -> Optional[Tuple[str, bytes, str]]:
+        """Return the delimiter line, diff and closing text of a changed file's patch section."""
+        patch = self._patches.get(rel_path)
+        if patch is None:
+            return None
+        footer = DIFF_END_DELIMITER + "\n"
+        if patch and not patch.endswith(b"\n"):
+            footer = "\n" + footer
+        template = LENGTH_PREFIXED_DIFF_DELIMITER if self._length_prefixed else DIFF_START_DELIMITER
+        return template.format(path=rel_path, bytes=len(patch)) + "\n", patch, footer
+
+    def _write_patch(self, outfile, entry: ManifestEntry, counter: Optional[TokenCounter]) -> None:
+        """Write the unified diff of a changed file ahead of its full content."""
+        parts = self._patch_parts(entry.rel_path)
+        if parts is None:
+            return
+        header, patch, footer = parts
+        outfile.write(header.encode("utf-8"))
+        outfile.write(patch)
+        outfile.write(footer.encode("utf-8"))
+        if counter is not None:
+            counter.feed(patch.decode("utf-8"))
+            counter.end_file()
+            self._count_overhead(counter, header + footer)
+
+    def _sniff(self, infile) -> Optional[bytes]:
+        """Read the first block of an open file; None if it looks binary."""
+        head = infile.read(SNIFF_SIZE)
+        if self._is_binary_chunk(head, final=len(head) < SNIFF_SIZE):
+            return None
+        return head
+
+    def _open_entry(self, entry: ManifestEntry):
+        """Open a manifest entry's content as a binary file-like object."""
+        if entry.oid is not None:
+            return self._cat_file.open(entry.oid)
+        return open(entry.abs_path, "rb")
+
+    def _blob_hasher(self, entry: ManifestEntry):
+        """
+        Return a sha1 that yields the git blob OID of the entry's content.
+
+        None if neither the token cache nor a dump manifest (incremental mode
+        or index) needs it, or the OID is already known from git.
+        """
+        if (self._token_cache is None and self._dump_manifest is None) or entry.oid is not None:
+            return None
+        return hashlib.sha1(b"blob %d\0" % entry.size)
+
+    def _write_block(
+        self,
+        outfile,
+        entry: ManifestEntry,
+        chunks: Iterable[bytes],
+        counter: Optional[TokenCounter] = None,
+        hasher=None,
+        tokens: Optional[int] = None,
+    ) -> None:
+        """
+        Write one delimited file block, streaming ``chunks`` to the output.
+
+        Only the last byte is kept for the trailing-newline fix-up. The block is
+        closed even if reading fails part way through. A start delimiter with
+        a {bytes} field needs the content's length first, so then the whole
+        file is read before anything is written. When counting tokens,
+        ``tokens`` is the content's count if already known; otherwise the
+        entry's blob OID, or ``hasher`` filled while reading, keys the
+        persistent token cache. Completed blocks are recorded in the dump
+        manifest.
+        """
+        rel_file = entry.rel_path
+        content_length = None
+        if self._length_prefixed:
+            chunks = list(chunks)
+            content_length = sum(len(chunk) for chunk in chunks)
+        offset = outfile.position
+        self._write_patch(outfile, entry, counter)
+        last_byte = b""
+        completed = False
+        start_line = self.start_delimiter.format(path=rel_file, bytes=content_length) + "\n"
+        outfile.write(start_line.encode("utf-8"))
+        self._count_overhead(counter, start_line)
+        body_offset = outfile.position
         try:
+            for chunk in chunks:
+                outfile.write(chunk)
+                last_byte = chunk[-1:]
+                if counter is not None:
+                    counter.feed(chunk.decode("utf-8"))
+            completed = True
+        finally:
+            body_length = outfile.position - body_offset
+            tail = self.end_delimiter.format(path=rel_file) + "\n"
+            if last_byte and last_byte != b"\n":
+                tail = "\n" + tail
+            outfile.write(tail.encode("utf-8"))
+            oid = None
+            if completed and (entry.oid or hasher):
+                oid = entry.oid or hasher.hexdigest()
+            cached = tokens
+            if counter is not None:
+                if cached is None and oid is not None and self._token_cache is not None:
+                    cached = self._token_cache.get(oid, counter.count_method)
+                counter.end_file(oid if cached is None else None, cached)
+                self._count_overhead(counter, tail)
+            if completed and self._dump_manifest is not None:
+                self._dump_manifest.add(
+                    entry, oid, offset, outfile.position - offset, cached,
+                    body_offset=body_offset - offset, body_length=body_length,
+                )
+
+    def _count_overhead(self, counter: Optional[TokenCounter], text: str) -> None:
+        """Count tree and delimiter text as well as content when a token budget applies."""
+        if counter is not None and (self.max_tokens is not None or self.split_tokens is not None):
+            counter.feed(text)
+            counter.end_file()
+
+    def _reusable_record(self, entry: ManifestEntry, counter: Optional[TokenCounter]) -> Optional[dict]:
+        """Return the previous dump's record of an unchanged entry, or None."""
+        if self._previous is None:
+            return None
+        return self._previous.lookup(entry, counter.count_method if counter is not None else None)
+
+    def _reuse_block(self, outfile, entry: ManifestEntry, record: dict, counter: Optional[TokenCounter]) -> bool:
+        """
+        Copy an unchanged entry's block from the previous output.
+
+        Returns:
+            False for binary entries, which are skipped as before
+        """
+        tokens = record["tokens"] if counter is not None else None
+        if record["binary"]:
+            self._dump_manifest.add(entry, record["sha"], binary=True)
+            return False
+        offset = outfile.position
+        outfile.copy_range(self._previous_fd, record["offset"], record["length"])
+        if counter is not None:
+            counter.end_file(None, tokens)
+        self._dump_manifest.add(
+            entry, record["sha"], offset, record["length"], tokens,
+            body_offset=record["body_offset"], body_length=record["body_length"],
+        )
+        self.reused_count += 1
+        return True
+
+    def _write_patched(
+        self, outfile, manifest: List[ManifestEntry], changed: Set[str], counter: Optional[TokenCounter]
+    ) -> int:
+        """
+        Write a dump in which only the ``changed`` paths may differ from the previous one.
+
+        The previous records become the new manifest, minus those of changed
+        paths, so an unchanged entry costs a dictionary lookup: entries between
+        two changed ones are copied as a run by _reuse_run(), and the changed
+        entries go through the serial writer. Only used by update(), whose
+        caller reports every change.
+        """
+        records = self._previous.files
+        for rel_path in changed:
+            records.pop(rel_path, None)
+        self._dump_manifest.files = records
+
+        processed_count = 0
+        run_start = 0
+        stops = [i for i, entry in enumerate(manifest) if entry.rel_path not in records]
+        for i in stops + [len(manifest)]:
+            processed_count += self._reuse_run(outfile, manifest[run_start:i], counter)
+            if i < len(manifest):
+                processed_count += self._write_serial(outfile, [manifest[i]], counter)
+            run_start = i + 1
+        return processed_count
+
+    def _reuse_run(self, outfile, run: List[ManifestEntry], counter: Optional[TokenCounter]) -> int:
+        """
+        Copy the blocks of consecutive unchanged entries from the previous output.
+
+        The blocks are normally contiguous there and copied with one range
+        copy; blocks of removed files in between split the copy. Offsets of the
+        records are shifted in place.
+
+        Returns:
+            Number of text files copied
+        """
+        records = self._previous.files
+        text = [record for record in (records[entry.rel_path] for entry in run) if not record["binary"]]
+        if not text:
+            return 0
+
+        start = text[0]["offset"]
+        end = text[-1]["offset"] + text[-1]["length"]
+        if sum(record["length"] for record in text) == end - start:
+            segments = [(start, end, text)]
+        else:
+            segments = []
+            for record in text:
+                if segments and segments[-1][1] == record["offset"]:
+                    segments[-1][1] += record["length"]
+                    segments[-1][2].append(record)
+                else:
+                    segments.append([record["offset"], record["offset"] + record["length"], [record]])
+
+        for start, end, segment in segments:
+            shift = outfile.position - start
+            outfile.copy_range(self._previous_fd, start, end - start)
+            if shift:
+                for record in segment:
+                    record["offset"] += shift
+        if counter is not None:
+            counter.end_file(None, sum(record["tokens"] for record in text))
+        self.reused_count += len(text)
+        return len(text)
+
+    def _record_binary(self, entry: ManifestEntry) -> None:
+        if self._dump_manifest is not None:
+            self._dump_manifest.add(entry, entry.oid, binary=True)
+
+    def _check_cancelled(self) -> None:
+        if self._cancel_check is not None:
+            self._cancel_check()
+
+    def _report_file_error(self, rel_file: str, error: Exception) -> None:
+        if not self.verbose:
+            return
+        if isinstance(error, (UnicodeDecodeError, PermissionError)):
+            logger.warning(f"Skipping '{rel_file}' - {error}")
+        else:
+            logger.error(f"Error processing '{rel_file}': {error}")
+
+    def _write_serial(self, outfile, manifest: List[ManifestEntry], counter: Optional[TokenCounter]) -> int:
+        processed_count = 0
+        for entry in manifest:
+            self._check_cancelled()
+            rel_file = entry.rel_path
+            try:
+                record = self._reusable_record(entry, counter)
+                if record is not None:
+                    if self._reuse_block(outfile, entry, record, counter):
+                        processed_count += 1
+                    continue
+
+                # Open once: the sniffed block doubles as the first chunk of content
+                with self._open_entry(entry) as infile:
+                    head = self._sniff(infile)
+                    if head is None:
+                        self._record_binary(entry)
+                        continue
+
+                    if self.dry_run:
+                        if self.verbose:
+                            logger.info(f"Would process: {rel_file}")
+                        processed_count += 1
+                        continue
+
+                    hasher = self._blob_hasher(entry)
+                    chunks = self._iter_content_chunks(infile, head, hasher=hasher)
+                    self._write_block(outfile, entry, chunks, counter, hasher)
+
+                processed_count += 1
+            except Exception as e:
+                self._report_file_error(rel_file, e)
+        return processed_count
+
+    def _load_entry(self, entry: ManifestEntry) -> Optional[Tuple[List[bytes], object]]:
+        """
+        Read and classify one file on a worker thread.
+
+        Returns:
+            None for binary files, otherwise the content chunks (empty in
+            dry-run mode) and the blob hasher when the token cache is in use
+        """
+        with self._open_entry(entry) as infile:
+            head = self._sniff(infile)
+            if head is None:
+                return None
             if self.dry_run:
-                outfile = None
-            else:
-                outfile = open(self.output_file, "w", encoding="utf-8")
+                return [], None
+            hasher = self._blob_hasher(entry)
+            return list(self._iter_content_chunks(infile, head, hasher=hasher)), hasher
+
+    def _write_parallel(self, outfile, manifest: List[ManifestEntry], counter: Optional[TokenCounter]) -> int:
+        """
+        Read files on a thread pool and write them in manifest order.
 
+        At most ``jobs * PARALLEL_WINDOW_PER_JOB`` files are in flight, so memory
+        stays below that many times ``max_file_size``. The output is identical
+        to the serial writer's. Entries reused from the previous output are
+        not read.
+        """
+        processed_count = 0
+        window = self.jobs * PARALLEL_WINDOW_PER_JOB
+        entries = iter(manifest)
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+
+            def submit(entry: ManifestEntry):
+                record = self._reusable_record(entry, counter)
+                future = pool.submit(self._load_entry, entry) if record is None else None
+                return entry, record, future
+
+            in_flight = deque(submit(entry) for entry in itertools.islice(entries, window))
             try:
-                # Write repository structure tree if requested
-                if self.include_tree and not self.dry_run:
-                    tree_structure = generate_tree_structure(self.repo_path)
-                    outfile.write(tree_structure)
-
-                # Walk through the repository
-                for root, dirs, files in os.walk(self.repo_path):
-                    rel_dir = os.path.relpath(root, self.repo_path)
-                    if rel_dir == ".":
-                        rel_dir = ""
-
-                    # Filter directories in-place
-                    dirs_to_remove = []
-                    for d in dirs:
-                        rel_d = os.path.join(rel_dir, d)
-                        if self.is_ignored(rel_d, root):
-                            dirs_to_remove.append(d)
-                    for d in dirs_to_remove:
-                        dirs.remove(d)
-
-                    for filename in sorted(files):
-                        rel_file = os.path.join(rel_dir, filename)
-
-                        if self.is_ignored(rel_file, root):
+                while in_flight:
+                    self._check_cancelled()
+                    entry, record, future = in_flight.popleft()
+                    next_entry = next(entries, None)
+                    if next_entry is not None:
+                        in_flight.append(submit(next_entry))
+
+                    rel_file = entry.rel_path
+                    try:
+                        if record is not None:
+                            if self._reuse_block(outfile, entry, record, counter):
+                                processed_count += 1
                             continue
 
-                        if not self._matches_include(rel_file):
+                        loaded = future.result()
+                        if loaded is None:
+                            self._record_binary(entry)
                             continue
 
-                        file_path = os.path.join(root, filename)
-                        
-                        # Check file size
-                        try:
-                            file_size = os.path.getsize(file_path)
-                            if file_size > self.max_file_size:
-                                if self.verbose:
-                                    logger.warning(f"Skipping {rel_file} - exceeds max size ({file_size} > {self.max_file_size})")
-                                continue
-                        except OSError:
+                        if self.dry_run:
                             if self.verbose:
-                                logger.warning(f"Could not get size for {rel_file}, skipping")
+                                logger.info(f"Would process: {rel_file}")
+                            processed_count += 1
                             continue
 
-                        try:
-                            if self._is_binary(file_path):
-                                continue
+                        chunks, hasher = loaded
+                        self._write_block(outfile, entry, chunks, counter, hasher)
+                        processed_count += 1
+                    except Exception as e:
+                        self._report_file_error(rel_file, e)
+            except BaseException:
+                # Stopped early: files not yet being read are not read
+                for _, _, future in in_flight:
+                    if future is not None:
+                        future.cancel()
+                raise
+        return processed_count
 
-                            if self.dry_run:
-                                if self.verbose:
-                                    logger.info(f"Would process: {rel_file}")
-                                processed_count += 1
-                                continue
-
-                            # Read and write file content
-                            file_content = ""
-                            for chunk in self._read_file_chunks(file_path):
-                                file_content += chunk
-
-                            # Write to output file
-                            outfile.write(self.start_delimiter.format(path=rel_file) + "\n")
-                            outfile.write(file_content)
-                            if file_content and not file_content.endswith("\n"):
-                                outfile.write("\n")
-                            outfile.write(self.end_delimiter.format(path=rel_file) + "\n")
-                            
-                            # Count tokens if requested
-                            if self.count_tokens:
-                                self.total_tokens += get_tiktoken_token_count(file_content)
-                            
-                            processed_count += 1
-                        except (UnicodeDecodeError, PermissionError) as e:
-                            if self.verbose:
-                                logger.warning(f"Skipping '{rel_file}' - {e}")
-                        except Exception as e:
-                            if self.verbose:
-                                logger.error(f"Error processing '{rel_file}': {e}")
+    def _count_segments(self, segments: List[List[str]], bound: bool = False) -> List[int]:
+        """
+        Count tokens of text segments, each fed piece by piece as the writer's counter sees it.
+
+        With ``bound``, estimates are rounded up, so the counts are an upper
+        bound of the estimate of the assembled text, for budgets and shard limits.
+        """
+        counter = TokenCounter(num_threads=max(self.jobs, TOKENIZER_THREADS), round_up=bound)
+        for i, segment in enumerate(segments):
+            for text in segment:
+                counter.feed(text)
+            counter.end_file(str(i))
+        counter.finish()
+        return [counter.file_counts[str(i)] for i in range(len(segments))]
+
+    def _tree_tokens(self, entries: Iterable[ManifestEntry]) -> int:
+        if not self.include_tree:
+            return 0
+        tree = generate_tree_structure(self.repo_path, paths=[entry.rel_path for entry in entries])
+        return self._count_segments([[tree]], bound=True)[0]
+
+    def _read_content(self, entry: ManifestEntry) -> Optional[Tuple[List[bytes], object]]:
+        """
+        Read an entry's whole content and blob hasher.
+
+        Returns:
+            (chunks, hasher); BINARY_CONTENT, an empty tuple, for a binary
+            file; None if it could not be read
+        """
+        try:
+            with self._open_entry(entry) as infile:
+                head = self._sniff(infile)
+                if head is None:
+                    return BINARY_CONTENT
+                hasher = hashlib.sha1(b"blob %d\0" % entry.size) if entry.oid is None else None
+                return list(self._iter_content_chunks(infile, head, hasher=hasher)), hasher
+        except Exception as e:
+            self._report_file_error(entry.rel_path, e)
+            return None
+
+    def _read_many(
+        self, entries: List[ManifestEntry], pool: Optional[ThreadPoolExecutor] = None
+    ) -> List[Optional[Tuple[List[bytes], object]]]:
+        """_read_content() of several entries, on ``pool`` or a new thread pool when jobs > 1."""
+        if pool is not None:
+            return list(pool.map(self._read_content, entries))
+        if self.jobs > 1 and len(entries) > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                return list(pool.map(self._read_content, entries))
+        return [self._read_content(entry) for entry in entries]
+
+    def _overhead_segments(
+        self, rel_path: str, chunks: List[bytes], label: Optional[str] = None, with_patch: bool = True
+    ) -> List[str]:
+        """
+        Return the text written around a file's content, one segment per token counter segment.
+
+        Args:
+            rel_path: The file's relative path
+            chunks: Its content
+            label: Path shown in the delimiters, if not ``rel_path``
+            with_patch: Whether the file's diff section precedes it
+        """
+        label = label or rel_path
+        tail = self.end_delimiter.format(path=label) + "\n"
+        last_byte = chunks[-1][-1:] if chunks else b""
+        if last_byte and last_byte != b"\n":
+            tail = "\n" + tail
+        start_line = self.start_delimiter.format(path=label, bytes=sum(len(chunk) for chunk in chunks)) + "\n"
+        segments = [start_line, tail]
+        parts = self._patch_parts(rel_path) if with_patch else None
+        if parts is not None:
+            segments += [parts[0] + parts[2], parts[1].decode("utf-8")]
+        return segments
+
+    def _section_costs(
+        self,
+        items: List[Tuple[List[bytes], List[str]]],
+        in_tokens: bool,
+        shas: Optional[List[Optional[str]]] = None,
+    ) -> List[Tuple[int, int]]:
+        """
+        Measure files' sections exactly, in tokens or in bytes.
+
+        Args:
+            items: Content chunks and overhead segments of each file
+            in_tokens: Count tokens, one counter segment per content and
+                overhead segment as the writer counts them; else count bytes
+            shas: Blob OIDs of the contents, to look their token counts up
+                in the token cache before encoding them
+
+        Returns:
+            The cost of each file's content and of its whole section
+        """
+        if not in_tokens:
+            result = []
+            for chunks, overhead in items:
+                content = sum(len(chunk) for chunk in chunks)
+                result.append((content, content + sum(len(text.encode("utf-8")) for text in overhead)))
+            return result
+        count_method = TokenCounter().count_method
+        # Estimates are cheap, and the cache holds whole-text ones, not rounded up for limits
+        cache = self._token_cache if shas is not None and count_method != "estimate" else None
+        shas = shas or [None] * len(items)
+        known = [cache.get(sha, count_method) if cache is not None and sha else None for sha in shas]
+        segments = []
+        for (chunks, overhead), tokens in zip(items, known):
+            if tokens is None:
+                segments.append([chunk.decode("utf-8") for chunk in chunks])
+            segments.extend([text] for text in overhead)
+        counts = iter(self._count_segments(segments, bound=True))
+        result = []
+        for (_, overhead), tokens, sha in zip(items, known, shas):
+            content = tokens
+            if content is None:
+                content = next(counts)
+                if cache is not None and sha:
+                    cache.put(sha, count_method, content)
+            result.append((content, content + sum(next(counts) for _ in overhead)))
+        return result
+
+    @staticmethod
+    def _bytes_per_token() -> int:
+        # Conservative: code averages three to four bytes per token
+        return 4 if TokenCounter().count_method == "estimate" else 3
+
+    def _section_estimates(self, manifest: List[ManifestEntry], bytes_per_token: int, tree_lines: bool) -> List[int]:
+        """Estimate the cost of each entry's section from its size, in tokens or, with one byte per token, bytes."""
+        estimates = []
+        for entry in manifest:
+            overhead = len(self.start_delimiter.format(path=entry.rel_path, bytes=entry.size)) + len(
+                self.end_delimiter.format(path=entry.rel_path)
+            ) + 3
+            if tree_lines:
+                overhead += len(entry.rel_path) + 8
+            patch = self._patches.get(entry.rel_path)
+            if patch is not None:
+                overhead += len(patch) + len(DIFF_START_DELIMITER) + len(DIFF_END_DELIMITER) + len(entry.rel_path)
+            estimates.append(-(-(entry.size + overhead) // bytes_per_token))
+        return estimates
+
+    def _plan_budget(self, manifest: List[ManifestEntry]) -> List[ManifestEntry]:
+        """
+        Choose the files that fit max_tokens, tree and delimiters included.
+
+        Files are ranked by priority score per estimated token and packed
+        greedily using size-based estimates. The chosen files are then read
+        and counted exactly, in rank order: the lowest-ranked ones are dropped
+        while the dump is over budget, and room left over is filled with the
+        next candidates. The content read here is what gets written, and
+        counted with the same counter, so the dump cannot exceed the budget
+        even if files change in the meantime.
+
+        Returns:
+            The chosen entries in manifest order
+        """
+        limit = self.max_tokens
+        bytes_per_token = self._bytes_per_token()
+
+        def estimate(length: int) -> int:
+            return -(-length // bytes_per_token)
+
+        weights = self._section_estimates(manifest, bytes_per_token, self.include_tree)
+        scores = budget.priority_scores(manifest, self.include_patterns)
+        order = budget.density_order(weights, scores)
+        chosen = budget.pack(weights, scores, limit - self._tree_tokens([]), order)
+
+        if any(entry.oid is not None for entry in manifest):
+            self._cat_file = git.CatFileBatch(self.repo_path)
+        self._token_cache = self._open_token_cache()
+        planned: Dict[int, Tuple[List[bytes], object, int]] = {}
+        # Exact tokens of each file's whole section; None for binary files
+        costs: Dict[int, Optional[int]] = {}
+
+        def measure(indices: List[int]) -> None:
+            loaded = self._read_many([manifest[i] for i in indices])
+            read = [(i, content) for i, content in zip(indices, loaded) if content]
+            measured = self._section_costs(
+                [(chunks, self._overhead_segments(manifest[i].rel_path, chunks)) for i, (chunks, _) in read], True,
+                [manifest[i].oid or (hasher and hasher.hexdigest()) for i, (_, hasher) in read],
+            )
+            for i in indices:
+                costs[i] = None
+            for (i, (chunks, hasher)), (content_tokens, cost) in zip(read, measured):
+                planned[i] = (chunks, hasher, content_tokens)
+                costs[i] = cost
+
+        try:
+            measure(chosen)
+            kept = [i for i in chosen if costs[i] is not None]
+            used = sum(costs[i] for i in kept)
+            # The tree of a selection bounds the tree of any subset of it
+            tree_bound = self._tree_tokens(manifest[i] for i in kept)
+            while kept and used + tree_bound > limit:
+                used -= costs[kept.pop()]
+
+            # Fill the room left by estimates that were too high
+            chosen_set = set(chosen)
+            misses = 0
+            for i in order:
+                if misses >= BUDGET_FILL_ATTEMPTS:
+                    break
+                room = limit - used - tree_bound
+                if i in chosen_set or weights[i] > room:
+                    continue
+                measure([i])
+                tree_line = estimate(len(manifest[i].rel_path) + 8) if self.include_tree else 0
+                if costs[i] is not None and costs[i] + tree_line <= room:
+                    kept.append(i)
+                    used += costs[i]
+                    tree_bound += tree_line
+                else:
+                    misses += 1
+
+            # Check against the exact tree, dropping the lowest-ranked files
+            while True:
+                tree_tokens = self._tree_tokens(manifest[i] for i in sorted(kept))
+                if used + tree_tokens <= limit:
+                    break
+                if not kept:
+                    raise ValueError(f"a token budget of {limit} does not fit the tree section")
+                used -= costs[kept.pop()]
+        finally:
+            if self._cat_file is not None:
+                self._cat_file.close()
+                self._cat_file = None
+            self._close_token_cache()
+
+        kept.sort()
+        self._planned = {manifest[i].rel_path: planned[i] for i in kept}
+        if self.verbose:
+            logger.info(
+                f"Token budget: {len(kept)} of {len(manifest)} files, {used + tree_tokens} of {limit} tokens"
+            )
+        return [manifest[i] for i in kept]
+
+    def _write_planned(self, outfile, manifest: List[ManifestEntry], counter: Optional[TokenCounter]) -> int:
+        """Write the content read and counted by _plan_budget()."""
+        processed_count = 0
+        for entry in manifest:
+            self._check_cancelled()
+            chunks, hasher, tokens = self._planned[entry.rel_path]
+            if self.dry_run:
+                if self.verbose:
+                    logger.info(f"Would process: {entry.rel_path}")
+            else:
+                self._write_block(outfile, entry, chunks, counter, hasher, tokens)
+            processed_count += 1
+        return processed_count
+
+    def _cut_part(self, text: str, start: int, fits) -> int:
+        """
+        Return where the longest part of ``text`` from ``start`` that ``fits`` ends.
+
+        The part ends after a newline where possible.
+
+        Raises:
+            ValueError: If not even one character fits
+        """
+        low, high = start, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(text[start:middle]):
+                low = middle
+            else:
+                high = middle - 1
+        if low == start:
+            raise ValueError("the shard size leaves no room for file content")
+        if low < len(text):
+            newline = text.rfind("\n", start, low)
+            if newline >= start and fits(text[start:newline + 1]):
+                return newline + 1
+        return low
+
+    def _write_shards(self, manifest: List[ManifestEntry], counter: Optional[TokenCounter]) -> int:
+        """
+        Write the dump as numbered shards of at most split_tokens tokens or split_bytes bytes.
+
+        Every shard starts with its header and the tree of the whole dump.
+        Files are read a batch at a time, measured exactly and placed in walk
+        order, so a shard holds neighbouring files; a new shard is started
+        early rather than splitting a directory that fits in a shard of its
+        own. Only a file larger than a whole shard is cut into parts, after a
+        newline where possible, each starting a shard.
+
+        Returns:
+            Number of text files in the dump
+
+        Raises:
+            ValueError: If the header and tree leave no room in a shard
+        """
+        by_tokens = self.split_tokens is not None
+        limit = self.split_tokens if by_tokens else self.split_bytes
+        name = os.path.basename(self.repo_path)
+        tree = self._tree_text.decode("utf-8") if self._tree_text is not None and self.include_tree else ""
+        tree_cost = self._section_costs([([], [tree])], by_tokens)[0][1] if tree else 0
+        capacities: Dict[int, int] = {}
+
+        def capacity(number: int) -> int:
+            if number not in capacities:
+                header = SHARD_HEADER.format(number=number, name=name) + "\n"
+                capacities[number] = limit - tree_cost - self._section_costs([([], [header])], by_tokens)[0][1]
+            return capacities[number]
+
+        if capacity(1) <= 0:
+            raise ValueError(f"a shard size of {limit} does not fit the shard header and tree")
+
+        # Estimated size of every directory, to keep small ones in one shard
+        estimates = self._section_estimates(manifest, self._bytes_per_token() if by_tokens else 1, tree_lines=False)
+        dir_costs: Dict[str, int] = {}
+        for entry, estimate in zip(manifest, estimates):
+            directory = os.path.dirname(entry.rel_path)
+            while directory:
+                dir_costs[directory] = dir_costs.get(directory, 0) + estimate
+                directory = os.path.dirname(directory)
+
+        shard: Optional[DumpWriter] = None
+        number = 0
+        room = 0
+        empty = True
+        previous = ""
+
+        def open_shard() -> None:
+            nonlocal shard, number, room, empty
+            if shard is not None:
+                shard.close()
+                shard = None
+            number += 1
+            path = shard_path(self.output_file, number)
+            shard = DumpWriter(open_output(path, OUTPUT_BUFFER_SIZE, self.compress_threads))
+            self.shard_files.append(path)
+            header = SHARD_HEADER.format(number=number, name=name) + "\n"
+            shard.write(header.encode("utf-8"))
+            self._count_overhead(counter, header)
+            if tree:
+                shard.write(self._tree_text)
+                self._count_overhead(counter, tree)
+            room = capacity(number)
+            empty = True
+
+        def write_parts(entry: ManifestEntry, chunks: List[bytes]) -> None:
+            nonlocal room, empty
+            text = b"".join(chunks).decode("utf-8")
+            start = 0
+            part = 0
+            while start < len(text):
+                part += 1
+                if shard is None or not empty:
+                    open_shard()
+                label = f"{entry.rel_path} (part {part})"
+
+                def measure(piece: str) -> Tuple[int, int]:
+                    piece_chunks = [piece.encode("utf-8")]
+                    overhead = self._overhead_segments(entry.rel_path, piece_chunks, label, with_patch=part == 1)
+                    return self._section_costs([(piece_chunks, overhead)], by_tokens)[0]
+
+                end = self._cut_part(text, start, lambda piece: measure(piece)[1] <= room)
+                content_cost, cost = measure(text[start:end])
+                piece = text[start:end].encode("utf-8")
+                if part == 1:
+                    self._write_patch(shard, entry, counter)
+                part_entry = ManifestEntry(label, entry.abs_path, len(piece), entry.stat)
+                self._write_block(shard, part_entry, [piece], counter, None, content_cost if by_tokens else None)
+                room -= cost
+                empty = False
+                start = end
+
+        def place(batch: List[ManifestEntry], pool: Optional[ThreadPoolExecutor]) -> int:
+            nonlocal previous, room, empty
+            loaded = self._read_many(batch, pool)
+            read = [(entry, content) for entry, content in zip(batch, loaded) if content]
+            measured = iter(self._section_costs(
+                [(chunks, self._overhead_segments(entry.rel_path, chunks)) for entry, (chunks, _) in read],
+                by_tokens,
+                [entry.oid or (hasher and hasher.hexdigest()) for entry, (_, hasher) in read],
+            ))
+            placed = 0
+            for entry, content in zip(batch, loaded):
+                entered = _entered_dirs(previous, entry.rel_path)
+                previous = entry.rel_path
+                if not content:
+                    continue
+                chunks, hasher = content
+                content_cost, cost = next(measured)
+                fresh = room if shard is not None and empty else capacity(number + 1)
+                if cost > fresh:
+                    write_parts(entry, chunks)
+                else:
+                    if shard is None or (not empty and cost > room):
+                        open_shard()
+                    elif not empty:
+                        # The outermost directory starting here that fits in a shard
+                        for directory in entered:
+                            if dir_costs[directory] <= fresh:
+                                if dir_costs[directory] > room:
+                                    open_shard()
+                                break
+                    self._write_block(shard, entry, chunks, counter, hasher, content_cost if by_tokens else None)
+                    room -= cost
+                    empty = False
+                placed += 1
+            return placed
+
+        processed_count = 0
+        pool = ThreadPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        try:
+            for batch in _read_batches(manifest):
+                processed_count += place(batch, pool)
+            if shard is None:
+                open_shard()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if shard is not None:
+                shard.close()
+
+        # Shards left over from an earlier, longer dump
+        output_dir = os.path.dirname(self.output_file)
+        for filename in os.listdir(output_dir):
+            path = os.path.join(output_dir, filename)
+            if self._shard_pattern.match(path) and path not in self.shard_files:
+                os.remove(path)
+        if self.verbose:
+            logger.info(f"Wrote {number} shards of at most {limit} {'tokens' if by_tokens else 'bytes'}")
+        return processed_count
+
+    def _write_records(self, outfile, manifest: List[ManifestEntry], counter: Optional[TokenCounter]) -> int:
+        """
+        Write one JSON object per text file, a line each, in manifest order.
+
+        Objects hold the file's path ('/'-separated), size in bytes, language,
+        token count (null unless counting tokens), git blob OID, its diff
+        when diff hunks are requested, and content. Files are read and
+        counted a batch at a time and each batch is flushed once written, so
+        readers can consume the output while it grows.
+        """
+        processed_count = 0
+        for records in self._iter_records(manifest, counter):
+            for entry, text, sha, tokens in records:
+                if text is None:
+                    continue
+                record = {
+                    "path": entry.rel_path.replace(os.sep, "/"),
+                    "size": entry.size,
+                    "language": detect_language(entry.rel_path),
+                    "tokens": tokens,
+                    "sha": sha,
+                }
+                patch = self._patches.get(entry.rel_path)
+                if patch is not None:
+                    record["diff"] = patch.decode("utf-8")
+                record["content"] = text
+                outfile.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                if counter is not None:
+                    counter.end_file(None, tokens)
+                processed_count += 1
+            outfile.flush()
+        return processed_count
+
+    def _write_database(self, manifest: List[ManifestEntry], started_ns: int) -> int:
+        """
+        Write the dump as an SQLite database with a full-text index (DumpDatabase).
+
+        In incremental mode, a database written earlier with the same
+        settings is updated in place: only files whose stat signature, or
+        blob OID, changed are read and upserted, and rows of files that are
+        gone are deleted. Otherwise a new database is built next to the
+        output and renamed over it once committed.
+
+        Returns:
+            Number of text files in the database
+        """
+        meta = {
+            "repo_path": self.repo_path,
+            "count_method": TokenCounter().count_method if self.count_tokens else "",
+            "started_ns": str(started_ns),
+        }
+        database = None
+        if self.incremental:
+            if self.diff is not None:
+                if self.verbose:
+                    logger.warning("Incremental mode is not supported with a diff range; writing a full dump")
+            else:
+                database = DumpDatabase.open_existing(self.output_file, meta)
+        target = self.output_file
+        known: Dict[str, tuple] = {}
+        previous_started_ns = 0
+        if database is not None:
+            known = database.signatures()
+            previous_started_ns = int(database.meta().get("started_ns", 0))
+        else:
+            target = self.output_file + TEMP_SUFFIX
+            if os.path.exists(target):
+                os.remove(target)
+            database = DumpDatabase(target)
+
+        def unchanged(entry: ManifestEntry, signature: tuple) -> bool:
+            size, mtime_ns, ino, sha = signature
+            if size != entry.size:
+                return False
+            if entry.oid is not None:
+                return sha == entry.oid
+            st = entry.stat
+            return (
+                st is not None and (mtime_ns, ino) == (st.st_mtime_ns, st.st_ino)
+                # Edits within the timestamp granularity of the last run may not show
+                and st.st_mtime_ns < previous_started_ns - RACY_WINDOW_NS
+            )
+
+        stale = set(known)
+        changed = []
+        for entry in manifest:
+            path = entry.rel_path.replace(os.sep, "/")
+            stale.discard(path)
+            signature = known.get(path)
+            if signature is None or not unchanged(entry, signature):
+                changed.append(entry)
+        self.reused_count = len(manifest) - len(changed)
+
+        completed = False
+        processed_count = 0
+        try:
+            if (self.rev is not None or self.diff is not None) and any(entry.oid is not None for entry in changed):
+                self._cat_file = git.CatFileBatch(self.repo_path)
+            counter = None
+            if self.count_tokens:
+                counter = TokenCounter(num_threads=max(self.jobs, TOKENIZER_THREADS))
+                self._token_cache = self._open_token_cache()
+
+            # Changed files that could not be read lose their old rows too
+            unwritten = {entry.rel_path.replace(os.sep, "/") for entry in changed if entry.rel_path.replace(os.sep, "/") in known}
+            for records in self._iter_records(changed, counter):
+                text_rows = []
+                binary_rows = []
+                for entry, text, sha, tokens in records:
+                    path = entry.rel_path.replace(os.sep, "/")
+                    unwritten.discard(path)
+                    st = entry.stat
+                    mtime_ns, ino = (st.st_mtime_ns, st.st_ino) if st is not None else (None, None)
+                    if text is None:
+                        binary_rows.append((path, entry.size, mtime_ns, ino, sha))
+                        continue
+                    patch = self._patches.get(entry.rel_path)
+                    text_rows.append((
+                        path, entry.size, mtime_ns, ino, detect_language(entry.rel_path), tokens, sha,
+                        patch.decode("utf-8") if patch is not None else None, text,
+                    ))
+                database.upsert_files(text_rows)
+                database.upsert_binary(binary_rows)
+            database.delete(stale | unwritten)
+
+            processed_count, total_tokens = database.totals()
+            if counter is not None:
+                self.total_tokens += total_tokens
+            database.commit(meta)
+            completed = True
+        finally:
+            database.close()
+            if self._cat_file is not None:
+                self._cat_file.close()
+                self._cat_file = None
+            self._close_token_cache()
+            if target != self.output_file:
+                if completed:
+                    os.replace(target, self.output_file)
+                elif os.path.exists(target):
+                    os.remove(target)
+        if self.verbose and self.incremental:
+            logger.info(f"Database: {len(changed)} files read, {len(stale)} removed")
+        return processed_count
+
+    def _iter_records(
+        self, manifest: List[ManifestEntry], counter: Optional[TokenCounter]
+    ) -> Generator[List[list], None, None]:
+        """
+        Read, hash and count the files of a manifest a batch at a time, for the record formats.
+
+        Token counts come from the token cache where possible; the rest of a
+        batch is counted together.
+
+        Yields:
+            For each batch, [entry, content, sha, tokens] lists in manifest
+            order. content is None for binary files; tokens is None for them
+            and when not counting. Unreadable files are left out.
+        """
+        pool = ThreadPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        try:
+            for batch in _read_batches(manifest):
+                self._check_cancelled()
+                records = []
+                for entry, content in zip(batch, self._read_many(batch, pool)):
+                    if content is None:
+                        continue
+                    if not content:
+                        records.append([entry, None, entry.oid, None])
+                        continue
+                    chunks, hasher = content
+                    sha = entry.oid or hasher.hexdigest()
+                    tokens = None
+                    if counter is not None and self._token_cache is not None:
+                        tokens = self._token_cache.get(sha, counter.count_method)
+                    records.append([entry, b"".join(chunks).decode("utf-8"), sha, tokens])
+
+                if counter is not None:
+                    uncounted = [record for record in records if record[1] is not None and record[3] is None]
+                    counts = self._count_segments([[record[1]] for record in uncounted])
+                    for record, tokens in zip(uncounted, counts):
+                        record[3] = tokens
+                        if self._token_cache is not None:
+                            self._token_cache.put(record[2], counter.count_method, tokens)
+                yield records
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def iter_files(self) -> Generator[FileRecord, None, None]:
+        """
+        Yield the files of the dump one at a time, as the repository is walked.
+
+        No output is written, and a record's content is only read when asked
+        for, so callers can filter, transform or tokenize files without disk
+        round trips or holding the repository in memory. The ignore, include
+        and size rules of process() apply; max_tokens, splitting and the
+        output format do not. Unlike process(), errors are raised.
+
+        Yields:
+            A FileRecord per file, binary files included, in output order
+        """
+        if self.rev is not None:
+            git.resolve_rev(self.repo_path, self.rev)
+        if self.count_tokens:
+            self._token_cache = self._open_token_cache()
+        try:
+            for entry in self._iter_manifest():
+                if entry.oid is not None and self._cat_file is None:
+                    self._cat_file = git.CatFileBatch(self.repo_path)
+                yield FileRecord(self, entry)
+        finally:
+            if self._cat_file is not None:
+                self._cat_file.close()
+                self._cat_file = None
+            self._close_token_cache()
+
+    def _record_tokens(self, record: FileRecord) -> Optional[int]:
+        """Count the tokens of a record's content, through the token cache."""
+        content = record.content
+        if content is None:
+            return None
+        count_method = TokenCounter().count_method
+        tokens = None
+        if self._token_cache is not None and record.oid is not None:
+            tokens = self._token_cache.get(record.oid, count_method)
+        if tokens is None:
+            tokens = self._count_segments([[content]])[0]
+            if self._token_cache is not None and record.oid is not None:
+                self._token_cache.put(record.oid, count_method, tokens)
+        return tokens
+
+    def _open_token_cache(self) -> Optional[TokenCache]:
+        if not self.token_cache_path:
+            return None
+        try:
+            return TokenCache(self.token_cache_path)
+        except (OSError, sqlite3.Error) as e:
+            if self.verbose:
+                logger.warning(f"Token cache disabled - could not open {self.token_cache_path}: {e}")
+            return None
+
+    def _close_token_cache(self) -> None:
+        if self._token_cache is None:
+            return
+        self.token_cache_hits += self._token_cache.hits
+        self.token_cache_misses += self._token_cache.misses
+        self._token_cache.close()
+        self._token_cache = None
+
+    def _new_dump_manifest(self, started_ns: int) -> DumpManifest:
+        return DumpManifest(
+            (self.start_delimiter, self.end_delimiter),
+            TokenCounter().count_method if self.count_tokens else None,
+            started_ns,
+        )
+
+    def _open_previous_dump(self, started_ns: int, previous: Optional[DumpManifest] = None) -> None:
+        """
+        Start an incremental dump: load the previous sidecar manifest, unless
+        one is given, and open the output it describes for copying.
+
+        The previous output is only reused if it is exactly the file the
+        manifest was written for and used the same delimiters.
+        """
+        self._dump_manifest = self._new_dump_manifest(started_ns)
+        if previous is None:
+            previous = DumpManifest.load(self.manifest_file)
+        if previous is None or previous.delimiters != self._dump_manifest.delimiters:
+            return
+        try:
+            fd = os.open(self.output_file, os.O_RDONLY)
+        except OSError:
+            return
+        st = os.fstat(fd)
+        if (st.st_size, st.st_mtime_ns) != (previous.output_size, previous.output_mtime_ns):
+            if self.verbose:
+                logger.info("Output changed since the last dump; rebuilding it in full")
+            os.close(fd)
+            return
+        self._previous = previous
+        self._previous_fd = fd
+
+    def _close_previous_dump(self) -> None:
+        if self._previous_fd is not None:
+            # Once replaced, closing the old output frees its blocks, which takes
+            # a while for a large dump; keep that off the caller's path
+            threading.Thread(target=os.close, args=(self._previous_fd,), daemon=True).start()
+            self._previous_fd = None
+        self._previous = None
+
+    def _finish_output(self, target: str, save_manifest: bool = True) -> None:
+        """Move a finished dump into place if needed and save its manifest and index."""
+        if target != self.output_file:
+            os.replace(target, self.output_file)
+        st = os.stat(self.output_file)
+        self._dump_manifest.output_size = st.st_size
+        self._dump_manifest.output_mtime_ns = st.st_mtime_ns
+        self._last_dump = self._dump_manifest
+        self._last_dump_saved = False
+        self._dump_manifest = None
+        if save_manifest:
+            self.save_manifest()
+
+    def save_manifest(self) -> None:
+        """Write the sidecar manifest and index of the last dump, if not yet saved."""
+        if self._last_dump is None or self._last_dump_saved:
+            return
+        if self.incremental:
+            self._last_dump.save(self.manifest_file)
+        if self.index:
+            write_index(self.index_file, self._last_dump, self._last_dump.output_size, self._last_dump.output_mtime_ns)
+        self._last_dump_saved = True
+
+    def _write_dump(
+        self,
+        manifest: List[ManifestEntry],
+        started_ns: int,
+        previous: Optional[DumpManifest] = None,
+        save_manifest: bool = True,
+        changed: Optional[Set[str]] = None,
+    ) -> int:
+        """
+        Write the tree and file blocks of a manifest to the output.
+
+        In incremental mode the dump is written next to the output and renamed
+        over it once complete, copying unchanged blocks from ``previous`` (by
+        default the manifest saved by the last run). If ``changed`` is given,
+        every other entry with a previous record is trusted to be unchanged
+        without comparing stat signatures.
+
+        Returns:
+            Number of text files in the dump
+        """
+        target = self.output_file
+        if self.incremental and not self.dry_run:
+            if self.diff is not None:
+                if self.verbose:
+                    logger.warning("Incremental mode is not supported with a diff range; writing a full dump")
+            else:
+                self._open_previous_dump(started_ns, previous)
+                target = self.output_file + TEMP_SUFFIX
+        if self.index and not self.dry_run and self._dump_manifest is None:
+            self._dump_manifest = self._new_dump_manifest(started_ns)
+
+        sharded = (self.split_tokens is not None or self.split_bytes is not None) and not self.dry_run
+        if self.dry_run or sharded:
+            outfile = None
+        elif self._stream is None:
+            # Binary handle: file bodies are written as raw UTF-8 bytes
+            outfile = DumpWriter(open_output(target, OUTPUT_BUFFER_SIZE, self.compress_threads))
+        else:
+            outfile = DumpWriter(StreamOutput(self._stream, self._stream_block_size))
+
+        completed = False
+        try:
+            if (self.rev is not None or self.diff is not None) and any(entry.oid is not None for entry in manifest):
+                self._cat_file = git.CatFileBatch(self.repo_path)
+
+            # Write repository structure tree if requested
+            if self.include_tree and not self.dry_run and self.output_format == "text":
+                if self._tree_text is None:
+                    self._tree_text = generate_tree_structure(
+                        self.repo_path, paths=[entry.rel_path for entry in manifest]
+                    ).encode("utf-8")
+                if outfile is not None:
+                    outfile.write(self._tree_text)
+
+            # One counter for the run: token counting is batched across files
+            counter = None
+            if self.count_tokens and not self.dry_run:
+                counter = TokenCounter(num_threads=max(self.jobs, TOKENIZER_THREADS))
+                self._token_cache = self._open_token_cache()
+                if self._tree_text is not None and self.include_tree and outfile is not None:
+                    self._count_overhead(counter, self._tree_text.decode("utf-8"))
+
+            if sharded:
+                processed_count = self._write_shards(manifest, counter)
+            elif self.output_format == "jsonl" and not self.dry_run:
+                processed_count = self._write_records(outfile, manifest, counter)
+            elif self._planned is not None:
+                processed_count = self._write_planned(outfile, manifest, counter)
+            elif changed is not None and self._previous is not None:
+                processed_count = self._write_patched(outfile, manifest, changed, counter)
+            elif self.jobs > 1:
+                processed_count = self._write_parallel(outfile, manifest, counter)
+            else:
+                processed_count = self._write_serial(outfile, manifest, counter)
+
+            if counter is not None:
+                self.total_tokens += counter.finish()
+                if self._token_cache is not None:
+                    for oid, tokens in counter.file_counts.items():
+                        self._token_cache.put(oid, counter.count_method, tokens)
+                if self._dump_manifest is not None:
+                    for record in self._dump_manifest.files.values():
+                        if record["tokens"] is None and not record["binary"]:
+                            record["tokens"] = counter.file_counts.get(record["sha"])
+            completed = True
+        finally:
+            if outfile:
+                outfile.close()
+            try:
+                if completed and self._dump_manifest is not None:
+                    self._finish_output(target, save_manifest)
+                elif not completed:
+                    self._dump_manifest = None
+                    if target != self.output_file:
+                        if os.path.exists(target):
+                            os.remove(target)
+                        if previous is not None:
+                            # Its records may have been moved and shifted already
+                            self._last_dump = None
             finally:
-                if outfile:
-                    outfile.close()
+                self._close_previous_dump()
+            if self._cat_file is not None:
+                self._cat_file.close()
+                self._cat_file = None
+            self._close_token_cache()
+        return processed_count
+
+    def process(self) -> int:
+        processed_count = 0
+        if self.dry_run:
+            if self.verbose:
+                logger.info("Dry run mode: No files will be written.")
+
+        try:
+            # Taken before any file is stat'ed, for the incremental racy check
+            started_ns = time.time_ns()
+            self._scan()
+            if self.output_format == "sqlite" and not self.dry_run:
+                processed_count = self._write_database(self._manifest, started_ns)
+            else:
+                processed_count = self._write_dump(self._manifest, started_ns)
         except Exception as e:
             logger.error(f"Fatal error: {e}")
             sys.exit(1)
 
-        return processed_count
\ No newline at end of file
+        return processed_count
+
+    def _scan(self) -> None:
+        """Build the manifest of a new dump, fitted to max_tokens if set."""
+        if self.rev is not None:
+            git.resolve_rev(self.repo_path, self.rev)
+        self._manifest = self._build_manifest()
+        self._tree_text = None
+        self._planned = None
+        self.shard_files = []
+        if self.max_tokens is not None:
+            self._manifest = self._plan_budget(self._manifest)
+
+    def process_to(
+        self, stream, block_size: Optional[int] = None, cancel_check: Optional[Callable[[], None]] = None
+    ) -> int:
+        """
+        Write the dump to an open stream instead of the output file.
+
+        The stream may be binary or text (io.TextIOBase), e.g. sys.stdout;
+        it is written in blocks of ``block_size`` bytes (by default
+        OUTPUT_BUFFER_SIZE) and flushed, but not closed. Incremental,
+        indexed, split and SQLite dumps need a file and are not supported.
+        Unlike process(), errors are raised.
+
+        Args:
+            stream: Writable file object
+            block_size: Bytes gathered before each write to the stream
+            cancel_check: Called as each directory is walked and before
+                each file is read; whatever it raises stops the dump (use
+                a BaseException to get past the per-file error handling)
+
+        Returns:
+            Number of text files in the dump
+        """
+        if (
+            self.incremental or self.index or self.output_format == "sqlite"
+            or self.split_tokens is not None or self.split_bytes is not None
+        ):
+            raise ValueError("process_to() cannot write incremental, indexed, split or SQLite dumps")
+        if self.compression is not None and self.verbose:
+            logger.warning(f"Output to a stream is not {self.compression}-compressed")
+        started_ns = time.time_ns()
+        self._cancel_check = cancel_check
+        try:
+            self._scan()
+            self._stream = stream
+            self._stream_block_size = block_size or OUTPUT_BUFFER_SIZE
+            return self._write_dump(self._manifest, started_ns)
+        finally:
+            self._stream = None
+            self._cancel_check = None
+
+    def update(self, changed_paths: Optional[Iterable[str]] = None) -> int:
+        """
+        Refresh the output of an incremental dump after files changed.
+
+        Only the given paths, relative to the repository, are examined again;
+        the rest of the manifest of the last dump is trusted as is. Blocks of
+        unchanged files are copied from the current output. None, or no
+        earlier dump by this processor, rescans the whole repository. A
+        changed .gitignore reloads the ignore rules and rescans too.
+
+        The sidecar manifest is not rewritten; call save_manifest() when
+        convenient. Unlike process(), errors are raised.
+
+        Returns:
+            Number of text files in the refreshed dump
+        """
+        if (
+            not self.incremental or self.dry_run or self.diff is not None or self.rev is not None
+            or self.output_format != "text"
+        ):
+            raise ValueError("update() requires an incremental dump of the working tree")
+        if self.max_tokens is not None:
+            raise ValueError("update() cannot keep a token budget; use process()")
+        started_ns = time.time_ns()
+        changed = None
+        if self._manifest is None or changed_paths is None:
+            self._manifest = self._build_manifest()
+            self._tree_text = None
+        else:
+            changed = self._update_manifest(changed_paths)
+        if self._last_dump is None:
+            # Signatures loaded from disk may predate changes nobody reported
+            changed = None
+        self.total_tokens = 0
+        return self._write_dump(self._manifest, started_ns, self._last_dump, save_manifest=False, changed=changed)
@@ -0,0 +1,192 @@
+"""SQLite output: a dump's files as rows, with a full-text index."""
+
+import logging
+import os
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+# Files SQLite may keep next to the database while writing it
+SQLITE_SUFFIXES = ("-journal", "-wal", "-shm")
+
+_FILE_COLUMNS = ("path", "size", "mtime_ns", "ino", "language", "tokens", "sha", "diff", "content")
+
+
+class DumpDatabase:
+    """
+    A dump written as an SQLite database.
+
+    Table ``files`` has one row per text file: path ('/'-separated), size,
+    mtime_ns, ino, language, tokens, sha (git blob OID), diff and content.
+    ``files_fts`` is an FTS5 index of path and content over it, with '_' as a
+    token character so identifiers match whole; triggers keep it in sync.
+    ``binary_files`` lists the binary files that were skipped, and ``meta``
+    the settings of the dump.
+
+    A new database is filled with batched inserts and its full-text index is
+    built once, at the end. An existing one is updated in place: changed
+    rows are upserted and removed ones deleted. Either way everything happens
+    in one transaction, made durable by commit().
+    """
+
+    def __init__(self, path: str, create: bool = True):
+        self.path = path
+        self.created = create
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        if create:
+            # A new database is written under a temporary name and renamed
+            # once committed, so it needs no rollback journal
+            self._conn.execute("PRAGMA journal_mode = OFF")
+            self._conn.execute("PRAGMA synchronous = OFF")
+            self._create_schema()
+        self.fts = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'files_fts'"
+        ).fetchone() is not None
+        self._conn.execute("BEGIN")
+
+    def _create_schema(self) -> None:
+        self._conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute(
+            "CREATE TABLE files ("
+            " id INTEGER PRIMARY KEY,"
+            " path TEXT NOT NULL UNIQUE,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER,"
+            " ino INTEGER,"
+            " language TEXT,"
+            " tokens INTEGER,"
+            " sha TEXT,"
+            " diff TEXT,"
+            " content TEXT NOT NULL"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE binary_files ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER,"
+            " ino INTEGER,"
+            " sha TEXT"
+            ") WITHOUT ROWID"
+        )
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE files_fts USING fts5("
+                " path, content, content='files', content_rowid='id', tokenize=\"unicode61 tokenchars '_'\")"
+            )
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Full-text index disabled - SQLite has no FTS5: {e}")
+
+    def _create_triggers(self) -> None:
+        self._conn.execute(
+            "CREATE TRIGGER files_ai AFTER INSERT ON files BEGIN"
+            " INSERT INTO files_fts (rowid, path, content) VALUES (new.id, new.path, new.content);"
+            " END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER files_ad AFTER DELETE ON files BEGIN"
+            " INSERT INTO files_fts (files_fts, rowid, path, content) VALUES ('delete', old.id, old.path, old.content);"
+            " END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER files_au AFTER UPDATE ON files BEGIN"
+            " INSERT INTO files_fts (files_fts, rowid, path, content) VALUES ('delete', old.id, old.path, old.content);"
+            " INSERT INTO files_fts (rowid, path, content) VALUES (new.id, new.path, new.content);"
+            " END"
+        )
+
+    @classmethod
+    def open_existing(cls, path: str, meta: Dict[str, str]) -> Optional["DumpDatabase"]:
+        """
+        Open a database written earlier for updating.
+
+        Returns:
+            None if it is missing, unreadable, of another schema version or
+            was written with other settings (``meta`` values other than
+            started_ns)
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            database = cls(path, create=False)
+        except sqlite3.Error:
+            return None
+        try:
+            stored = database.meta()
+        except sqlite3.Error:
+            stored = {}
+        if stored.get("version") != str(SCHEMA_VERSION) or any(
+            stored.get(key) != value for key, value in meta.items() if key != "started_ns"
+        ):
+            database.close()
+            return None
+        return database
+
+    def meta(self) -> Dict[str, str]:
+        return dict(self._conn.execute("SELECT key, value FROM meta"))
+
+    def signatures(self) -> Dict[str, Tuple[int, Optional[int], Optional[int], Optional[str]]]:
+        """(size, mtime_ns, ino, sha) of every text and binary file, by path."""
+        signatures = {}
+        for table in ("files", "binary_files"):
+            for path, size, mtime_ns, ino, sha in self._conn.execute(
+                f"SELECT path, size, mtime_ns, ino, sha FROM {table}"
+            ):
+                signatures[path] = (size, mtime_ns, ino, sha)
+        return signatures
+
+    def upsert_files(self, rows: List[tuple]) -> None:
+        """Insert or update text files, given as tuples in _FILE_COLUMNS order."""
+        self._conn.executemany("DELETE FROM binary_files WHERE path = ?", [(row[0],) for row in rows])
+        # An UPDATE, then an INSERT of the rows not there yet, rather than
+        # INSERT ... ON CONFLICT, which needs SQLite 3.24, or INSERT OR
+        # REPLACE, whose implicit delete bypasses the full-text index triggers
+        self._conn.executemany(
+            f"UPDATE files SET {', '.join(f'{column} = ?' for column in _FILE_COLUMNS[1:])} WHERE path = ?",
+            [row[1:] + row[:1] for row in rows],
+        )
+        self._conn.executemany(
+            f"INSERT INTO files ({', '.join(_FILE_COLUMNS)}) SELECT {', '.join('?' * len(_FILE_COLUMNS))}"
+            f" WHERE NOT EXISTS (SELECT 1 FROM files WHERE path = ?)",
+            [row + row[:1] for row in rows],
+        )
+
+    def upsert_binary(self, rows: List[Tuple[str, int, Optional[int], Optional[int], Optional[str]]]) -> None:
+        """Insert or update binary files, as (path, size, mtime_ns, ino, sha)."""
+        self._conn.executemany("DELETE FROM files WHERE path = ?", [(row[0],) for row in rows])
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO binary_files (path, size, mtime_ns, ino, sha) VALUES (?, ?, ?, ?, ?)", rows
+        )
+
+    def delete(self, paths: Iterable[str]) -> None:
+        """Remove files that are no longer part of the dump."""
+        rows = [(path,) for path in paths]
+        self._conn.executemany("DELETE FROM files WHERE path = ?", rows)
+        self._conn.executemany("DELETE FROM binary_files WHERE path = ?", rows)
+
+    def totals(self) -> Tuple[int, int]:
+        """Number of text files and their total tokens."""
+        count, tokens = self._conn.execute("SELECT COUNT(*), TOTAL(tokens) FROM files").fetchone()
+        return count, int(tokens)
+
+    def commit(self, meta: Dict[str, str]) -> None:
+        """Build the full-text index of a new database, record ``meta`` and commit."""
+        if self.created and self.fts:
+            self._conn.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+            self._create_triggers()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [("version", str(SCHEMA_VERSION))] + list(meta.items()),
+        )
+        self._conn.execute("COMMIT")
+
+    def close(self) -> None:
+        """Close the database, rolling back anything not committed."""
+        if self._conn is None:
+            return
+        if self._conn.in_transaction:
+            self._conn.execute("ROLLBACK")
+        self._conn.close()
+        self._conn = None
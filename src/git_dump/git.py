@@ -0,0 +1,312 @@
+"""Thin wrappers around git plumbing commands used by git_dump."""
+
+import codecs
+import os
+import subprocess
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# Tree entry mode of submodules
+GITLINK_MODE = b"160000"
+
+
+class GitError(Exception):
+    """Raised when git is unavailable or a git command fails."""
+
+
+def run_git(repo_path: str, *args: str) -> bytes:
+    """
+    Run a git command in ``repo_path`` and return its stdout.
+
+    Raises:
+        GitError: If git is not installed or exits with a non-zero status
+    """
+    try:
+        result = subprocess.run(
+            ["git", "-C", repo_path, *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+    except OSError as e:
+        raise GitError(f"could not run git: {e}") from e
+    if result.returncode != 0:
+        message = result.stderr.decode("utf-8", errors="replace").strip()
+        raise GitError(f"git {args[0]} failed: {message}")
+    return result.stdout
+
+
+def split_z(output: bytes) -> List[str]:
+    """Split NUL-terminated git output into paths using the native separator."""
+    paths = []
+    for raw in output.split(b"\0"):
+        if raw:
+            path = os.fsdecode(raw)
+            paths.append(path.replace("/", os.sep) if os.sep != "/" else path)
+    return paths
+
+
+def ls_files(repo_path: str, include_untracked: bool = False) -> List[str]:
+    """
+    List files git tracks under ``repo_path``, relative to it.
+
+    Args:
+        repo_path: Directory inside a git working tree
+        include_untracked: Also list untracked files that are not ignored by
+            .gitignore, .git/info/exclude or core.excludesFile
+
+    Returns:
+        Unique relative paths in index order
+    """
+    args = ["ls-files", "-z", "--cached"]
+    if include_untracked:
+        args += ["--others", "--exclude-standard"]
+    # Unmerged paths are listed once per stage
+    return list(dict.fromkeys(split_z(run_git(repo_path, *args))))
+
+
+def resolve_rev(repo_path: str, rev: str) -> str:
+    """Return the tree OID a revision points to, raising GitError if it is invalid."""
+    try:
+        return run_git(repo_path, "rev-parse", "--verify", "--quiet", f"{rev}^{{tree}}").decode().strip()
+    except GitError as e:
+        raise GitError(f"unknown revision {rev!r}") from e
+
+
+def ls_tree(repo_path: str, rev: str) -> List[Tuple[str, str, str, int]]:
+    """
+    List every blob reachable from a revision's tree, recursively.
+
+    Paths are relative to ``repo_path`` when it is a subdirectory of the work
+    tree, as with ls-files.
+
+    Returns:
+        (path, mode, oid, size) tuples in tree order; submodules are omitted
+    """
+    entries = []
+    for record in run_git(repo_path, "ls-tree", "-r", "-z", "-l", rev).split(b"\0"):
+        if not record:
+            continue
+        meta, raw_path = record.split(b"\t", 1)
+        mode, obj_type, oid, size = meta.split()
+        if obj_type != b"blob":
+            continue
+        path = os.fsdecode(raw_path)
+        if os.sep != "/":
+            path = path.replace("/", os.sep)
+        entries.append((path, mode.decode(), oid.decode(), int(size)))
+    return entries
+
+
+class CatFileBatch:
+    """
+    A long-lived ``git cat-file --batch`` process serving blob contents.
+
+    One process serves every blob of a dump, so there is no fork per file.
+    Blobs are streamed: open() returns a reader over the pipe, and the next
+    blob can only be requested once that reader is closed. Readers may be
+    opened from several threads; they are served one at a time.
+    """
+
+    def __init__(self, repo_path: str):
+        try:
+            self._proc = subprocess.Popen(
+                ["git", "-C", repo_path, "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        except OSError as e:
+            raise GitError(f"could not run git: {e}") from e
+        self._lock = threading.Lock()
+
+    def open(self, oid: str) -> "BlobReader":
+        """Request a blob and return a reader over its content."""
+        self._lock.acquire()
+        try:
+            self._proc.stdin.write(oid.encode("ascii") + b"\n")
+            self._proc.stdin.flush()
+            # "<oid> <type> <size>" or "<oid> missing"
+            header = self._proc.stdout.readline().split()
+            if len(header) != 3:
+                raise GitError(f"object {oid} is missing")
+            return BlobReader(self, int(header[2]))
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def close(self) -> None:
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.stdout.close()
+            self._proc.wait()
+
+    def __enter__(self) -> "CatFileBatch":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class BlobReader:
+    """Binary reader over one blob in a CatFileBatch stream."""
+
+    def __init__(self, batch: CatFileBatch, size: int):
+        self.size = size
+        self._batch = batch
+        self._remaining = size
+
+    def read(self, n: int = -1) -> bytes:
+        if self._batch is None:
+            raise ValueError("read from closed blob")
+        if n is None or n < 0 or n > self._remaining:
+            n = self._remaining
+        data = self._batch._proc.stdout.read(n) if n else b""
+        self._remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        """Skip any unread content so the stream is ready for the next blob."""
+        if self._batch is None:
+            return
+        try:
+            stdout = self._batch._proc.stdout
+            while self._remaining:
+                skipped = len(stdout.read(min(self._remaining, 1 << 16)))
+                if not skipped:
+                    break
+                self._remaining -= skipped
+            stdout.read(1)  # newline terminating the object
+        finally:
+            self._batch._lock.release()
+            self._batch = None
+
+    def __enter__(self) -> "BlobReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def merge_base(repo_path: str, rev_a: str, rev_b: str) -> str:
+    """Return the best common ancestor of two revisions."""
+    return run_git(repo_path, "merge-base", rev_a, rev_b).decode().strip()
+
+
+def _diff_args(base: str, head: Optional[str]) -> List[str]:
+    # Added, modified and type-changed files; renames show up as additions.
+    # --relative limits the diff to the current directory, with paths
+    # relative to it, as ls-files and ls-tree list them.
+    args = ["--no-renames", "--relative", "--diff-filter=AMT", base]
+    if head is not None:
+        args.append(head)
+    return args
+
+
+def diff_changes(repo_path: str, base: str, head: Optional[str] = None) -> List[Tuple[str, str, str]]:
+    """
+    List files added or modified between two revisions with one ``git diff`` call.
+
+    Args:
+        repo_path: Directory inside a git working tree
+        base: Revision to compare from
+        head: Revision to compare to; None compares against the working tree
+
+    Returns:
+        (path, new mode, new blob OID) tuples in path order, relative to
+        ``repo_path`` and limited to files under it. The OID is all
+        zeros for working-tree content that is not in the object database.
+        Submodules are omitted.
+    """
+    fields = run_git(repo_path, "diff", "--raw", "-z", "--no-abbrev", *_diff_args(base, head)).split(b"\0")
+    changes = []
+    # Records are ":<old mode> <new mode> <old oid> <new oid> <status>" NUL "<path>" NUL
+    for meta, raw_path in zip(fields[0::2], fields[1::2]):
+        if not meta.startswith(b":"):
+            continue
+        _, new_mode, _, new_oid, _ = meta[1:].split()
+        if new_mode == GITLINK_MODE:
+            continue
+        path = os.fsdecode(raw_path)
+        if os.sep != "/":
+            path = path.replace("/", os.sep)
+        changes.append((path, new_mode.decode(), new_oid.decode()))
+    return changes
+
+
+def diff_patches(repo_path: str, base: str, head: Optional[str] = None) -> Dict[str, bytes]:
+    """
+    Return the unified diff of each file listed by diff_changes(), by path.
+
+    Patches are split on their ``diff --git`` headers and keyed by the path
+    in them. A type change (e.g. a file replaced by a symlink) gets two
+    sections, which are joined. Submodule sections are left out, as
+    diff_changes() leaves out submodules.
+    """
+    output = run_git(
+        repo_path, "diff", "--no-color", "--no-ext-diff", "--src-prefix=a/", "--dst-prefix=b/",
+        *_diff_args(base, head),
+    )
+    sections = []
+    for line in output.splitlines(keepends=True):
+        if line.startswith(b"diff --git "):
+            sections.append([])
+        if sections:
+            sections[-1].append(line)
+
+    patches: Dict[str, bytes] = {}
+    for lines in sections:
+        if _is_gitlink_section(lines):
+            continue
+        path = _patch_path(lines[0])
+        patches[path] = patches.get(path, b"") + b"".join(lines)
+    return patches
+
+
+def _patch_path(header: bytes) -> str:
+    """Return the path of a ``diff --git a/<path> b/<path>`` header; both paths are equal without renames."""
+    names = header[len(b"diff --git "):].rstrip(b"\n")
+    # "a/<path> b/<path>": the first half, less its prefix
+    name = names[:(len(names) - 1) // 2]
+    if name.startswith(b'"'):
+        # C-style quoted, for paths with special characters
+        name = codecs.escape_decode(name[1:-1])[0]
+    path = os.fsdecode(name[2:])
+    if os.sep != "/":
+        path = path.replace("/", os.sep)
+    return path
+
+
+def _is_gitlink_section(lines: List[bytes]) -> bool:
+    """Whether a patch section is a submodule's, by the modes in its extended header."""
+    for line in lines[1:]:
+        if line.startswith((b"--- ", b"@@", b"Binary files ")):
+            break
+        if line.startswith((b"new file mode ", b"deleted file mode ", b"new mode ", b"index ")):
+            if line.rstrip().endswith(b" " + GITLINK_MODE):
+                return True
+    return False
+
+
+def blob_sizes(repo_path: str, oids: List[str]) -> Dict[str, int]:
+    """Look up the sizes of many objects with one ``git cat-file --batch-check`` call."""
+    if not oids:
+        return {}
+    try:
+        result = subprocess.run(
+            ["git", "-C", repo_path, "cat-file", "--batch-check"],
+            input="".join(oid + "\n" for oid in oids).encode("ascii"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+    except OSError as e:
+        raise GitError(f"could not run git: {e}") from e
+    if result.returncode != 0:
+        raise GitError(f"git cat-file failed: {result.stderr.decode('utf-8', errors='replace').strip()}")
+    sizes = {}
+    # "<oid> <type> <size>" or "<oid> missing"
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            sizes[parts[0].decode()] = int(parts[2])
+    return sizes
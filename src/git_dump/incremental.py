@@ -0,0 +1,127 @@
+"""Sidecar manifests that let a dump be rebuilt from its previous output."""
+
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+MANIFEST_VERSION = 2
+# Appended to the output path to name the sidecar manifest
+MANIFEST_SUFFIX = ".manifest.json"
+# Appended to the output path while an incremental dump is being written
+TEMP_SUFFIX = ".tmp"
+# Files modified this close to the start of a dump are re-read next time, since
+# a later edit within the file system's timestamp granularity would leave
+# their stat signature unchanged
+RACY_WINDOW_NS = 2_000_000_000
+
+
+class DumpManifest:
+    """
+    Where each file's block sits in a dump, and the file state it was built from.
+
+    Records are keyed by relative path and hold the stat signature (size,
+    mtime_ns, inode), the git blob OID of the content ("sha"), the byte offset
+    and length of the block in the output, where the content starts and ends
+    within the block, and its token count. Binary files are recorded too, so
+    an unchanged one is skipped without being opened.
+    """
+
+    def __init__(self, delimiters: Tuple[str, str], count_method: Optional[str] = None, started_ns: int = 0):
+        self.delimiters = tuple(delimiters)
+        # Encoding the token counts were made with; None if tokens were not counted
+        self.count_method = count_method
+        # time.time_ns() when the dump began
+        self.started_ns = started_ns
+        # Stat of the output the manifest describes
+        self.output_size: Optional[int] = None
+        self.output_mtime_ns: Optional[int] = None
+        self.files: Dict[str, dict] = {}
+
+    def add(
+        self,
+        entry,
+        sha: Optional[str],
+        offset: Optional[int] = None,
+        length: Optional[int] = None,
+        tokens: Optional[int] = None,
+        binary: bool = False,
+        body_offset: Optional[int] = None,
+        body_length: Optional[int] = None,
+    ) -> dict:
+        """
+        Record a manifest entry's block; offsets and lengths are None for binary files.
+
+        ``body_offset`` is relative to the start of the block.
+        """
+        st = entry.stat
+        record = {
+            "size": entry.size,
+            "mtime_ns": st.st_mtime_ns if st is not None else None,
+            "ino": st.st_ino if st is not None else None,
+            "sha": sha,
+            "offset": offset,
+            "length": length,
+            "tokens": tokens,
+            "binary": binary,
+            "body_offset": body_offset,
+            "body_length": body_length,
+        }
+        self.files[entry.rel_path] = record
+        return record
+
+    def lookup(self, entry, count_method: Optional[str] = None) -> Optional[dict]:
+        """
+        Return the record of an entry whose content is unchanged, or None.
+
+        Entries from the object database match on their blob OID; working-tree
+        files match on their stat signature. When ``count_method`` is set, a
+        text file's record only matches if it holds a count of that method.
+        """
+        record = self.files.get(entry.rel_path)
+        if record is None or record["size"] != entry.size:
+            return None
+        if entry.oid is not None:
+            if record["sha"] != entry.oid:
+                return None
+        else:
+            st = entry.stat
+            if st is None or record["mtime_ns"] != st.st_mtime_ns or record["ino"] != st.st_ino:
+                return None
+            if st.st_mtime_ns >= self.started_ns - RACY_WINDOW_NS:
+                return None
+        if count_method is not None and not record["binary"]:
+            if record["tokens"] is None or self.count_method != count_method:
+                return None
+        return record
+
+    def save(self, path: str) -> None:
+        """Write the manifest atomically."""
+        data = {
+            "version": MANIFEST_VERSION,
+            "delimiters": list(self.delimiters),
+            "count_method": self.count_method,
+            "started_ns": self.started_ns,
+            "output_size": self.output_size,
+            "output_mtime_ns": self.output_mtime_ns,
+            "files": self.files,
+        }
+        temp_path = path + TEMP_SUFFIX
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["DumpManifest"]:
+        """Read a manifest; None if it is missing, unreadable or from another version."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != MANIFEST_VERSION:
+                return None
+            manifest = cls(tuple(data["delimiters"]), data["count_method"], data["started_ns"])
+            manifest.output_size = data["output_size"]
+            manifest.output_mtime_ns = data["output_mtime_ns"]
+            manifest.files = data["files"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return manifest
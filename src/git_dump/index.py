@@ -0,0 +1,133 @@
+"""Offset index of a dump, for reading single files without scanning the output."""
+
+import json
+import mmap
+import os
+from typing import Dict, Iterator, NamedTuple, Optional
+
+from .incremental import TEMP_SUFFIX
+
+INDEX_VERSION = 1
+# Appended to the output path to name the index
+INDEX_SUFFIX = ".index.json"
+
+
+class IndexEntry(NamedTuple):
+    """Where a file's content sits in a dump."""
+
+    # Byte offset and length of the content between the delimiters, without
+    # the newline added when the file does not end with one
+    offset: int
+    length: int
+    # Token count, if tokens were counted
+    tokens: Optional[int]
+    # Git blob OID of the file
+    sha: Optional[str]
+
+
+def write_index(path: str, manifest, output_size: int, output_mtime_ns: int) -> None:
+    """
+    Write the index of a dump atomically.
+
+    Args:
+        path: Index file to write
+        manifest: DumpManifest describing the dump
+        output_size: Size of the dump the index is for
+        output_mtime_ns: Modification time of that dump
+    """
+    files = []
+    for rel_path, record in manifest.files.items():
+        if record["binary"]:
+            continue
+        files.append((
+            record["offset"] + record["body_offset"],
+            record["body_length"],
+            record["tokens"],
+            record["sha"],
+            rel_path.replace(os.sep, "/"),
+        ))
+    files.sort()
+    data = {
+        "version": INDEX_VERSION,
+        "output_size": output_size,
+        "output_mtime_ns": output_mtime_ns,
+        # [path, offset, length, tokens, sha] in output order
+        "files": [[rel_path, offset, length, tokens, sha] for offset, length, tokens, sha, rel_path in files],
+    }
+    temp_path = path + TEMP_SUFFIX
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+class DumpReader:
+    """
+    Random access to the files of a dump through its index.
+
+    The dump is memory-mapped and read() returns a memoryview over a file's
+    content, found with one dictionary lookup and without copying. Paths use
+    '/' separators. Views must be released before the reader is closed.
+
+    Raises:
+        ValueError: If the index is missing, of another version, or does not
+            match the dump (e.g. the dump was rewritten without an index)
+    """
+
+    def __init__(self, output_path: str, index_path: Optional[str] = None):
+        self.output_path = output_path
+        self.index_path = index_path or output_path + INDEX_SUFFIX
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Could not read index {self.index_path}: {e}") from e
+        if data.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version in {self.index_path}")
+
+        self._entries: Dict[str, IndexEntry] = {
+            rel_path: IndexEntry(offset, length, tokens, sha)
+            for rel_path, offset, length, tokens, sha in data["files"]
+        }
+        with open(output_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if (st.st_size, st.st_mtime_ns) != (data["output_size"], data["output_mtime_ns"]):
+                raise ValueError(f"Index {self.index_path} does not match {output_path}")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b"")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        """Paths in output order."""
+        return iter(self._entries)
+
+    def __contains__(self, rel_path: str) -> bool:
+        return rel_path in self._entries
+
+    def entry(self, rel_path: str) -> IndexEntry:
+        """Return the index entry of a file, raising KeyError if it is not in the dump."""
+        return self._entries[rel_path]
+
+    def read(self, rel_path: str) -> memoryview:
+        """Return a file's content as a zero-copy view into the dump."""
+        entry = self._entries[rel_path]
+        return self._view[entry.offset:entry.offset + entry.length]
+
+    def read_text(self, rel_path: str) -> str:
+        """Return a file's content decoded from UTF-8."""
+        with self.read(rel_path) as view:
+            return str(view, "utf-8")
+
+    def close(self) -> None:
+        if self._mmap is None:
+            return
+        self._view.release()
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self) -> "DumpReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
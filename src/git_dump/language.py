@@ -0,0 +1,42 @@
+"""Guessing the language of a file from its name."""
+
+import os
+from typing import Optional
+
+# Lower-case identifiers, as used to tag Markdown code blocks
+EXTENSION_LANGUAGES = {
+    ".py": "python", ".pyi": "python", ".pyx": "cython", ".ipynb": "json",
+    ".js": "javascript", ".mjs": "javascript", ".cjs": "javascript", ".jsx": "jsx",
+    ".ts": "typescript", ".mts": "typescript", ".cts": "typescript", ".tsx": "tsx",
+    ".java": "java", ".kt": "kotlin", ".kts": "kotlin", ".scala": "scala", ".groovy": "groovy",
+    ".c": "c", ".h": "c", ".cc": "cpp", ".cpp": "cpp", ".cxx": "cpp", ".hh": "cpp", ".hpp": "cpp",
+    ".hxx": "cpp", ".m": "objective-c", ".mm": "objective-cpp", ".cs": "csharp", ".fs": "fsharp",
+    ".go": "go", ".rs": "rust", ".swift": "swift", ".zig": "zig", ".dart": "dart",
+    ".rb": "ruby", ".php": "php", ".pl": "perl", ".pm": "perl", ".lua": "lua", ".r": "r",
+    ".jl": "julia", ".ex": "elixir", ".exs": "elixir", ".erl": "erlang", ".hs": "haskell",
+    ".ml": "ocaml", ".mli": "ocaml", ".clj": "clojure", ".elm": "elm", ".nim": "nim",
+    ".sh": "bash", ".bash": "bash", ".zsh": "zsh", ".fish": "fish", ".ps1": "powershell",
+    ".bat": "batch", ".cmd": "batch",
+    ".html": "html", ".htm": "html", ".css": "css", ".scss": "scss", ".sass": "sass",
+    ".less": "less", ".vue": "vue", ".svelte": "svelte",
+    ".json": "json", ".jsonl": "json", ".yaml": "yaml", ".yml": "yaml", ".toml": "toml",
+    ".ini": "ini", ".cfg": "ini", ".xml": "xml", ".csv": "csv", ".sql": "sql",
+    ".graphql": "graphql", ".proto": "protobuf", ".tf": "hcl", ".hcl": "hcl",
+    ".md": "markdown", ".markdown": "markdown", ".rst": "rst", ".tex": "latex", ".txt": "text",
+    ".cmake": "cmake", ".gradle": "groovy", ".mk": "makefile",
+}
+
+FILENAME_LANGUAGES = {
+    "Makefile": "makefile", "GNUmakefile": "makefile", "Dockerfile": "dockerfile",
+    "CMakeLists.txt": "cmake", "Gemfile": "ruby", "Rakefile": "ruby", "Jenkinsfile": "groovy",
+    ".gitignore": "gitignore", ".dockerignore": "gitignore",
+}
+
+
+def detect_language(rel_path: str) -> Optional[str]:
+    """Return the language of a file from its name or extension, or None if unknown."""
+    name = os.path.basename(rel_path)
+    language = FILENAME_LANGUAGES.get(name)
+    if language is not None:
+        return language
+    return EXTENSION_LANGUAGES.get(os.path.splitext(name)[1].lower())
@@ -0,0 +1,284 @@
+"""Output handles for git_dump."""
+
+import bz2
+import codecs
+import collections
+import gzip
+import io
+import lzma
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# Output suffixes written compressed, and the compression used
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".xz": "xz", ".bz2": "bz2"}
+
+GZIP_LEVEL = 6  # As gzip and pigz default to
+GZIP_BLOCK_SIZE = 128 * 1024  # Input compressed per task in parallel mode, as in pigz
+GZIP_WINDOW = 32 * 1024  # Deflate back-references reach this far
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, length: int) -> None:
+    """
+    Append ``length`` bytes at ``offset`` of one file to another, in the kernel where possible.
+
+    Uses os.copy_file_range, then os.sendfile, and falls back to pread/write
+    when neither is available or the file systems refuse them.
+    """
+    while length > 0:
+        copied = _kernel_copy(src_fd, dst_fd, offset, length)
+        if copied is None:
+            break
+        if copied == 0:
+            raise OSError(f"unexpected end of file copying {length} bytes at offset {offset}")
+        offset += copied
+        length -= copied
+
+    while length > 0:
+        data = os.pread(src_fd, min(length, 1 << 20), offset)
+        if not data:
+            raise OSError(f"unexpected end of file copying {length} bytes at offset {offset}")
+        view = memoryview(data)
+        while view:
+            written = os.write(dst_fd, view)
+            view = view[written:]
+        offset += len(data)
+        length -= len(data)
+
+
+def _kernel_copy(src_fd: int, dst_fd: int, offset: int, length: int):
+    """One copy_file_range/sendfile call; None if neither can be used."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            return os.copy_file_range(src_fd, dst_fd, length, offset)
+        except OSError:
+            pass
+    if hasattr(os, "sendfile"):
+        try:
+            return os.sendfile(dst_fd, src_fd, offset, length)
+        except OSError:
+            pass
+    return None
+
+
+class DumpWriter:
+    """
+    Binary output for a dump that tracks its position and splices in byte
+    ranges of another file.
+
+    Consecutive ranges that are contiguous in the source are merged and
+    copied with a single copy_range() call before the next regular write.
+    """
+
+    def __init__(self, outfile):
+        self._file = outfile
+        self.position = 0
+        # Pending (fd, offset, length) range to copy
+        self._copy = None
+
+    def write(self, data: bytes) -> None:
+        if self._copy is not None:
+            self._flush_copy()
+        self._file.write(data)
+        self.position += len(data)
+
+    def copy_range(self, src_fd: int, offset: int, length: int) -> None:
+        """Append a byte range of an open file to the output."""
+        if self._copy is not None:
+            fd, pending_offset, pending_length = self._copy
+            if fd == src_fd and pending_offset + pending_length == offset:
+                self._copy = (fd, pending_offset, pending_length + length)
+                self.position += length
+                return
+            self._flush_copy()
+        self._copy = (src_fd, offset, length)
+        self.position += length
+
+    def flush(self) -> None:
+        """Push everything written so far to the file."""
+        if self._copy is not None:
+            self._flush_copy()
+        self._file.flush()
+
+    def _flush_copy(self) -> None:
+        src_fd, offset, length = self._copy
+        self._copy = None
+        self._file.flush()
+        copy_range(src_fd, self._file.fileno(), offset, length)
+
+    def close(self) -> None:
+        try:
+            if self._copy is not None:
+                self._flush_copy()
+        finally:
+            self._file.close()
+
+
+class StreamOutput:
+    """
+    Binary output over a stream opened by the caller, written in large blocks.
+
+    Accepts binary writables and text ones (io.TextIOBase): UTF-8 text
+    streams with an underlying buffer, like sys.stdout usually is, get the
+    bytes directly; others are given decoded text. Writes are gathered
+    into blocks of ``block_size`` bytes; flush() and close() push what is
+    left and flush the stream, which is never closed.
+    """
+
+    def __init__(self, stream, block_size: int):
+        self._decoder = None
+        if isinstance(stream, io.TextIOBase):
+            buffer = getattr(stream, "buffer", None)
+            encoding = getattr(stream, "encoding", None)
+            if buffer is not None and encoding and codecs.lookup(encoding).name == "utf-8":
+                # Text written earlier must come out first
+                stream.flush()
+                stream = buffer
+            else:
+                self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._stream = stream
+        self._block_size = block_size
+        self._buffer = bytearray()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= self._block_size:
+            self._write_buffer()
+        return len(data)
+
+    def _write_buffer(self) -> None:
+        block = bytes(self._buffer)
+        self._buffer.clear()
+        if self._decoder is not None:
+            self._stream.write(self._decoder.decode(block))
+            return
+        written = self._stream.write(block)
+        # Raw streams may write only part of a block
+        while written is not None and written < len(block):
+            block = block[written:]
+            written = self._stream.write(block)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._write_buffer()
+        if hasattr(self._stream, "flush"):
+            self._stream.flush()
+
+    def close(self) -> None:
+        self.flush()
+
+
+def compression_for(path: str) -> Optional[str]:
+    """Return the compression implied by a file's suffix ("gzip", "xz" or "bz2"), or None."""
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+def open_output(path: str, buffering: int = -1, compress_threads: int = 1):
+    """
+    Open a dump file for binary writing, compressed as its suffix implies.
+
+    Args:
+        path: Output path; .gz, .xz and .bz2 are written compressed
+        buffering: Buffer size of the underlying file
+        compress_threads: Threads compressing .gz output in blocks
+            (ParallelGzipFile); 1 writes a plain gzip stream
+
+    Returns:
+        A writable binary file object
+    """
+    compression = compression_for(path)
+    if compression == "gzip":
+        if compress_threads > 1:
+            return ParallelGzipFile(open(path, "wb", buffering=buffering), compress_threads)
+        return gzip.GzipFile(path, "wb", compresslevel=GZIP_LEVEL, mtime=0)
+    if compression == "xz":
+        return lzma.open(path, "wb")
+    if compression == "bz2":
+        return bz2.open(path, "wb")
+    return open(path, "wb", buffering=buffering)
+
+
+def _deflate_block(block: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    """Raw-deflate one block of a ParallelGzipFile, primed with the data before it."""
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile:
+    """
+    Write-only gzip file whose blocks are compressed on a thread pool, like pigz.
+
+    Input is cut into GZIP_BLOCK_SIZE blocks, each deflated on its own with
+    the 32 KiB before it as preset dictionary and ended on a byte boundary
+    by a sync flush, so the compressed blocks join into one deflate stream:
+    the result is a regular single-member gzip file. zlib releases the GIL
+    while compressing. At most two blocks per thread are in flight; writes
+    wait for the oldest one beyond that.
+    """
+
+    def __init__(self, fileobj, threads: int, level: int = GZIP_LEVEL, block_size: int = GZIP_BLOCK_SIZE):
+        self._file = fileobj
+        self._level = level
+        self._block_size = block_size
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="git-dump-gzip")
+        self._max_pending = 2 * threads
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._dictionary = b""
+        self._crc = 0
+        self._size = 0
+        # No file name, no modification time, unknown OS
+        self._file.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", 0) + b"\x00\xff")
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= self._block_size:
+            view = memoryview(self._buffer)
+            start = 0
+            while len(self._buffer) - start >= self._block_size:
+                self._submit(bytes(view[start:start + self._block_size]), last=False)
+                start += self._block_size
+            view.release()
+            del self._buffer[:start]
+        return len(data)
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(self._pool.submit(_deflate_block, block, self._dictionary, self._level, last))
+        self._dictionary = (self._dictionary + block)[-GZIP_WINDOW:]
+        while len(self._pending) > self._max_pending:
+            self._file.write(self._pending.popleft().result())
+
+    def _drain(self) -> None:
+        while self._pending:
+            self._file.write(self._pending.popleft().result())
+
+    def flush(self) -> None:
+        """Compress and write out everything written so far."""
+        if self._buffer:
+            self._submit(bytes(self._buffer), last=False)
+            self._buffer.clear()
+        self._drain()
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer.clear()
+            self._drain()
+            self._file.write(struct.pack("<II", self._crc, self._size & 0xFFFFFFFF))
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._pool.shutdown()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,275 @@
+"""
+A long-running dump server (git-dump-serve) that keeps repositories warm.
+
+Each repository and set of options a client asks for gets an incremental
+RepoProcessor writing to the server's cache directory. It keeps the compiled
+ignore rules, the file manifest, and the content hashes and token counts of
+the last dump in memory. An inotify watcher collects the paths changed
+between requests, so a repeat request reads only those files and copies the
+rest of the dump; where inotify is unavailable, a stat scan finds them
+instead. The least recently used repositories are dropped beyond
+``max_repos``.
+
+Protocol, over a Unix stream socket: the client sends one JSON line,
+{"repo": path, "options": {...}}; the server answers with one JSON line,
+{"files", "tokens", "reused", "size"} or {"error"}, followed by ``size``
+bytes of dump.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from typing import Optional, Set, Tuple
+
+from .cache import default_cache_dir, default_token_cache_path
+from .client import default_socket_path
+from .core import RepoProcessor
+from .watch import InotifyWatcher
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_REPOS = 8
+# RepoProcessor options a client may set
+CLIENT_OPTIONS = (
+    "ignore_patterns", "include_patterns", "use_gitignore", "start_delimiter", "end_delimiter",
+    "max_file_size", "include_tree", "count_tokens", "source", "include_untracked",
+)
+
+
+class _CachedDump:
+    """The incremental dump of one repository with one set of options."""
+
+    def __init__(self, repo_path: str, options: dict, output_file: str, jobs: int):
+        token_cache_path = default_token_cache_path() if options.get("count_tokens") else None
+        self.processor = RepoProcessor(
+            repo_path, output_file, verbose=False, incremental=True, jobs=jobs,
+            token_cache_path=token_cache_path, **options,
+        )
+        # Held while refreshing, and while the output is opened for a reply
+        self.lock = threading.Lock()
+        self.watcher: Optional[InotifyWatcher] = None
+        self.files = 0
+        # Evicted from the server's cache
+        self.closed = False
+
+    def _changed_paths(self) -> Optional[Set[str]]:
+        """Paths changed since the last refresh, by inotify; None to rescan with stat checks."""
+        if self.watcher is None:
+            return None
+        changed: Set[str] = set()
+        while True:
+            more = self.watcher.read(0)
+            if more is None:
+                return None
+            if not more:
+                return changed
+            changed |= more
+
+    def refresh(self) -> Tuple[int, int, Optional[int], int]:
+        """
+        Bring the dump up to date and open it.
+
+        Returns:
+            (file descriptor of the output, size, tokens, files reused)
+        """
+        if self.processor._last_dump is None:
+            # Watch first, so edits made during the first dump are not missed
+            if self.watcher is None:
+                try:
+                    self.watcher = InotifyWatcher(self.processor)
+                except OSError as e:
+                    logger.info(f"Checking {self.processor.repo_path} by stat scans ({e})")
+            changed = None
+        else:
+            changed = self._changed_paths()
+        if changed is None or changed:
+            # Counted up by each dump
+            self.processor.reused_count = 0
+            self.files = self.processor.update(changed)
+            if self.watcher is not None and (
+                changed is None or any(os.path.basename(path) == ".gitignore" for path in changed)
+            ):
+                self.watcher.reset()
+        # The output is replaced, never rewritten, so the descriptor stays valid after the lock is released
+        fd = os.open(self.processor.output_file, os.O_RDONLY)
+        tokens = self.processor.total_tokens if self.processor.count_tokens else None
+        reused = self.processor.reused_count if changed is None or changed else self.files
+        return fd, os.fstat(fd).st_size, tokens, reused
+
+    def close(self, remove: bool = True) -> None:
+        self.closed = True
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        if remove:
+            for path in (self.processor.output_file, self.processor.manifest_file):
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            self.processor.save_manifest()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        fd = None
+        try:
+            request = json.loads(self.rfile.readline())
+            fd, size, tokens, reused, files = self.server.open_dump(request["repo"], request.get("options") or {})
+        except Exception as e:
+            self.wfile.write(json.dumps({"error": str(e)}).encode("utf-8") + b"\n")
+            return
+        try:
+            header = {"files": files, "tokens": tokens, "reused": reused, "size": size}
+            self.wfile.write(json.dumps(header).encode("utf-8") + b"\n")
+            self.wfile.flush()
+            with os.fdopen(fd, "rb") as dump:
+                fd = None
+                self.connection.sendfile(dump, 0, size)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+
+class DumpServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serve dumps over a Unix socket from LRU-bounded, per-repository caches.
+
+    Requests run on their own threads; requests for the same repository and
+    options take turns refreshing it, then send the output with sendfile().
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: str,
+        max_repos: int = DEFAULT_MAX_REPOS,
+        jobs: int = 1,
+        cache_dir: Optional[str] = None,
+    ):
+        self.max_repos = max(1, max_repos)
+        self.jobs = jobs
+        # Outputs and sidecar manifests of the cached dumps
+        self.cache_dir = cache_dir or os.path.join(default_cache_dir(), "serve")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._dumps: "collections.OrderedDict[str, _CachedDump]" = collections.OrderedDict()
+        self._dumps_lock = threading.Lock()
+        _remove_stale_socket(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+
+    def server_bind(self) -> None:
+        # Owner only, from the start: clients can have any path the server reads dumped
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+    def open_dump(self, repo_path: str, options: dict) -> Tuple[int, int, Optional[int], int, int]:
+        """
+        Refresh the cached dump of a repository and open it.
+
+        Returns:
+            (file descriptor, size, tokens, files reused, files in the dump)
+
+        Raises:
+            ValueError: For a missing repository or options clients may not set
+        """
+        unknown = set(options) - set(CLIENT_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unsupported options: {', '.join(sorted(unknown))}")
+        repo_path = os.path.realpath(repo_path)
+        if not os.path.isdir(repo_path):
+            raise ValueError(f"Path '{repo_path}' is not a directory")
+        key = hashlib.sha1(json.dumps([repo_path, options], sort_keys=True).encode("utf-8")).hexdigest()[:20]
+
+        while True:
+            evicted = []
+            with self._dumps_lock:
+                dump = self._dumps.get(key)
+                if dump is None:
+                    output_file = os.path.join(self.cache_dir, key + ".txt")
+                    dump = self._dumps[key] = _CachedDump(repo_path, options, output_file, self.jobs)
+                self._dumps.move_to_end(key)
+                while len(self._dumps) > self.max_repos:
+                    evicted.append(self._dumps.popitem(last=False)[1])
+            for old in evicted:
+                with old.lock:
+                    old.close()
+
+            with dump.lock:
+                # Evicted while this request waited for it: start again
+                if not dump.closed:
+                    fd, size, tokens, reused = dump.refresh()
+                    return fd, size, tokens, reused, dump.files
+
+    def server_close(self) -> None:
+        super().server_close()
+        with self._dumps_lock:
+            dumps, self._dumps = list(self._dumps.values()), collections.OrderedDict()
+        for dump in dumps:
+            with dump.lock:
+                # Kept for a warm start next time
+                dump.close(remove=False)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+    """Remove a socket left by a server that is gone; raise if one still listens on it."""
+    if not os.path.exists(socket_path):
+        os.makedirs(os.path.dirname(socket_path) or ".", mode=0o700, exist_ok=True)
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        os.remove(socket_path)
+    else:
+        raise OSError(f"A git-dump server is already listening on {socket_path}")
+    finally:
+        probe.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="git-dump-serve", description="Serve repository dumps from warm caches over a Unix socket."
+    )
+    parser.add_argument("--socket", default=default_socket_path(), help="Socket to listen on (default: %(default)s)")
+    parser.add_argument(
+        "--max-repos", type=int, default=DEFAULT_MAX_REPOS,
+        help=f"Repositories (with distinct options) kept warm (default: {DEFAULT_MAX_REPOS})"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of threads reading files concurrently (default: 1)"
+    )
+    parser.add_argument("-q", "--quiet", action="store_false", dest="verbose", help="Quiet mode")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(levelname)s: %(message)s')
+    try:
+        server = DumpServer(args.socket, args.max_repos, args.jobs)
+    except OSError as e:
+        print(f"Error: {e}")
+        raise SystemExit(1)
+    if args.verbose:
+        print(f"Serving dumps on {args.socket} (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
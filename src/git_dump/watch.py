@@ -0,0 +1,282 @@
+"""Keep a dump up to date while files in the repository change."""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+from typing import Callable, Dict, Optional, Set
+
+from .core import RepoProcessor
+
+logger = logging.getLogger(__name__)
+
+# Quiet period that ends a burst of events, and the longest a burst may delay a refresh
+DEBOUNCE_SECONDS = 0.025
+MAX_DEBOUNCE_SECONDS = 0.5
+# Interval between scans when inotify is unavailable
+POLL_INTERVAL_SECONDS = 1.0
+# Idle time after a refresh before the sidecar manifest is written
+MANIFEST_SAVE_DELAY_SECONDS = 2.0
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Report changed paths under a repository using Linux inotify through ctypes.
+
+    Every directory that is not ignored gets a watch; directories created
+    later are added as their events arrive. read() returns None when the
+    kernel queue overflowed and the whole tree must be rescanned.
+
+    Raises:
+        OSError: If inotify is not available on this system
+    """
+
+    # Events arrive in bursts that are merged before refreshing
+    debounce = True
+
+    def __init__(self, processor: RepoProcessor):
+        self.processor = processor
+        libc_name = ctypes.util.find_library("c")
+        try:
+            self._libc = ctypes.CDLL(libc_name, use_errno=True)
+            init1 = self._libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, f"inotify is not available: {e}") from e
+        init1.restype = ctypes.c_int
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc.inotify_add_watch.restype = ctypes.c_int
+        self._fd = init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+        # Watch descriptor -> directory relative to the repository ("" for the root)
+        self._dirs: Dict[int, str] = {}
+        self.add_tree("")
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def _add_watch(self, rel_dir: str) -> None:
+        path = os.path.join(self.processor.repo_path, rel_dir) if rel_dir else self.processor.repo_path
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logger.warning("inotify watch limit reached; raise fs.inotify.max_user_watches")
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                logger.warning(f"Could not watch {rel_dir or '.'}: {os.strerror(err)}")
+            return
+        self._dirs[wd] = rel_dir
+
+    def add_tree(self, rel_root: str) -> None:
+        """Watch a directory and every non-ignored directory below it."""
+        pending = [rel_root]
+        while pending:
+            rel_dir = pending.pop()
+            self._add_watch(rel_dir)
+            dir_path = os.path.join(self.processor.repo_path, rel_dir)
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        if not entry.is_dir(follow_symlinks=False):
+                            continue
+                        rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                        if not self.processor.is_ignored(rel_path + os.sep, dir_path):
+                            pending.append(rel_path)
+            except OSError:
+                continue
+
+    def reset(self) -> None:
+        """Drop every watch and watch the tree again, e.g. after ignore rules changed."""
+        for wd in list(self._dirs):
+            self._libc.inotify_rm_watch(self._fd, wd)
+        self._dirs = {}
+        self.add_tree("")
+
+    def read(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        """
+        Wait up to ``timeout`` seconds for events and return the paths they touch.
+
+        Returns:
+            Relative paths of changed files and directories (empty on timeout),
+            or None if events were lost
+        """
+        changed: Set[str] = set()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return changed
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            rel_dir = self._dirs.get(wd)
+            if rel_dir is None or not name:
+                continue
+            rel_path = os.path.join(rel_dir, name) if rel_dir else name
+            if mask & IN_ISDIR:
+                if self.processor.is_ignored(rel_path + os.sep, rel_dir or "."):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(rel_path)
+            elif self.processor.is_ignored(rel_path, rel_dir or "."):
+                continue
+            changed.add(rel_path)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """
+    Report changed paths by rescanning the repository at a fixed interval.
+
+    Each scan lists and stats every file once, as a normal dump does, and
+    compares the result with the manifest of the last dump.
+    """
+
+    # Each scan already covers a whole interval
+    debounce = False
+
+    def __init__(self, processor: RepoProcessor, interval: float = POLL_INTERVAL_SECONDS):
+        self.processor = processor
+        self.interval = interval
+
+    def read(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        if self.processor._manifest is None:
+            return None
+        previous = {entry.rel_path: entry.stat for entry in self.processor._manifest}
+        changed = set()
+        for entry in self.processor._build_manifest():
+            old = previous.pop(entry.rel_path, None)
+            if old is None or (old.st_size, old.st_mtime_ns, old.st_ino) != (
+                entry.stat.st_size, entry.stat.st_mtime_ns, entry.stat.st_ino
+            ):
+                changed.add(entry.rel_path)
+        changed.update(previous)
+        return changed
+
+    def reset(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def open_watcher(processor: RepoProcessor, poll_interval: float = POLL_INTERVAL_SECONDS):
+    """Return an InotifyWatcher, or a PollingWatcher where inotify is unavailable."""
+    try:
+        return InotifyWatcher(processor)
+    except OSError as e:
+        if processor.verbose:
+            logger.info(f"Watching by polling every {poll_interval:g}s ({e})")
+        return PollingWatcher(processor, poll_interval)
+
+
+def _collect(watcher, timeout: Optional[float]) -> Optional[Set[str]]:
+    """Wait for a burst of events and merge them until it goes quiet."""
+    changed = watcher.read(timeout)
+    if not changed or not watcher.debounce:
+        return changed
+    deadline = time.monotonic() + MAX_DEBOUNCE_SECONDS
+    while time.monotonic() < deadline:
+        more = watcher.read(DEBOUNCE_SECONDS)
+        if more is None:
+            return None
+        if not more:
+            break
+        changed |= more
+    return changed
+
+
+def watch(
+    processor: RepoProcessor,
+    poll_interval: float = POLL_INTERVAL_SECONDS,
+    on_refresh: Optional[Callable[[int, float], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> None:
+    """
+    Dump the repository, then refresh the output whenever files change.
+
+    Refreshes go through RepoProcessor.update(), so only changed files are
+    read and the rest of the output is copied. The sidecar manifest is saved
+    once the repository has been quiet for a moment, and on exit.
+
+    Args:
+        processor: An incremental processor of the working tree
+        poll_interval: Seconds between scans when inotify is unavailable
+        on_refresh: Called with the file count and elapsed seconds after
+            every refresh
+        should_stop: Checked between events; watching ends when it returns True
+    """
+    # Watch first, so edits made during the initial dump are not missed
+    watcher = open_watcher(processor, poll_interval)
+    try:
+        processor.update()
+        while should_stop is None or not should_stop():
+            timeout = MANIFEST_SAVE_DELAY_SECONDS if not processor._last_dump_saved else POLL_INTERVAL_SECONDS
+            changed = _collect(watcher, timeout)
+            if changed is not None and not changed:
+                processor.save_manifest()
+                continue
+
+            started = time.monotonic()
+            try:
+                count = processor.update(changed)
+            except Exception as e:
+                logger.error(f"Could not refresh {processor.output_file}: {e}")
+                continue
+            finally:
+                # Directories may have become ignored or visible under new rules
+                if changed is None or any(os.path.basename(p) == ".gitignore" for p in changed):
+                    watcher.reset()
+            elapsed = time.monotonic() - started
+            if processor.verbose:
+                logger.info(f"Refreshed {len(changed) if changed is not None else 'all'} paths in {elapsed * 1000:.0f} ms")
+            if on_refresh is not None:
+                on_refresh(count, elapsed)
+    finally:
+        watcher.close()
+        processor.save_manifest()
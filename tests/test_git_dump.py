@@ -1,8 +1,17 @@
+import hashlib
+import io
 import os
 import shutil
+import socket
+import subprocess
+import sys
 import tempfile
+import tracemalloc
+import types
 import pytest
-from src.git_dump.core import RepoProcessor, generate_tree_structure
+from src.git_dump import core
+from src.git_dump.cache import TokenCache
+from src.git_dump.core import RepoProcessor, generate_tree_structure, get_tiktoken_token_count
 
 
 class TestRepoProcessor:
@@ -89,6 +98,1038 @@ class TestRepoProcessor:
             assert ".gitignore" in content  # Root .gitignore file itself is included
             assert "subdir/.gitignore" in content  # Nested .gitignore file itself is included
 
+    def test_nested_gitignore_parsed_once(self):
+        self.create_file(".gitignore", "*.log")
+        self.create_file("a/.gitignore", "secret.txt")
+        self.create_file("a/b/.gitignore", "*.tmp")
+        for i in range(5):
+            self.create_file(f"a/b/file{i}.txt", "data")
+            self.create_file(f"a/b/file{i}.tmp", "scratch")
+        self.create_file("a/b/secret.txt", "secret data")
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False)
+        count = processor.process()
+
+        # 3 .gitignore files + 5 .txt files survive the nested rules
+        assert count == 8
+        assert processor.gitignore_parse_count == 3
+
+    @pytest.mark.skipif(not hasattr(os, "symlink") or os.name == "nt", reason="requires symlinks")
+    def test_symlinks(self):
+        self.create_file("real/file.txt", "real content")
+        os.symlink(os.path.join(self.test_dir, "real"), os.path.join(self.test_dir, "linked_dir"))
+        os.symlink(os.path.join(self.test_dir, "real", "file.txt"), os.path.join(self.test_dir, "link.txt"))
+        os.symlink(os.path.join(self.test_dir, "missing"), os.path.join(self.test_dir, "dangling.txt"))
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False)
+        count = processor.process()
+
+        # Symlinked files are followed, symlinked directories are not
+        assert count == 2
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            content = f.read()
+            assert "--- FILE: link.txt ---" in content
+            assert "linked_dir" not in content
+            assert "dangling.txt" not in content
+
+    def test_binary_files_skipped(self):
+        with open(os.path.join(self.test_dir, "image.png"), "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR")
+        self.create_file("main.py", "print('hello')")
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False)
+        count = processor.process()
+
+        assert count == 1
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            assert "image.png" not in f.read()
+
+    def test_multibyte_character_across_sniff_block(self):
+        # A 3-byte character straddles the end of the first 8KB block
+        content = "a" * 8191 + "\u20ac" + "b" * 10000
+        self.create_file("euro.txt", content)
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False)
+        count = processor.process()
+
+        assert count == 1
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            assert content in f.read()
+
+    def test_content_matches_text_mode_read(self):
+        # CRLF split across the sniff block, lone CRs, and invalid UTF-8 after
+        # the first block must all come out as a text-mode read would produce.
+        raw = b"x" * 8191 + b"\r\n" + "caf\u00e9\r\n".encode("utf-8") * 5000 + b"bad \xff\xfe byte\rend"
+        with open(os.path.join(self.test_dir, "mixed.txt"), "wb") as f:
+            f.write(raw)
+        with open(os.path.join(self.test_dir, "mixed.txt"), "r", encoding="utf-8", errors="replace") as f:
+            expected = f.read()
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False)
+        processor.process()
+
+        with open(self.output_file, "rb") as f:
+            output = f.read()
+        assert output == (
+            "--- FILE: mixed.txt ---\n" + expected + "\n--- END FILE ---\n"
+        ).encode("utf-8")
+
+    def test_large_file_streams_with_bounded_memory(self):
+        line = "x" * 99 + "\n"
+        with open(os.path.join(self.test_dir, "big.txt"), "w", encoding="utf-8") as f:
+            for _ in range(200000):  # ~20MB
+                f.write(line)
+
+        processor = RepoProcessor(
+            self.test_dir, self.output_file, include_tree=False, max_file_size=10**9, count_tokens=True
+        )
+        tracemalloc.start()
+        try:
+            count = processor.process()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        assert count == 1
+        assert peak < 4 * 1024 * 1024
+        assert os.path.getsize(self.output_file) > 20000000
+        assert processor.total_tokens > 0
+
+    def test_token_count(self):
+        self.create_file("main.py", "print('hello world')\n" * 10)
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False, count_tokens=True)
+        processor.process()
+
+        assert processor.total_tokens == get_tiktoken_token_count("print('hello world')\n" * 10)
+
+    def test_parallel_output_matches_serial(self):
+        for i in range(60):
+            self.create_file(f"pkg{i % 4}/mod{i}.py", f"value = {i}\n" * (i * 50))
+        with open(os.path.join(self.test_dir, "pkg0", "blob.bin"), "wb") as f:
+            f.write(b"\0" * 100)
+
+        outputs = []
+        for jobs in (1, 4):
+            output_file = os.path.join(self.test_dir, f"out{jobs}.txt")
+            processor = RepoProcessor(
+                self.test_dir, output_file, jobs=jobs, count_tokens=True, ignore_patterns=["out*.txt"]
+            )
+            count = processor.process()
+            with open(output_file, "rb") as f:
+                outputs.append((count, processor.total_tokens, f.read()))
+
+        assert outputs[0][0] == 60
+        assert outputs[0] == outputs[1]
+
+    def test_token_counting_uses_cached_batch_encoder(self, monkeypatch):
+        calls = {"get_encoding": 0, "batch": 0}
+
+        class FakeEncoding:
+            def encode_ordinary(self, text):
+                return text.split()
+
+            def encode_ordinary_batch(self, texts, num_threads=8):
+                calls["batch"] += 1
+                return [text.split() for text in texts]
+
+        def get_encoding(name):
+            calls["get_encoding"] += 1
+            return FakeEncoding()
+
+        monkeypatch.setitem(sys.modules, "tiktoken", types.SimpleNamespace(get_encoding=get_encoding))
+        monkeypatch.setattr(core, "_ENCODERS", {})
+        for i in range(20):
+            self.create_file(f"file{i}.txt", "one two three\n")
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False, count_tokens=True)
+        processor.process()
+
+        assert processor.total_tokens == 60
+        assert calls == {"get_encoding": 1, "batch": 1}
+
+    def test_persistent_token_cache(self):
+        cache_path = os.path.join(tempfile.mkdtemp(), "tokens.sqlite3")
+        try:
+            self.create_file("a.py", "print('hello world')\n" * 10)
+            self.create_file("b.py", "x = 1\n")
+
+            results = []
+            for _ in range(2):
+                processor = RepoProcessor(
+                    self.test_dir, self.output_file, include_tree=False,
+                    count_tokens=True, token_cache_path=cache_path,
+                )
+                processor.process()
+                results.append((processor.total_tokens, processor.token_cache_hits, processor.token_cache_misses))
+
+            assert results[0][1:] == (0, 2)
+            assert results[1][1:] == (2, 0)
+            assert results[0][0] == results[1][0] > 0
+
+            # Entries are keyed by git blob OID
+            with TokenCache(cache_path) as cache:
+                oid = hashlib.sha1(b"blob 6\0x = 1\n").hexdigest()
+                assert cache.get(oid, core.TokenCounter().count_method) is not None
+        finally:
+            shutil.rmtree(os.path.dirname(cache_path))
+
+    def test_token_cache_eviction(self):
+        cache_path = os.path.join(self.test_dir, "tokens.sqlite3")
+        with TokenCache(cache_path, max_entries=2) as cache:
+            for i in range(5):
+                cache.put(f"oid{i}", "cl100k_base", i)
+        with TokenCache(cache_path) as cache:
+            remaining = [oid for oid in ("oid0", "oid1", "oid2", "oid3", "oid4") if cache.get(oid, "cl100k_base") is not None]
+            assert len(remaining) == 2
+
+    def git(self, *args):
+        return subprocess.run(["git", "-C", self.test_dir, *args], check=True, capture_output=True).stdout.decode()
+
+    @pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+    def test_index_source_matches_git(self):
+        self.create_file(".gitignore", "*.log\nbuild/\n")
+        self.create_file("src/main.py", "print('hello')")
+        self.create_file("src/util.py", "x = 1")
+        self.create_file("forced.log", "tracked despite .gitignore")
+        self.create_file("build/out.txt", "ignored")
+        self.create_file("notes.txt", "untracked")
+        self.git("init", "-q")
+        self.git("add", ".gitignore", "src")
+        self.git("add", "-f", "forced.log")
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False, source="index")
+        names = [entry.rel_path for entry in processor._build_manifest()]
+        assert names == [".gitignore", "forced.log", os.path.join("src", "main.py"), os.path.join("src", "util.py")]
+
+        processor = RepoProcessor(
+            self.test_dir, self.output_file, include_tree=False, source="index",
+            include_untracked=True, ignore_patterns=["src/util.py"],
+        )
+        names = [entry.rel_path for entry in processor._build_manifest()]
+        assert names == [".gitignore", "forced.log", "notes.txt", os.path.join("src", "main.py")]
+
+    def test_index_source_falls_back_outside_git(self):
+        self.create_file("file1.txt", "content1")
+
+        processor = RepoProcessor(self.test_dir, self.output_file, source="index")
+        assert processor.process() == 1
+
+    @pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+    def test_rev_dumps_committed_contents(self):
+        self.create_file("main.py", "print('v1')\n")
+        self.create_file("docs/big.txt", "x" * 2000)
+        with open(os.path.join(self.test_dir, "logo.png"), "wb") as f:
+            f.write(b"\x89PNG\0\0")
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("-c", "user.name=t", "-c", "user.email=t@example.com", "commit", "-qm", "v1")
+        self.git("tag", "v1")
+        self.create_file("main.py", "print('v2')\n")
+        self.create_file("new.py", "uncommitted")
+
+        for jobs in (1, 3):
+            output_file = os.path.join(self.test_dir, f"rev{jobs}.txt")
+            processor = RepoProcessor(self.test_dir, output_file, rev="v1", max_file_size=1000, jobs=jobs)
+            count = processor.process()
+
+            assert count == 1
+            with open(output_file, "r", encoding="utf-8") as f:
+                content = f.read()
+            assert "--- FILE: main.py ---\nprint('v1')\n--- END FILE ---" in content
+            assert "new.py" not in content
+            assert "big.txt" not in content
+            assert "logo.png" in content.split("--- END REPOSITORY STRUCTURE ---")[0]
+
+    @pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+    def test_diff_dumps_changed_files_only(self):
+        commit = ["-c", "user.name=t", "-c", "user.email=t@example.com", "commit", "-qm"]
+        self.create_file("keep.py", "unchanged\n")
+        self.create_file("edit.py", "old\n")
+        self.create_file("gone.py", "deleted\n")
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git(*commit, "base")
+        self.git("tag", "base")
+        self.git("checkout", "-q", "-b", "feature")
+        self.create_file("edit.py", "new\n")
+        self.create_file("pkg/added.py", "added\n")
+        os.remove(os.path.join(self.test_dir, "gone.py"))
+        self.git("add", "-A")
+        self.git(*commit, "feature")
+        self.create_file("edit.py", "work in progress\n")
+
+        processor = RepoProcessor(self.test_dir, self.output_file, diff="base..feature", diff_hunks=True)
+        assert processor.process() == 2
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            content = f.read()
+        assert "--- FILE: edit.py ---\nnew\n--- END FILE ---" in content
+        assert "--- FILE: " + os.path.join("pkg", "added.py") + " ---" in content
+        assert "--- DIFF: edit.py ---\ndiff --git a/edit.py b/edit.py" in content
+        assert "-old\n+new\n--- END DIFF ---" in content
+        assert "keep.py" not in content
+        assert "gone.py" not in content
+
+        # Merge base of base and HEAD is base itself; a bare base compares with the working tree
+        processor = RepoProcessor(self.test_dir, self.output_file, include_tree=False, diff="base", merge_base=True)
+        assert processor.process() == 2
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            content = f.read()
+        assert "work in progress" in content
+        assert "--- DIFF:" not in content
+
+    @pytest.mark.skipif(shutil.which("git") is None, reason="requires git")
+    def test_diff_from_subdirectory(self):
+        commit = ["-c", "user.name=t", "-c", "user.email=t@example.com", "commit", "-qm"]
+        self.create_file("sub/a.txt", "old\n")
+        self.create_file("other/o.txt", "old\n")
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git(*commit, "base")
+        self.create_file("sub/a.txt", "new\n")
+        self.create_file("other/o.txt", "new\n")
+        self.git("add", ".")
+        self.git(*commit, "change")
+        self.create_file("sub/a.txt", "work in progress\n")
+        sub = os.path.join(self.test_dir, "sub")
+
+        # Paths are relative to the dumped directory, and other directories are left out
+        processor = RepoProcessor(
+            sub, self.output_file, verbose=False, include_tree=False, diff="HEAD~1..HEAD", diff_hunks=True
+        )
+        assert processor.process() == 1
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            content = f.read()
+        assert "--- FILE: a.txt ---\nnew\n--- END FILE ---" in content
+        assert "--- DIFF: a.txt ---\ndiff --git a/a.txt b/a.txt" in content
+        assert "o.txt" not in content
+
+        # Against the working tree
+        processor = RepoProcessor(sub, self.output_file, verbose=False, include_tree=False, diff="HEAD")
+        assert processor.process() == 1
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            assert "--- FILE: a.txt ---\nwork in progress\n--- END FILE ---" in f.read()
+
+    @pytest.mark.skipif(shutil.which("git") is None or not hasattr(os, "symlink"), reason="requires git and symlinks")
+    def test_diff_hunks_match_files_past_submodules_and_type_changes(self):
+        commit = ["-c", "user.name=t", "-c", "user.email=t@example.com", "commit", "-qm"]
+        self.create_file("edit.py", "old\n")
+        self.create_file("link.txt", "a file\n")
+        self.create_file("café notes.txt", "old\n")
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git(*commit, "base")
+        self.git("tag", "base")
+        first = self.git("rev-parse", "HEAD").strip()
+        # A submodule, added and then bumped
+        self.git("update-index", "--add", "--cacheinfo", f"160000,{first},sub")
+        self.git(*commit, "add submodule")
+        self.git("tag", "with-sub")
+        self.create_file("edit.py", "new\n")
+        self.create_file("café notes.txt", "new\n")
+        os.remove(os.path.join(self.test_dir, "link.txt"))
+        os.symlink("edit.py", os.path.join(self.test_dir, "link.txt"))
+        self.git("add", "edit.py", "link.txt", "café notes.txt")
+        self.git("update-index", "--cacheinfo", f"160000,{self.git('rev-parse', 'with-sub').strip()},sub")
+        self.git(*commit, "feature")
+
+        for diff in ("base..HEAD", "with-sub..HEAD"):
+            processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, diff=diff, diff_hunks=True)
+            processor.process()
+            assert set(processor._patches) == {"edit.py", "link.txt", "café notes.txt"}
+            assert processor._patches["edit.py"].startswith(b"diff --git a/edit.py b/edit.py\n")
+            assert b"-old\n+new\n" in processor._patches["edit.py"]
+            assert b"-old\n+new\n" in processor._patches["café notes.txt"]
+            # Both sections of the type change
+            link = processor._patches["link.txt"]
+            assert link.count(b"diff --git a/link.txt b/link.txt") == 2
+            assert b"-a file\n" in link and b"+edit.py\n" in link
+
+    def test_incremental_reuses_unchanged_files(self, monkeypatch):
+        self.create_file("a.txt", "alpha\n")
+        self.create_file("b.txt", "bravo\n")
+        self.create_file("dir/c.txt", "charlie")
+        with open(os.path.join(self.test_dir, "blob.bin"), "wb") as f:
+            f.write(b"\0\1\2")
+        # Outside the racy window, so stat signatures are trusted
+        for name in ("a.txt", "b.txt", "dir/c.txt", "blob.bin"):
+            os.utime(os.path.join(self.test_dir, name), ns=(10**18, 10**18))
+
+        def full_dump(**kwargs):
+            processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, count_tokens=True, **kwargs)
+            count = processor.process()
+            with open(self.output_file, "rb") as f:
+                return count, processor.total_tokens, f.read()
+
+        assert full_dump(incremental=True) == full_dump()
+        full_dump(incremental=True)
+        assert os.path.exists(self.output_file + ".manifest.json")
+
+        self.create_file("b.txt", "bravo, edited\n")
+        self.create_file("dir/d.txt", "delta\n")
+        os.remove(os.path.join(self.test_dir, "a.txt"))
+
+        opened = []
+        open_entry = RepoProcessor._open_entry
+        monkeypatch.setattr(
+            RepoProcessor, "_open_entry", lambda self, entry: opened.append(entry.rel_path) or open_entry(self, entry)
+        )
+        for jobs in (1, 3):
+            processor = RepoProcessor(
+                self.test_dir, self.output_file, verbose=False, count_tokens=True, incremental=True, jobs=jobs
+            )
+            count = processor.process()
+            with open(self.output_file, "rb") as f:
+                incremental = (count, processor.total_tokens, f.read())
+            if jobs == 1:
+                assert sorted(opened) == ["b.txt", os.path.join("dir", "d.txt")]
+                assert processor.reused_count == 1
+            assert incremental == full_dump()
+            assert not os.path.exists(self.output_file + ".tmp")
+
+    def test_update_refreshes_changed_paths(self):
+        self.create_file("a.txt", "alpha\n")
+        self.create_file("sub/b.txt", "bravo\n")
+        self.create_file("sub/c.txt", "charlie\n")
+        self.create_file("sub/e.txt", "echo\n")
+        self.create_file("old/f.txt", "foxtrot\n")
+
+        processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, incremental=True)
+        assert processor.update() == 5
+
+        self.create_file("a.txt", "alpha, edited\n")
+        self.create_file("new/d.txt", "delta\n")
+        os.remove(os.path.join(self.test_dir, "sub", "c.txt"))
+        shutil.rmtree(os.path.join(self.test_dir, "old"))
+        assert processor.update(["a.txt", "new", "old", os.path.join("sub", "c.txt")]) == 4
+        assert processor.reused_count == 2
+        with open(self.output_file, "rb") as f:
+            refreshed = f.read()
+        full_dir = tempfile.mkdtemp()
+        try:
+            full_output = os.path.join(full_dir, "full.txt")
+            RepoProcessor(self.test_dir, full_output, verbose=False, ignore_patterns=["output.txt*"]).process()
+            with open(full_output, "rb") as f:
+                assert f.read() == refreshed
+        finally:
+            shutil.rmtree(full_dir)
+        assert b"alpha, edited" in refreshed
+
+        # A new ignore rule rescans the repository and applies to files already in the dump
+        self.create_file(".gitignore", "sub/\n")
+        assert processor.update([".gitignore"]) == 3
+        with open(self.output_file, "rb") as f:
+            refreshed = f.read()
+        assert b"bravo" not in refreshed
+
+        processor.save_manifest()
+        full = RepoProcessor(self.test_dir, self.output_file, verbose=False)
+        full.process()
+        with open(self.output_file, "rb") as f:
+            assert f.read() == refreshed
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="requires inotify")
+    def test_inotify_watcher_reports_changes(self):
+        from src.git_dump.watch import InotifyWatcher
+
+        self.create_file(".gitignore", "build/\n")
+        self.create_file("src/main.py", "print('hello')\n")
+        self.create_file("build/out.o", "")
+        processor = RepoProcessor(self.test_dir, self.output_file, verbose=False)
+        watcher = InotifyWatcher(processor)
+        try:
+            self.create_file("src/main.py", "print('edited')\n")
+            self.create_file("build/out.o", "object")
+            self.create_file("output.txt", "the dump itself")
+            os.makedirs(os.path.join(self.test_dir, "pkg"))
+            changed = set()
+            while True:
+                events = watcher.read(0.2)
+                if not events:
+                    break
+                changed |= events
+            assert changed == {os.path.join("src", "main.py"), "pkg"}
+
+            # The new directory is watched too
+            self.create_file("pkg/mod.py", "")
+            assert watcher.read(1) == {os.path.join("pkg", "mod.py")}
+        finally:
+            watcher.close()
+
+    def test_index_gives_random_access(self):
+        from src.git_dump.index import DumpReader
+
+        files = {"a.txt": "alpha\n", "dir/b.txt": "no newline", "dir/c.txt": "caf\u00e9\r\nline\n", "empty.txt": ""}
+        for path, content in files.items():
+            self.create_file(path, content)
+        with open(os.path.join(self.test_dir, "blob.bin"), "wb") as f:
+            f.write(b"\0\1")
+
+        for incremental in (False, True, True):
+            processor = RepoProcessor(
+                self.test_dir, self.output_file, verbose=False, count_tokens=True,
+                index=True, incremental=incremental,
+            )
+            processor.process()
+            with DumpReader(self.output_file) as reader:
+                assert list(reader) == ["a.txt", "empty.txt", "dir/b.txt", "dir/c.txt"]
+                assert reader.read_text("dir/b.txt") == "no newline"
+                assert reader.read_text("dir/c.txt") == "caf\u00e9\nline\n"
+                view = reader.read("a.txt")
+                assert isinstance(view, memoryview) and view.tobytes() == b"alpha\n"
+                view.release()
+                entry = reader.entry("a.txt")
+                assert entry.sha == hashlib.sha1(b"blob 6\0alpha\n").hexdigest()
+                assert entry.tokens is not None
+                assert "blob.bin" not in reader
+
+        # An index that no longer matches its dump is refused
+        RepoProcessor(self.test_dir, self.output_file, verbose=False, include_tree=False).process()
+        with pytest.raises(ValueError):
+            DumpReader(self.output_file)
+
+    def test_max_tokens_fits_budget(self):
+        self.create_file("README.md", "# Project\n\nWhat it does.\n")
+        self.create_file("main.py", "print('hi')\n")
+        for i in range(20):
+            self.create_file(f"lib/deep/mod{i}.py", "".join(f"value_{j} = {j}\n" for j in range(50)))
+
+        unlimited = RepoProcessor(self.test_dir, self.output_file, verbose=False, count_tokens=True)
+        unlimited.process()
+        budget = unlimited.total_tokens // 3
+
+        processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, max_tokens=budget)
+        processed = processor.process()
+        assert 2 < processed < 22
+        assert 0 < processor.total_tokens <= budget
+
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            content = f.read()
+        # The file as written fits, counted whole (or estimated whole without tiktoken)
+        assert get_tiktoken_token_count(content) <= budget
+        assert "--- FILE: README.md ---" in content
+        assert "--- FILE: main.py ---" in content
+        # The tree only lists the files that were kept
+        tree = content.split("--- END REPOSITORY STRUCTURE ---")[0]
+        assert tree.count("mod") == processed - 2
+
+        # Spending the whole budget on the tree is an error
+        with pytest.raises(SystemExit):
+            RepoProcessor(self.test_dir, self.output_file, verbose=False, max_tokens=1).process()
+
+    def test_token_limits_hold_for_the_written_files(self):
+        # Many short sections: rounding each one down would add up to an overshoot
+        for i in range(40):
+            self.create_file(f"src/m{i:02}.py", f"x = {i:02}\n")
+        for budget in (350, 525):
+            processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, max_tokens=budget)
+            assert processor.process() > 10
+            with open(self.output_file, "r", encoding="utf-8") as f:
+                assert get_tiktoken_token_count(f.read()) <= budget
+        os.remove(self.output_file)
+
+        for limit in (100, 150):
+            processor = RepoProcessor(
+                self.test_dir, self.output_file, verbose=False, include_tree=False, split_tokens=limit
+            )
+            assert processor.process() == 40
+            for path in processor.shard_files:
+                with open(path, "r", encoding="utf-8") as f:
+                    assert get_tiktoken_token_count(f.read()) <= limit
+
+    def test_token_limits_use_token_cache(self, monkeypatch):
+        encoded = []
+
+        class FakeEncoding:
+            def encode_ordinary(self, text):
+                encoded.append(text)
+                return text.split()
+
+            def encode_ordinary_batch(self, texts, num_threads=8):
+                encoded.extend(texts)
+                return [text.split() for text in texts]
+
+        monkeypatch.setitem(sys.modules, "tiktoken", types.SimpleNamespace(get_encoding=lambda name: FakeEncoding()))
+        monkeypatch.setattr(core, "_ENCODERS", {})
+        for i in range(10):
+            self.create_file(f"src/m{i}.py", f"unique_{i} = {i}\n" * 20)
+        cache_path = os.path.join(self.test_dir, "tokens.sqlite3")
+
+        for options in ({"max_tokens": 400}, {"split_tokens": 300, "include_tree": False}):
+            outputs = []
+            for _ in range(2):
+                encoded.clear()
+                processor = RepoProcessor(
+                    self.test_dir, self.output_file, verbose=False, token_cache_path=cache_path,
+                    ignore_patterns=["tokens.sqlite3*", "output*"], **options,
+                )
+                processor.process()
+                texts = []
+                for path in processor.shard_files or [self.output_file]:
+                    with open(path, "r", encoding="utf-8") as f:
+                        texts.append(f.read())
+                outputs.append(texts)
+            # Contents were counted on the first run only
+            assert not any("unique_" in text and "FILE" not in text for text in encoded)
+            assert outputs[0] == outputs[1]
+
+    def test_split_bytes_writes_shards(self):
+        from src.git_dump.core import shard_path
+
+        for d in range(3):
+            for i in range(3):
+                self.create_file(f"pkg{d}/m{i}.py", "x = 1\n" * 10)
+        big = "".join(f"line {i}\n" for i in range(400))
+        self.create_file("pkg1/big.txt", big)
+        # Named like a shard, but no split is requested: an ordinary file
+        self.create_file("output.001.txt", "not a shard\n")
+        RepoProcessor(self.test_dir, self.output_file, verbose=False).process()
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            assert "--- FILE: output.001.txt ---\nnot a shard\n" in f.read()
+        os.remove(self.output_file)
+        with open(shard_path(self.output_file, 99), "w") as f:
+            f.write("stale shard")
+
+        limit = 1500
+        processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, split_bytes=limit)
+        assert processor.process() == 10
+        assert len(processor.shard_files) > 3
+        assert not os.path.exists(shard_path(self.output_file, 99))
+
+        parts = {}
+        for number, path in enumerate(processor.shard_files, 1):
+            assert path == shard_path(self.output_file, number)
+            with open(path, "rb") as f:
+                data = f.read()
+            assert len(data) <= limit
+            text = data.decode("utf-8")
+            assert text.startswith(f"--- SHARD {number}: {os.path.basename(self.test_dir)} ---\n")
+            # Every shard has the tree of the whole dump, and no earlier shard
+            assert text.count("big.txt") >= 1 and ".001" not in text.split("--- END REPOSITORY STRUCTURE ---")[0]
+            files = [line[len("--- FILE: "):-len(" ---")] for line in text.splitlines() if line.startswith("--- FILE: ")]
+            for name in files:
+                parts[name] = number
+            # Each small package fits in one shard and is not split
+            for d in (0, 2):
+                if f"pkg{d}/m0.py" in files:
+                    assert {f"pkg{d}/m1.py", f"pkg{d}/m2.py"} <= set(files)
+
+        # Only the file larger than a shard spans shards, cut at line ends
+        big_parts = sorted((number, name) for name, number in parts.items() if name.startswith("pkg1/big.txt"))
+        assert len(big_parts) > 1 and len({number for number, _ in big_parts}) == len(big_parts)
+        joined = ""
+        for number, name in big_parts:
+            with open(shard_path(self.output_file, number), "r", encoding="utf-8") as f:
+                text = f.read()
+            joined += text.split(f"--- FILE: {name} ---\n", 1)[1].split("--- END FILE ---\n", 1)[0]
+        assert joined == big
+
+    def test_jsonl_format(self):
+        import json
+
+        self.create_file("main.py", "print('hi')\n")
+        self.create_file("docs/notes.md", "--- END FILE ---\r\nfin")
+        with open(os.path.join(self.test_dir, "blob.bin"), "wb") as f:
+            f.write(b"\0\1")
+
+        for jobs in (1, 4):
+            processor = RepoProcessor(
+                self.test_dir, self.output_file, verbose=False, count_tokens=True,
+                output_format="jsonl", jobs=jobs,
+            )
+            assert processor.process() == 2
+            with open(self.output_file, "r", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+
+            assert [record["path"] for record in records] == ["main.py", "docs/notes.md"]
+            main, notes = records
+            assert main == {
+                "path": "main.py", "size": 12, "language": "python",
+                "tokens": main["tokens"], "sha": hashlib.sha1(b"blob 12\0print('hi')\n").hexdigest(),
+                "content": "print('hi')\n",
+            }
+            assert notes["language"] == "markdown"
+            assert notes["content"] == "--- END FILE ---\nfin"
+            assert processor.total_tokens == main["tokens"] + notes["tokens"] > 0
+
+        with pytest.raises(ValueError):
+            RepoProcessor(self.test_dir, self.output_file, output_format="jsonl", incremental=True)
+
+    def test_length_prefixed_headers_parse_by_seeking(self):
+        from src.git_dump.core import LENGTH_PREFIXED_START_DELIMITER, parse_length_prefixed
+
+        files = {
+            "a.txt": "alpha\n",
+            "tricky.txt": "--- END FILE ---\n--- FILE: fake.txt (bytes=3) ---\nno newline",
+            "dir/crlf.txt": "café\r\nline\r\n",
+            "empty.txt": "",
+        }
+        for path, content in files.items():
+            self.create_file(path, content)
+
+        for jobs in (1, 4):
+            processor = RepoProcessor(
+                self.test_dir, self.output_file, verbose=False, jobs=jobs,
+                start_delimiter=LENGTH_PREFIXED_START_DELIMITER,
+            )
+            assert processor.process() == 4
+            with open(self.output_file, "rb") as f:
+                assert b"--- FILE: a.txt (bytes=6) ---\nalpha\n--- END FILE ---\n" in f.read()
+                f.seek(0)
+                sections = list(parse_length_prefixed(f))
+                assert [s.path for s in sections] == ["a.txt", "empty.txt", "tricky.txt", "dir/crlf.txt"]
+                assert all(s.kind == "file" for s in sections)
+                contents = {}
+                for section in sections:
+                    f.seek(section.offset)
+                    contents[section.path] = f.read(section.length).decode("utf-8")
+            assert contents == {
+                path.replace("/", os.sep): content.replace("\r\n", "\n") for path, content in files.items()
+            }
+
+        # A length that does not match the content is detected
+        with open(self.output_file, "rb") as f:
+            data = f.read().replace(b"(bytes=6)", b"(bytes=4)")
+        with pytest.raises(ValueError):
+            list(parse_length_prefixed(io.BytesIO(data)))
+
+    def test_sqlite_format_upserts_changed_rows(self):
+        import sqlite3
+
+        self.create_file("main.py", "def parse_args():\n    pass\n")
+        self.create_file("util.py", "helper = 1\n")
+        self.create_file("old.py", "obsolete_symbol = 2\n")
+        with open(os.path.join(self.test_dir, "blob.bin"), "wb") as f:
+            f.write(b"\0\1")
+        # Outside the racy window, so stat signatures are trusted
+        for name in ("main.py", "util.py", "old.py", "blob.bin"):
+            os.utime(os.path.join(self.test_dir, name), ns=(10**18, 10**18))
+
+        def query(sql, *params):
+            conn = sqlite3.connect(self.output_file)
+            try:
+                return conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+
+        def run():
+            processor = RepoProcessor(
+                self.test_dir, self.output_file, verbose=False, count_tokens=True,
+                output_format="sqlite", incremental=True,
+            )
+            return processor, processor.process()
+
+        processor, count = run()
+        assert count == 3
+        assert query("SELECT path FROM files_fts WHERE files_fts MATCH ?", "parse_args") == [("main.py",)]
+        assert query("SELECT path FROM binary_files") == [("blob.bin",)]
+        rows = dict(query("SELECT path, tokens FROM files"))
+        assert processor.total_tokens == sum(rows.values()) > 0
+        ids = dict(query("SELECT path, id FROM files"))
+
+        self.create_file("util.py", "helper = 1\nnew_symbol = 3\n")
+        os.remove(os.path.join(self.test_dir, "old.py"))
+        self.create_file("added.py", "x = 4\n")
+        processor, count = run()
+        assert count == 3
+        assert processor.reused_count == 2  # main.py and blob.bin
+        assert dict(query("SELECT path, id FROM files"))["main.py"] == ids["main.py"]
+        assert query("SELECT content FROM files WHERE path = 'util.py'") == [("helper = 1\nnew_symbol = 3\n",)]
+        assert query("SELECT path FROM files_fts WHERE files_fts MATCH ?", "new_symbol") == [("util.py",)]
+        assert query("SELECT path FROM files_fts WHERE files_fts MATCH ?", "obsolete_symbol") == []
+        assert sorted(path for path, in query("SELECT path FROM files")) == ["added.py", "main.py", "util.py"]
+
+    def test_compressed_output(self):
+        import bz2
+        import gzip
+        import lzma
+
+        # Several parallel gzip blocks' worth
+        for i in range(40):
+            self.create_file(f"repo/module{i}.py", "".join(f"value_{i}_{n} = {n * i}\n" for n in range(800)))
+        repo = os.path.join(self.test_dir, "repo")
+        processor = RepoProcessor(repo, self.output_file, verbose=False)
+        processor.process()
+        with open(self.output_file, "rb") as f:
+            expected = f.read()
+        assert len(expected) > 4 * 128 * 1024
+
+        for suffix, decompress, threads in (
+            (".gz", gzip.decompress, 1), (".gz", gzip.decompress, 4),
+            (".xz", lzma.decompress, 1), (".bz2", bz2.decompress, 1),
+        ):
+            output = os.path.join(self.test_dir, "dump.txt" + suffix)
+            processor = RepoProcessor(repo, output, verbose=False, compress_threads=threads)
+            assert processor.process() == 40
+            with open(output, "rb") as f:
+                compressed = f.read()
+            assert len(compressed) < len(expected) // 4
+            assert decompress(compressed) == expected
+            os.remove(output)
+
+        output = os.path.join(self.test_dir, "dump.txt.gz")
+        processor = RepoProcessor(repo, output, verbose=False, split_bytes=len(expected) // 3, jobs=2)
+        processor.process()
+        assert processor.shard_files[0].endswith("dump.txt.001.gz")
+        for shard in processor.shard_files:
+            with gzip.open(shard, "rb") as f:
+                assert f.read().startswith(b"--- SHARD ")
+
+        with pytest.raises(ValueError):
+            RepoProcessor(repo, output, incremental=True)
+
+    def test_process_to_stream(self, monkeypatch):
+        for i in range(20):
+            self.create_file(f"dir/file{i}.txt", f"café {i}\n" * 50)
+        processor = RepoProcessor(self.test_dir, self.output_file, verbose=False)
+        processor.process()
+        with open(self.output_file, "rb") as f:
+            expected = f.read()
+        os.remove(self.output_file)
+
+        class Recorder(io.RawIOBase):
+            def __init__(self):
+                self.blocks = []
+
+            def writable(self):
+                return True
+
+            def write(self, data):
+                # Takes at most 700 bytes per call, like a pipe that is nearly full
+                self.blocks.append(bytes(data[:700]))
+                return len(self.blocks[-1])
+
+        monkeypatch.setattr(core, "OUTPUT_BUFFER_SIZE", 1000)
+        binary, text, recorder = io.BytesIO(), io.StringIO(), Recorder()
+        wrapper = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+        wrapper.write("preamble\n")
+        for stream in (binary, text, recorder, wrapper):
+            processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, jobs=2)
+            assert processor.process_to(stream) == 20
+        assert not os.path.exists(self.output_file)
+
+        assert binary.getvalue() == expected
+        assert text.getvalue() == expected.decode("utf-8")
+        assert b"".join(recorder.blocks) == expected
+        # Blocks of 1000+ bytes, written 700 at a time
+        assert len(recorder.blocks) <= 2 * (len(expected) // 1000 + 1)
+        assert wrapper.buffer.getvalue() == b"preamble\n" + expected
+
+        with pytest.raises(ValueError):
+            RepoProcessor(self.test_dir, self.output_file, incremental=True).process_to(binary)
+
+    def test_iter_files_reads_content_lazily(self, monkeypatch):
+        self.create_file(".gitignore", "*.log\n")
+        self.create_file("main.py", "print('hi')\r\n")
+        self.create_file("app.log", "ignored")
+        self.create_file("pkg/util.py", "x = 1\n")
+        with open(os.path.join(self.test_dir, "blob.bin"), "wb") as f:
+            f.write(b"\0\1")
+
+        opened = []
+        open_entry = RepoProcessor._open_entry
+        monkeypatch.setattr(
+            RepoProcessor, "_open_entry", lambda self, entry: opened.append(entry.rel_path) or open_entry(self, entry)
+        )
+        processor = RepoProcessor(self.test_dir, self.output_file, verbose=False)
+        records = list(processor.iter_files())
+        assert [record.path for record in records] == [".gitignore", "blob.bin", "main.py", "pkg/util.py"]
+        assert opened == []
+        assert not os.path.exists(self.output_file)
+
+        gitignore, blob, main, util = records
+        assert blob.binary and blob.content is None
+        assert not main.binary
+        assert main.size == 13 and main.stat.st_size == 13
+        assert main.content == "print('hi')\n"
+        assert main.oid == hashlib.sha1(b"blob 13\0print('hi')\r\n").hexdigest()
+        assert main.tokens is None
+        assert not hasattr(main, "__dict__")
+
+        opened.clear()
+        processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, count_tokens=True)
+        for record in processor.iter_files():
+            if record.path == "pkg/util.py":
+                assert record.tokens == get_tiktoken_token_count("x = 1\n")
+                break
+        assert opened == [os.path.join("pkg", "util.py")]
+
+        # Unreadable files raise rather than pass as text
+        os.remove(os.path.join(self.test_dir, ".gitignore"))
+        for _ in range(2):
+            with pytest.raises(OSError):
+                gitignore.binary
+
+        if shutil.which("git") is not None:
+            self.git("init", "-q")
+            self.git("add", "main.py")
+            self.git("-c", "user.name=t", "-c", "user.email=t@example.com", "commit", "-qm", "v1")
+            processor = RepoProcessor(self.test_dir, self.output_file, verbose=False, rev="HEAD")
+            (committed,) = list(processor.iter_files())
+            with pytest.raises(ValueError):
+                committed.binary
+            with pytest.raises(ValueError):
+                committed.content
+
+    def test_async_processor_streams_with_backpressure(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from src.git_dump.aio import AsyncRepoProcessor
+
+        for i in range(30):
+            self.create_file(f"dir/file{i}.txt", f"line {i}\n" * 200)
+        RepoProcessor(self.test_dir, self.output_file, verbose=False).process()
+        with open(self.output_file, "rb") as f:
+            expected = f.read()
+        os.remove(self.output_file)
+
+        async def main():
+            # One dump at a time: a stream left behind would hold the only thread
+            executor = ThreadPoolExecutor(max_workers=1)
+            dumps = AsyncRepoProcessor(self.test_dir, executor=executor, max_pending=2, block_size=1024, jobs=2)
+
+            stream = dumps.stream()
+            chunks = []
+            async for chunk in stream:
+                chunks.append(chunk)
+                await asyncio.sleep(0)
+                # Two chunks ahead at most, and the end marker
+                assert stream._queue.qsize() <= 3
+            assert b"".join(chunks) == expected
+            # Blocks of at least 1024 bytes
+            assert 10 < len(chunks) <= len(expected) // 1024 + 1
+            assert stream.processed_count == 30
+
+            async with dumps.stream() as stream:
+                assert expected.startswith(await stream.__anext__())
+            with pytest.raises(asyncio.TimeoutError):
+                async for chunk in dumps.stream(timeout=0):
+                    pass
+
+            # The closed and timed-out dumps gave their thread back
+            assert await asyncio.wait_for(dumps.dump(), 10) == expected
+            executor.shutdown()
+
+        asyncio.run(main())
+
+    def test_async_stream_stops_reading_files_once_closed(self, monkeypatch):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from src.git_dump.aio import AsyncRepoProcessor
+
+        for i in range(400):
+            self.create_file(f"dir/file{i:03}.txt", f"line {i}\n" * 50)
+        opened = []
+        open_entry = RepoProcessor._open_entry
+        monkeypatch.setattr(
+            RepoProcessor, "_open_entry", lambda self, entry: opened.append(entry.rel_path) or open_entry(self, entry)
+        )
+
+        async def main(jobs):
+            executor = ThreadPoolExecutor(max_workers=1)
+            dumps = AsyncRepoProcessor(self.test_dir, executor=executor, max_pending=1, block_size=1024, jobs=jobs)
+            stream = dumps.stream()
+            await stream.__anext__()
+            await stream.aclose()
+            opened_at_close = len(opened)
+            # Wait for the worker thread to end
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+            return opened_at_close
+
+        opened_at_close = asyncio.run(main(1))
+        assert opened_at_close < 50
+        assert len(opened) == opened_at_close
+
+        # Parallel reads: files already being read may finish, but no more start
+        opened.clear()
+        asyncio.run(main(4))
+        assert len(opened) < 100
+
+        # A dump past its deadline stops walking the repository too
+        for i in range(100):
+            self.create_file(f"tree/d{i:03}/f.txt", "x\n")
+        listed = []
+        scandir = os.scandir
+        monkeypatch.setattr(os, "scandir", lambda path: listed.append(path) or scandir(path))
+
+        async def expired():
+            executor = ThreadPoolExecutor(max_workers=1)
+            AsyncRepoProcessor(self.test_dir, executor=executor).stream(timeout=0)
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+        opened.clear()
+        asyncio.run(expired())
+        assert len(listed) <= 1 and opened == []
+
+    @pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires Unix sockets")
+    def test_server_refreshes_changed_files(self):
+        import threading
+        from src.git_dump.client import ServerError, request_dump
+        from src.git_dump.server import DumpServer
+
+        self.create_file("repo/a.txt", "alpha\n")
+        self.create_file("repo/sub/b.txt", "bravo\n")
+        self.create_file("repo/sub/c.txt", "charlie\n")
+        repo = os.path.join(self.test_dir, "repo")
+        socket_path = os.path.join(self.test_dir, "s.sock")
+        cache_dir = os.path.join(self.test_dir, "cache")
+
+        def expected():
+            RepoProcessor(repo, self.output_file, verbose=False).process()
+            with open(self.output_file, "rb") as f:
+                return f.read()
+
+        def request(**options):
+            out = io.BytesIO()
+            summary = request_dump(repo, out, socket_path, **options)
+            return summary, out.getvalue()
+
+        server = DumpServer(socket_path, max_repos=1, cache_dir=cache_dir)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            summary, dump = request()
+            assert dump == expected()
+            assert summary["files"] == 3 and summary["size"] == len(dump)
+
+            summary, dump = request()
+            assert dump == expected()
+            assert summary["reused"] == 3
+
+            self.create_file("repo/sub/b.txt", "bravo, edited\n")
+            os.remove(os.path.join(repo, "a.txt"))
+            summary, dump = request()
+            assert dump == expected()
+            assert summary["files"] == 2 and summary["reused"] == 1
+
+            # Only one repository is kept warm
+            assert len(os.listdir(cache_dir)) == 1
+            summary, dump = request(include_tree=False)
+            assert b"REPOSITORY STRUCTURE" not in dump
+            assert len(os.listdir(cache_dir)) == 1
+
+            with pytest.raises(ServerError):
+                request(max_tokens=10)
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert not os.path.exists(socket_path)
+        with pytest.raises(ServerError):
+            request()
+
+    @pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires Unix sockets")
+    def test_server_socket_is_private(self):
+        import stat
+        from src.git_dump.server import DumpServer
+
+        socket_path = os.path.join(self.test_dir, "run", "git-dump", "s.sock")
+        server = DumpServer(socket_path, cache_dir=os.path.join(self.test_dir, "cache"))
+        try:
+            assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+            assert stat.S_IMODE(os.stat(os.path.dirname(socket_path)).st_mode) == 0o700
+        finally:
+            server.server_close()
+
     def test_include_patterns(self):
         self.create_file("main.py", "print('hello')")
         self.create_file("README.md", "# project")
@@ -156,6 +1197,30 @@ class TestRepoProcessor:
             assert "main.py" in content
             assert "README.md" in content
 
+    def test_tree_lists_filtered_files(self):
+        self.create_file(".gitignore", "build/\n*.log")
+        self.create_file("main.py", "print('hello')")
+        self.create_file("app.log", "log content")
+        self.create_file("build/out.txt", "artifact")
+        self.create_file("docs/guide.md", "# guide")
+        with open(os.path.join(self.test_dir, "docs", "logo.png"), "wb") as f:
+            f.write(b"\x89PNG\0\0")
+
+        processor = RepoProcessor(self.test_dir, self.output_file, include_patterns=["*.py", "docs/*"])
+        processor.process()
+
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            content = f.read()
+        tree = content.split("--- END REPOSITORY STRUCTURE ---")[0]
+        assert "main.py" in tree
+        assert "docs/guide.md" in tree
+        assert "app.log" not in tree
+        assert "build" not in tree
+        assert ".gitignore" not in tree
+        # Binary files pass the filters, so they are listed, but have no body
+        assert "logo.png" in tree
+        assert "--- FILE: docs/logo.png ---" not in content
+
     def test_no_tree_inclusion(self):
         self.create_file("main.py", "print('hello')")
         self.create_file("README.md", "# project")